@@ -3,16 +3,36 @@
 # -*- coding: utf-8 -*-
 
 import sys
-from cattqt import cattqt
 
 if sys.version_info.major < 3:
     print("This program requires Python 3 and above to run.")
     sys.exit(1)
 
-__author__ = cattqt.author
-__email__ = cattqt.email
-__version__ = cattqt.version
+__author__ = "Scott Moreau"
+__email__ = "oreaus@gmail.com"
+__version__ = "5.1"
 
 
 def main() -> None:
-    cattqt.main()
+    # The gui module pulls in Qt, keep importing the package itself cheap.
+    # The headless daemon never loads the widgets at all
+    from cattqt.core import parse_args
+
+    args = parse_args(sys.argv[1:])
+    if args.headless:
+        from cattqt import daemon
+
+        daemon.main(args)
+        return
+    from cattqt import instance
+
+    if instance.single_instance(args):
+        reply = instance.forward(instance.request_from_args(args))
+        if reply != None:
+            if reply["error"] != None:
+                print(reply["error"])
+                sys.exit(1)
+            return
+    from cattqt import cattqt
+
+    cattqt.main(args)
@@ -0,0 +1,1731 @@
+# Copyright 2020 - Scott Moreau
+
+import os
+import sys
+import json
+import time
+import uuid
+import queue
+import random
+import threading
+import subprocess
+from dataclasses import replace
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal
+from pychromecast.models import CastInfo
+from pychromecast.controllers.media import MediaStatus
+from pychromecast.controllers.receiver import CastStatus
+from cattqt.metrics import percentile
+
+
+def print_percentiles(title, samples, unit="s", scale=1.0):
+    print(title)
+    width = max([len(name) for name in samples] + [5])
+    print(
+        "  %-*s %10s %10s %10s %10s"
+        % (width, "phase", "p50", "p90", "p99", "max")
+    )
+    for name, values in samples.items():
+        print(
+            "  %-*s %10s %10s %10s %10s"
+            % (
+                width,
+                name,
+                "%.3f%s" % (percentile(values, 50) * scale, unit),
+                "%.3f%s" % (percentile(values, 90) * scale, unit),
+                "%.3f%s" % (percentile(values, 99) * scale, unit),
+                "%.3f%s" % (max(values) * scale, unit),
+            )
+        )
+
+
+class StandInMediaController:
+    def __init__(self):
+        self.status = MediaStatus()
+        self.status_listeners = []
+
+    def register_status_listener(self, listener):
+        self.status_listeners.append(listener)
+
+    def update_status(self):
+        for listener in self.status_listeners:
+            listener.new_media_status(self.status)
+
+
+class StandInCast:
+    def __init__(self, cast_info, latency, reachable=None):
+        self.cast_info = cast_info
+        self.uuid = cast_info.uuid
+        self.name = cast_info.friendly_name
+        self.latency = latency
+        self.reachable = reachable
+        self.media_controller = StandInMediaController()
+        self.status = None
+        self.app_id = None
+        self.stopped = False
+        self.status_listeners = []
+        self.connection_listeners = []
+
+    def start(self):
+        thread = threading.Thread(target=self.connect)
+        thread.daemon = True
+        thread.start()
+
+    def connect(self):
+        from pychromecast.socket_client import ConnectionStatus, NetworkAddress
+
+        time.sleep(self.latency)
+        if self.reachable != None and not self.reachable(self.cast_info):
+            address = NetworkAddress(self.cast_info.host, self.cast_info.port)
+            status = ConnectionStatus("FAILED", address, None)
+            for listener in self.connection_listeners:
+                listener.new_connection_status(status)
+            return
+        self.ready()
+        for listener in self.status_listeners:
+            listener.new_cast_status(self.status)
+
+    def wait(self, timeout=None):
+        time.sleep(self.latency)
+        self.ready()
+
+    def ready(self):
+        self.status = CastStatus(
+            is_active_input=None,
+            is_stand_by=None,
+            volume_level=0.5,
+            volume_muted=False,
+            app_id=None,
+            display_name=None,
+            namespaces=[],
+            session_id=None,
+            transport_id=None,
+            status_text="",
+            icon_url=None,
+            volume_control_type="attenuation",
+        )
+
+    def disconnect(self, timeout=None):
+        self.stopped = True
+
+    def set_volume(self, level):
+        self.status = replace(self.status, volume_level=level)
+        for listener in self.status_listeners:
+            listener.new_cast_status(self.status)
+
+    def register_status_listener(self, listener):
+        self.status_listeners.append(listener)
+
+    def register_connection_listener(self, listener):
+        self.connection_listeners.append(listener)
+
+
+class StandInDiscovery(QObject):
+    device_added = pyqtSignal(object)
+    device_updated = pyqtSignal(object)
+    device_removed = pyqtSignal(object)
+
+    def __init__(self, count, latency=0.05, delay=0.0, parent=None):
+        super(StandInDiscovery, self).__init__(parent)
+        self.latency = latency
+        # How long the devices take to answer mDNS
+        self.delay = delay
+        self.announced = False
+        self.browses = 0
+        self.devices = {}
+        # Until when each device drops connection attempts
+        self.down = {}
+        for i in range(count):
+            # Stable across runs so a device cache recognizes them
+            u = uuid.uuid5(uuid.NAMESPACE_URL, "stand-in:%d" % (i + 1))
+            self.devices[u] = CastInfo(
+                services=set(),
+                uuid=u,
+                model_name="Chromecast",
+                friendly_name="Stand-in %d" % (i + 1),
+                host="127.0.0.%d" % (i % 250 + 2),
+                port=8009,
+                cast_type="cast",
+                manufacturer="Google Inc.",
+            )
+
+    def start(self):
+        self.browses = self.browses + 1
+        QTimer.singleShot(int(self.delay * 1000), self.announce)
+
+    def announce(self):
+        self.announced = True
+        for u in self.devices:
+            self.device_added.emit(u)
+
+    def stop(self):
+        pass
+
+    def get_cast_info(self, uuid):
+        # Like the browser, nothing is known before the devices answered
+        if not self.announced:
+            return None
+        return self.devices.get(uuid)
+
+    def get_chromecast(self, cast_info, tries=None, timeout=None):
+        # Connect latency is jittered so devices complete out of order
+        return StandInCast(
+            cast_info, self.latency * random.uniform(0.5, 1.5), self.reachable
+        )
+
+    def wind_down(self, cast, timeout):
+        pass
+
+    def drop(self, uuid, outage, host=None):
+        # The device is gone for outage seconds, when host is given it
+        # comes back on that address
+        self.down[uuid] = time.monotonic() + outage
+        if host != None:
+            self.devices[uuid] = replace(self.devices[uuid], host=host)
+
+    def reachable(self, cast_info):
+        info = self.devices.get(cast_info.uuid)
+        if info == None or info.host != cast_info.host:
+            return False
+        return time.monotonic() >= self.down.get(cast_info.uuid, 0)
+
+
+class Probe:
+    # What a benchmark asked of the app it started with --probe: stand-in
+    # devices in place of discovery, and a measurement once startup is
+    # done that prints its report and closes the app
+    def __init__(self, s, spec):
+        self.s = s
+        self.spec = spec
+        self.discovery = None
+        if spec.get("devices"):
+            self.discovery = StandInDiscovery(
+                spec["devices"], delay=spec.get("mdns_delay", 0.0), parent=s
+            )
+        if spec.get("measure") == "dispatch":
+            # Runs once the window is up, ahead of the stand-ins announcing
+            QTimer.singleShot(0, self.trace_memory)
+
+    def trace_memory(self):
+        import tracemalloc
+        import catt.api
+
+        # catt is loaded with the first device, keep it out of the
+        # per-device numbers
+        tracemalloc.start()
+        self.memory_baseline = tracemalloc.get_traced_memory()[0]
+
+    def startup_complete(self):
+        s = self.s
+        spec = self.spec
+        measure = spec.get("measure")
+        if measure == "startup":
+            print("startup-timing " + json.dumps(s.startup_timer.report()))
+            s.close()
+        elif measure == "dispatch":
+            report = measure_dispatch(s, self.memory_baseline)
+            print("dispatch " + json.dumps(report))
+            s.close()
+        elif measure == "connections":
+            ConnectionProbe(
+                s, spec["control"], spec["rounds"], rediscover=spec["rediscover"]
+            ).start()
+        elif measure == "reconnect":
+            ReconnectProbe(s, spec["rounds"]).start()
+        elif measure == "gaps":
+            GapProbe(s, spec["control"], spec["tracks"], spec["queue"]).start()
+        elif measure == "status-bus":
+            StatusStress(s, spec["seconds"], spec["rate"]).start()
+        elif measure == "e2e":
+            EndToEndProbe(s, spec["control"]).start()
+        elif measure == "replay":
+            ReplayProbe(s, spec["path"], spec["speed"]).start()
+
+
+def app_command(options):
+    return [sys.executable, "-u", "-c", "import cattqt; cattqt.main()"] + options
+
+
+def probe_option(**spec):
+    return "--probe=" + json.dumps(spec)
+
+
+def run_probe(options, prefix, env=None, timeout=None):
+    # Runs the app offscreen until it exits and returns the JSON report it
+    # printed after prefix, None when it printed none
+    if env == None:
+        env = dict(os.environ)
+        env["QT_QPA_PLATFORM"] = "offscreen"
+    result = subprocess.run(
+        app_command(options),
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        timeout=timeout,
+    )
+    report = None
+    for line in result.stdout.decode(errors="replace").splitlines():
+        if line.startswith(prefix + " "):
+            report = json.loads(line[len(prefix) + 1 :])
+    return report
+
+
+def run_startup_benchmark(runs, devices):
+    samples = {}
+    for run in range(runs):
+        report = run_probe(
+            [probe_option(devices=devices, measure="startup")], "startup-timing"
+        )
+        if report == None:
+            print("Run", run + 1, "failed")
+            continue
+        for name, t in report["phases"]:
+            samples.setdefault(name, []).append(t)
+        for t in report["devices"].values():
+            samples.setdefault("device connect", []).append(t)
+    if not samples:
+        return 1
+    print_percentiles(
+        "Startup over %d runs with %d stand-in devices" % (runs, devices), samples
+    )
+    return 0
+
+
+def connect_times(env, options, names, timeout):
+    # Seconds from launch until each device printed that it connected
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        app_command(options),
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    lines = read_lines(process.stdout)
+    times = {}
+    deadline = time.monotonic() + timeout
+    while len(times) < len(names):
+        try:
+            line = lines.get(timeout=max(deadline - time.monotonic(), 0.01))
+        except queue.Empty:
+            break
+        if line == None:
+            break
+        if line in names and line not in times:
+            times[line] = time.perf_counter() - start
+    # Leave it a moment to write the cache it just corrected
+    time.sleep(0.5)
+    process.terminate()
+    process.wait()
+    return times
+
+
+def run_device_cache_benchmark(runs=5, devices=10, delay=2.0, moved=2):
+    # The stand-in devices take delay seconds to answer mDNS. Each run starts
+    # once without a cache, once with the cache that left behind and once
+    # with moved devices cached on an address they no longer answer on
+    import tempfile
+
+    env = dict(os.environ)
+    env["QT_QPA_PLATFORM"] = "offscreen"
+    names = set("Stand-in %d" % (i + 1) for i in range(devices))
+    samples = {}
+    corrected = 0
+    for run in range(runs):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "devices.json")
+            options = [
+                probe_option(devices=devices, mdns_delay=delay),
+                "--device-cache=" + path,
+            ]
+            for kind in ("no cache", "cached", "moved"):
+                if kind == "moved":
+                    with open(path) as f:
+                        cache = json.load(f)
+                    for key in sorted(cache)[:moved]:
+                        cache[key]["host"] = "127.1.0.1"
+                    with open(path, "w") as f:
+                        json.dump(cache, f)
+                times = connect_times(env, options, names, delay + 10)
+                if len(times) < devices:
+                    print("Run", run + 1, kind, "failed")
+                    continue
+                times = sorted(times.values())
+                samples.setdefault(kind + ", first device", []).append(times[0])
+                if kind == "moved":
+                    samples.setdefault(kind + ", devices in place", []).append(
+                        times[-moved - 1]
+                    )
+                samples.setdefault(kind + ", all devices", []).append(times[-1])
+            with open(path) as f:
+                cache = json.load(f)
+            corrected = corrected + sum(
+                1 for entry in cache.values() if entry["host"] != "127.1.0.1"
+            )
+    if not samples:
+        return 1
+    print_percentiles(
+        "Launch to connected over %d runs, %d stand-in devices answering mDNS"
+        " after %.1fs and %d of them moved" % (runs, devices, delay, moved),
+        samples,
+    )
+    print("Cache entries corrected by discovery: %d/%d" % (corrected, runs * devices))
+    return 0
+
+
+# Cumulative import budgets in milliseconds, cattqt alone has to stay cheap
+# so version queries and forwarded commands never pay for Qt or the cast stack
+import_budgets = {"cattqt": 20, "cattqt.cattqt": 150}
+
+
+def import_time(module):
+    env = dict(os.environ)
+    env.pop("PYTHONPROFILEIMPORTTIME", None)
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import " + module],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    for line in result.stderr.decode(errors="replace").splitlines():
+        fields = line.split("|")
+        if len(fields) == 3 and fields[2].strip() == module:
+            return int(fields[1]) / 1000.0
+    return None
+
+
+def check_import_budget(runs=5):
+    failed = False
+    for module, budget in import_budgets.items():
+        # Take the best of several runs so a cold disk cache is not a failure
+        times = [import_time(module) for run in range(runs)]
+        if None in times:
+            print(module, "failed to import")
+            failed = True
+            continue
+        t = min(times)
+        status = "ok" if t <= budget else "over budget"
+        print("%-16s %8.1fms %8.1fms budget  %s" % (module, t, budget, status))
+        if t > budget:
+            failed = True
+    return 1 if failed else 0
+
+
+def run_server_benchmark(size_mb=256, clients=8, seeks=200):
+    import tempfile
+    import http.client
+    from concurrent.futures import ThreadPoolExecutor
+    from cattqt.server import MediaServer
+
+    size = size_mb * 1024 * 1024
+    with tempfile.NamedTemporaryFile(suffix=".mp4") as f:
+        chunk = os.urandom(1 << 20)
+        for i in range(size_mb):
+            f.write(chunk)
+        f.flush()
+        server = MediaServer(host="127.0.0.1")
+        server.start()
+        token = server.add_file(f.name)
+        path = "/" + token + "/" + os.path.basename(f.name)
+
+        def fetch(headers):
+            connection = http.client.HTTPConnection("127.0.0.1", server.port)
+            start = time.perf_counter()
+            connection.request("GET", path, headers=headers)
+            response = connection.getresponse()
+            first_byte = None
+            n = 0
+            while True:
+                data = response.read(1 << 20)
+                if first_byte == None:
+                    first_byte = time.perf_counter() - start
+                if not data:
+                    break
+                n = n + len(data)
+            connection.close()
+            return n, first_byte, time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(clients) as pool:
+            results = list(pool.map(fetch, [{}] * clients))
+        elapsed = time.perf_counter() - start
+        total = sum([n for n, first_byte, t in results])
+        if total != size * clients:
+            print("Short read:", total, "of", size * clients, "bytes")
+            server.stop()
+            return 1
+        print(
+            "Throughput: %d clients x %d MB in %.3fs, %.1f MB/s (sendfile %s)"
+            % (
+                clients,
+                size_mb,
+                elapsed,
+                total / (1024 * 1024) / elapsed,
+                "on" if server.sendfile else "off",
+            )
+        )
+        samples = {"first byte": [], "64 KB range": []}
+        for i in range(seeks):
+            first = random.randrange(0, size - 65536)
+            n, first_byte, t = fetch(
+                {"Range": "bytes=%d-%d" % (first, first + 65535)}
+            )
+            if n != 65536:
+                print("Bad range response:", n, "bytes")
+                server.stop()
+                return 1
+            samples["first byte"].append(first_byte)
+            samples["64 KB range"].append(t)
+        server.stop()
+    print_percentiles("Seek latency over %d range requests" % seeks, samples, "ms", 1000)
+    return 0
+
+
+def walk_next(directory, filename):
+    # What on_play_next did before the playlist index
+    paths = []
+    for root, directories, files in os.walk(directory):
+        for f in files:
+            paths.append(f)
+        break
+    paths.sort()
+    i = paths.index(filename)
+    return paths[i + 1] if i < len(paths) - 1 else None
+
+
+def run_playlist_benchmark(sizes=(1000, 10000, 100000), lookups=1000):
+    import tempfile
+    from cattqt.playlist import PlaylistIndex
+
+    extensions = (".mp3", ".mkv", ".mp4", ".flac", ".nfo", ".txt")
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            for i in range(size):
+                name = "Track %d%s" % (i, extensions[i % len(extensions)])
+                open(os.path.join(directory, name), "w").close()
+            current = "Track %d.mp3" % (size // 2 - size // 2 % len(extensions))
+            start = time.perf_counter()
+            for i in range(5):
+                walk_next(directory, current)
+            walk = (time.perf_counter() - start) / 5
+
+            playlists = PlaylistIndex()
+            start = time.perf_counter()
+            playlists.prepare(directory).result()
+            build = time.perf_counter() - start
+            start = time.perf_counter()
+            for i in range(lookups):
+                playlists.next(directory, current)
+            lookup = (time.perf_counter() - start) / lookups
+
+            name = "Track %d.mp3" % size
+            index = playlists.prepare(directory).result()
+            longest = 0.0
+            start = time.perf_counter()
+            open(os.path.join(directory, name), "w").close()
+            while time.perf_counter() - start < 5:
+                # Without inotify the lookup starts the rescan, and keeps
+                # answering from the old listing until it is done
+                before = time.perf_counter()
+                playlists.next(directory, current)
+                longest = max(longest, time.perf_counter() - before)
+                with playlists.lock:
+                    if index.position(name) != None:
+                        break
+                time.sleep(0.0001)
+            update = time.perf_counter() - start
+            mode = "inotify" if playlists.watcher != None else "mtime"
+            playlists.close()
+        print(
+            "%6d entries: walk %8.2fms  build %8.2fms  next %6.1fus"
+            "  new file %6.2fms (%s, longest next %.2fms)"
+            % (
+                size,
+                walk * 1000,
+                build * 1000,
+                lookup * 1000000,
+                update * 1000,
+                mode,
+                longest * 1000,
+            )
+        )
+    return 0
+
+
+def dispatch_time(devices, rounds):
+    if not devices:
+        return 0.0
+    for d in devices:
+        d.media_listener.apply(d.cast.media_controller.status)
+        d.status_listener.apply(d.cast.status)
+    start = time.perf_counter()
+    for r in range(rounds):
+        for d in devices:
+            d.media_listener.apply(d.cast.media_controller.status)
+            d.status_listener.apply(d.cast.status)
+    return (time.perf_counter() - start) / (rounds * len(devices) * 2)
+
+
+def measure_dispatch(s, baseline, rounds=20):
+    import tracemalloc
+
+    # The selected device also refreshes the widgets, keep it apart from
+    # the background devices whose cost has to stay flat
+    devices = list(s.registry.active())
+    selected = s.get_device_from_index(s.combo_box.currentIndex())
+    background = [d for d in devices if d is not selected]
+    memory = tracemalloc.get_traced_memory()[0] - baseline
+    return {
+        "devices": len(devices),
+        "selected": dispatch_time([selected] if selected else [], rounds),
+        "background": dispatch_time(background, rounds),
+        "memory": memory / max(len(devices), 1),
+    }
+
+
+def run_registry_benchmark(counts=(1, 10, 100, 250, 500)):
+    print(
+        "%8s %16s %16s %16s"
+        % ("devices", "selected/event", "background/event", "memory/device")
+    )
+    for count in counts:
+        probe = probe_option(devices=count, measure="dispatch")
+        report = run_probe([probe], "dispatch")
+        if report == None:
+            print("Run with", count, "devices failed")
+            return 1
+        print(
+            "%8d %14.2fus %14.2fus %14.1fKB"
+            % (
+                report["devices"],
+                report["selected"] * 1e6,
+                report["background"] * 1e6,
+                report["memory"] / 1024,
+            )
+        )
+    return 0
+
+
+class StatusStress(QObject):
+    def __init__(self, s, seconds=5, rate=5000, threads=4):
+        super(StatusStress, self).__init__(s)
+        self.s = s
+        self.seconds = seconds
+        self.rate = rate
+        self.threads = threads
+        self.running = False
+        self.workers = []
+
+    def start(self):
+        import threading
+
+        bus = self.s.status_bus
+        bus.posted_count = bus.applied_count = bus.flush_count = 0
+        bus.flush_time = bus.flush_time_max = 0.0
+        self.running = True
+        self.start_time = time.perf_counter()
+        for i in range(self.threads):
+            worker = threading.Thread(target=self.run, args=(i,), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+        QTimer.singleShot(self.seconds * 1000, self.finish)
+
+    def run(self, n):
+        # Each worker posts its share of the rate in small bursts, which
+        # is how receivers tend to deliver status updates
+        devices = list(self.s.registry.active())
+        rate = self.rate / self.threads
+        burst = 10
+        posted = 0
+        start = time.perf_counter()
+        while self.running:
+            for i in range(burst):
+                d = random.choice(devices)
+                status = MediaStatus()
+                status.player_state = "PLAYING"
+                status.stream_type = "BUFFERED"
+                status.duration = 300.0
+                status.current_time = (time.perf_counter() - start) % 300
+                status.media_metadata = {"title": "Stress"}
+                d.media_listener.new_media_status(status)
+                d.status_listener.new_cast_status(d.cast.status)
+            posted = posted + burst * 2
+            delay = posted / rate - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+
+    def finish(self):
+        self.running = False
+        for worker in self.workers:
+            worker.join()
+        elapsed = time.perf_counter() - self.start_time
+        self.s.status_bus.flush()
+        bus = self.s.status_bus
+        report = {
+            "devices": len(self.s.registry.active()),
+            "posted": bus.posted_count,
+            "applied": bus.applied_count,
+            "flushes": bus.flush_count,
+            "rate": bus.posted_count / elapsed,
+            "busy": bus.flush_time / elapsed,
+            "flush_max": bus.flush_time_max,
+        }
+        print("status-bus " + json.dumps(report))
+        self.s.close()
+
+
+def run_status_bus_benchmark(devices=50, rate=5000, seconds=5, busy_limit=0.25):
+    probe = probe_option(
+        devices=devices, measure="status-bus", rate=rate, seconds=seconds
+    )
+    report = run_probe([probe], "status-bus")
+    if report == None:
+        print("Stress run failed")
+        return 1
+    print(
+        "%d statuses from %d devices in %ds, %.0f/s"
+        % (report["posted"], report["devices"], seconds, report["rate"])
+    )
+    print(
+        "%d applied in %d flushes, %.1f%% of the gui thread, longest flush %.2fms"
+        % (
+            report["applied"],
+            report["flushes"],
+            report["busy"] * 100,
+            report["flush_max"] * 1000,
+        )
+    )
+    if report["busy"] > busy_limit:
+        print("Gui thread time over the %d%% limit" % (busy_limit * 100))
+        return 1
+    return 0
+
+
+def running_threads():
+    # Every thread of the process, Qt's and pychromecast's alike
+    try:
+        return len(os.listdir("/proc/self/task"))
+    except OSError:
+        return None
+
+
+def open_sockets():
+    try:
+        fds = os.listdir("/proc/self/fd")
+    except OSError:
+        return None
+    n = 0
+    for fd in fds:
+        try:
+            if os.readlink("/proc/self/fd/" + fd).startswith("socket:"):
+                n = n + 1
+        except OSError:
+            pass
+    return n
+
+
+class ReconnectProbe(QObject):
+    # Every round drops all devices at once for a random outage, one in
+    # four comes back on a new address. A device is usable again once it
+    # is online on a connection that has its status
+    def __init__(self, s, rounds=10, timeout=60):
+        super(ReconnectProbe, self).__init__(s)
+        self.s = s
+        self.rounds = rounds
+        self.timeout = timeout
+        self.round = 0
+        self.moves = 0
+        self.lost = []
+        self.recovered = []
+        self.replaced = []
+
+    def start(self):
+        self.devices = list(self.s.registry)
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.poll)
+        self.drop()
+        self.timer.start(5)
+
+    def drop(self):
+        from pychromecast.socket_client import ConnectionStatus, NetworkAddress
+
+        self.round = self.round + 1
+        self.pending = {}
+        self.round_start = time.perf_counter()
+        for i, d in enumerate(self.devices):
+            info = d.cast.cast_info
+            outage = random.uniform(0.1, 1.5)
+            host = None
+            if (self.round + i) % 4 == 0:
+                self.moves = self.moves + 1
+                host = "127.1.%d.%d" % (self.round % 250, i % 250 + 2)
+            self.s.discovery.drop(info.uuid, outage, host)
+            self.pending[d] = (d.cast, time.perf_counter(), outage)
+            address = NetworkAddress(info.host, info.port)
+            status = ConnectionStatus("LOST", address, None)
+            for listener in d.cast.connection_listeners:
+                listener.new_connection_status(status)
+
+    def poll(self):
+        now = time.perf_counter()
+        for d, (cast, lost, outage) in list(self.pending.items()):
+            if d.online and d.cast is not cast and d.cast.status != None:
+                del self.pending[d]
+                self.replaced.append(cast)
+                self.lost.append(now - lost)
+                self.recovered.append(now - lost - outage)
+        if self.pending and now - self.round_start < self.timeout:
+            return
+        if not self.pending and self.round < self.rounds:
+            self.drop()
+            return
+        self.timer.stop()
+        metrics = self.s.metrics
+        report = {
+            "devices": len(self.devices),
+            "rounds": self.round,
+            "moves": self.moves,
+            "missing": len(self.pending),
+            "lost": self.lost,
+            "recovered": self.recovered,
+            "counts": {
+                "in place": metrics.reconnects.value(path="in place"),
+                "direct": metrics.reconnects.value(path="direct"),
+                "discovery": metrics.reconnects.value(path="discovery"),
+                "failed dials": metrics.failed_dials.value(),
+            },
+            "pooled": len(self.s.connections.casts),
+            "stale": sum(not cast.stopped for cast in self.replaced),
+        }
+        print("reconnect " + json.dumps(report))
+        self.s.close()
+
+
+def run_reconnect_benchmark(devices=5, rounds=10):
+    probe = probe_option(devices=devices, measure="reconnect", rounds=rounds)
+    report = run_probe([probe], "reconnect")
+    if report == None:
+        print("Reconnect run failed")
+        return 1
+    counts = report["counts"]
+    print(
+        "%d devices dropped %d times, %d came back on a new address"
+        % (report["devices"], report["rounds"], report["moves"])
+    )
+    print_percentiles(
+        "Reconnect",
+        {"lost to usable": report["lost"], "after outage": report["recovered"]},
+    )
+    print("  direct dials                   %d" % counts["direct"])
+    print("  discovery fallbacks            %d" % counts["discovery"])
+    print("  failed dials                   %d" % counts["failed dials"])
+    print("  devices not back               %d" % report["missing"])
+    print("  replaced connections left open %d" % report["stale"])
+    if report["missing"] or report["stale"]:
+        return 1
+    if report["pooled"] != report["devices"]:
+        return 1
+    return 0
+
+
+def process_usage(pid):
+    # Cpu seconds, resident bytes and whether Qt widgets are mapped in
+    with open("/proc/%d/stat" % pid) as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    rss = 0
+    with open("/proc/%d/status" % pid) as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                rss = int(line.split()[1]) * 1024
+    with open("/proc/%d/maps" % pid) as f:
+        widgets = "libQt5Widgets" in f.read()
+    return cpu, rss, widgets
+
+
+def read_lines(stream):
+    lines = queue.Queue()
+
+    def run():
+        for line in stream:
+            lines.put(line.decode(errors="replace").rstrip("\n"))
+        lines.put(None)
+
+    threading.Thread(target=run, daemon=True).start()
+    return lines
+
+
+def wait_for_line(lines, prefix, timeout):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            line = lines.get(timeout=max(deadline - time.monotonic(), 0.01))
+        except queue.Empty:
+            return None
+        if line == None:
+            return None
+        if line.startswith(prefix):
+            return line
+
+
+def measure_idle(pid, seconds):
+    cpu, _, _ = process_usage(pid)
+    time.sleep(seconds)
+    after, rss, widgets = process_usage(pid)
+    return {"cpu": (after - cpu) / seconds, "rss": rss, "widgets": widgets}
+
+
+def api_request(base, path, body=None):
+    import urllib.request
+
+    data = json.dumps(body).encode() if body != None else None
+    request = urllib.request.Request(base + path, data=data)
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.loads(response.read())
+
+
+def measure_headless(devices, idle):
+    import urllib.request
+
+    env = dict(os.environ)
+    # No display at all, it has to come up on QCoreApplication alone
+    for name in ("DISPLAY", "WAYLAND_DISPLAY", "QT_QPA_PLATFORM"):
+        env.pop(name, None)
+    proc = subprocess.Popen(
+        app_command(
+            ["--headless", "--api=127.0.0.1:0", probe_option(devices=devices)]
+        ),
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    report = {"error": None}
+    try:
+        line = wait_for_line(read_lines(proc.stdout), "api ", 20)
+        if line == None:
+            report["error"] = "the api never came up"
+            return report
+        base = line[len("api ") :]
+        deadline = time.monotonic() + 20
+        listed = []
+        while len(listed) < devices and time.monotonic() < deadline:
+            listed = api_request(base, "/devices")["devices"]
+            time.sleep(0.05)
+        if len(listed) < devices:
+            report["error"] = "%d of %d devices listed" % (len(listed), devices)
+            return report
+        events = read_lines(urllib.request.urlopen(base + "/events", timeout=30))
+        uuid = listed[0]["uuid"]
+        start = time.perf_counter()
+        api_request(base, "/devices/%s/volume" % uuid, {"level": 0.3})
+        while True:
+            line = wait_for_line(events, "{", 5)
+            if line == None:
+                report["error"] = "no status event for the volume change"
+                return report
+            event = json.loads(line)
+            device = event["device"]
+            if (
+                event["event"] == "volume"
+                and device["uuid"] == uuid
+                and abs(device["volume"] - 0.3) < 0.01
+            ):
+                report["event_latency"] = time.perf_counter() - start
+                break
+        time.sleep(1)
+        report.update(measure_idle(proc.pid, idle))
+    finally:
+        proc.terminate()
+        try:
+            report["exit"] = proc.wait(10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            report["exit"] = None
+    return report
+
+
+def measure_gui(devices, idle):
+    env = dict(os.environ)
+    env["QT_QPA_PLATFORM"] = "offscreen"
+    proc = subprocess.Popen(
+        app_command([probe_option(devices=devices), "--startup-timing"]),
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        if wait_for_line(read_lines(proc.stdout), "all devices connected", 30) == None:
+            return None
+        time.sleep(1)
+        return measure_idle(proc.pid, idle)
+    finally:
+        proc.kill()
+        proc.wait()
+
+
+def run_headless_benchmark(devices=10, idle=5):
+    headless = measure_headless(devices, idle)
+    if headless["error"] != None:
+        print("Headless run failed:", headless["error"])
+        return 1
+    gui = measure_gui(devices, idle)
+    print("%d stand-in devices, idle for %ds after startup" % (devices, idle))
+    print("  %-26s %12s %12s" % ("", "headless", "gui"))
+    print(
+        "  %-26s %10.1fMB %10s"
+        % (
+            "resident memory",
+            headless["rss"] / 1e6,
+            "%.1fMB" % (gui["rss"] / 1e6) if gui else "-",
+        )
+    )
+    print(
+        "  %-26s %11.2f%% %12s"
+        % (
+            "idle cpu",
+            headless["cpu"] * 100,
+            "%.2f%%" % (gui["cpu"] * 100) if gui else "-",
+        )
+    )
+    print(
+        "  %-26s %12s %12s"
+        % (
+            "qt widgets loaded",
+            "yes" if headless["widgets"] else "no",
+            ("yes" if gui["widgets"] else "no") if gui else "-",
+        )
+    )
+    print(
+        "  status event after a volume change  %.1fms"
+        % (headless["event_latency"] * 1000)
+    )
+    if headless["exit"] != 0:
+        print("The daemon did not exit cleanly on SIGTERM")
+        return 1
+    if headless["widgets"] or (gui and headless["rss"] >= gui["rss"]):
+        return 1
+    return 0
+
+
+class EmulatorProbe(QObject):
+    # Runs the gui against the emulator one step at a time, each waiting
+    # on a condition of the app's state, and prints the report after tag
+    tag = None
+
+    def __init__(self, s, control, timeout=60):
+        super(EmulatorProbe, self).__init__(s)
+        self.s = s
+        self.base = "http://127.0.0.1:%d" % control
+        self.timeout = timeout
+        self.report = {"error": None}
+        self.check = None
+
+    def start(self):
+        receivers = api_request(self.base, "/devices")
+        self.uuids = [uuid.UUID(r["uuid"]) for r in receivers]
+        self.report["devices"] = len(self.uuids)
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.poll)
+        self.timer.start(20)
+        self.wait("every device to connect", self.all_online, self.on_online)
+
+    def devices(self):
+        return [self.s.registry.from_uuid(u) for u in self.uuids]
+
+    def all_online(self):
+        return all(d != None and d.online for d in self.devices())
+
+    def wait(self, what, check, then):
+        self.what = what
+        self.check = check
+        self.then = then
+        self.deadline = time.perf_counter() + self.timeout
+
+    def poll(self):
+        if self.check == None:
+            return
+        if self.check():
+            self.check = None
+            self.then()
+        elif time.perf_counter() > self.deadline:
+            self.check = None
+            self.report["error"] = "timed out waiting for " + self.what
+            self.finish()
+
+    def reconnected(self, times):
+        metrics = self.s.metrics
+        back = sum(child.value for labels, child in metrics.series(metrics.reconnects))
+        return back >= len(self.uuids) * times and self.all_online()
+
+    def finish(self):
+        self.timer.stop()
+        print(self.tag + " " + json.dumps(self.report))
+        self.s.close()
+
+
+class EndToEndProbe(EmulatorProbe):
+    # Drives the gui against emulated receivers through the paths a user
+    # takes, play and seek on every device and then all of them dropping,
+    # and reads the timings back from the app's own metrics
+    tag = "e2e"
+
+    def __init__(self, s, control, idle=3, outage=1.0, timeout=60):
+        super(EndToEndProbe, self).__init__(s, control, timeout)
+        self.idle = idle
+        self.outage = outage
+
+    def measure_cpu(self, name, then):
+        # Process time covers the connection and command threads too
+        start = (time.process_time(), time.perf_counter())
+
+        def done():
+            cpu = time.process_time() - start[0]
+            self.report[name] = cpu / (time.perf_counter() - start[1])
+            then()
+
+        QTimer.singleShot(self.idle * 1000, done)
+
+    def samples(self, family, **labels):
+        child = family.children.get(tuple(sorted(labels.items())))
+        return list(child.samples) if child != None else []
+
+    def on_online(self):
+        self.report["startup"] = time.perf_counter() - self.s.startup_timer.start
+        self.measure_cpu("idle_cpu", self.cast)
+
+    def cast(self):
+        import tempfile
+
+        self.directory = tempfile.TemporaryDirectory()
+        path = os.path.join(self.directory.name, "Emulated.mp4")
+        with open(path, "wb") as f:
+            f.write(bytes(256 * 1024))
+        for d in self.devices():
+            self.s.play(d, path)
+        self.wait("every device to play", self.all_playing, self.on_playing)
+
+    def all_playing(self):
+        metrics = self.s.metrics
+        return all(
+            self.samples(metrics.play_to_playing, device=d.device.name)
+            for d in self.devices()
+        )
+
+    def on_playing(self):
+        metrics = self.s.metrics
+        self.report["cast"] = [
+            self.samples(metrics.play_to_playing, device=d.device.name)[0]
+            for d in self.devices()
+        ]
+        self.measure_cpu("playing_cpu", self.seek)
+
+    def seek(self):
+        for d in self.devices():
+            self.s.seek(d, 60)
+        self.wait("every device to seek", self.all_seeked, self.on_seeked)
+
+    def seek_samples(self):
+        metrics = self.s.metrics
+        samples = []
+        for d in self.devices():
+            samples.extend(
+                self.samples(metrics.commands, device=d.device.name, command="seek")
+            )
+        return samples
+
+    def all_seeked(self):
+        return len(self.seek_samples()) >= len(self.uuids)
+
+    def on_seeked(self):
+        self.report["seek"] = self.seek_samples()
+        api_request(self.base, "/drop?device=all&outage=%f" % self.outage)
+        self.wait(
+            "every device to reconnect", lambda: self.reconnected(1), self.on_back
+        )
+
+    def on_back(self):
+        metrics = self.s.metrics
+        self.report["reconnect"] = []
+        self.report["paths"] = {}
+        for labels, child in metrics.series(metrics.reconnect_time):
+            self.report["reconnect"].extend(child.samples)
+            self.report["paths"][dict(labels)["path"]] = child.count
+        self.finish()
+
+
+class ConnectionProbe(EmulatorProbe):
+    # Drops every emulated receiver rounds times and counts what getting
+    # them back cost in discovery browses, connections the receivers hold,
+    # threads and sockets. With rediscover, every device that came back is
+    # also looked up by name and given a new catt device, which is what
+    # on_add_device did before the connection pool
+    tag = "connections"
+
+    def __init__(self, s, control, rounds=5, outage=1.0, rediscover=False):
+        super(ConnectionProbe, self).__init__(s, control)
+        self.rounds = rounds
+        self.outage = outage
+        self.rediscover = rediscover
+        self.round = 0
+        self.browses = 0
+        self.lock = threading.Lock()
+        self.lookups = []
+        self.kept = []
+        self.failed = 0
+
+    def count_browses(self):
+        from pychromecast.discovery import CastBrowser
+
+        start_discovery = CastBrowser.start_discovery
+
+        def counted(browser):
+            with self.lock:
+                self.browses = self.browses + 1
+            return start_discovery(browser)
+
+        CastBrowser.start_discovery = counted
+
+    def on_online(self):
+        # Whatever startup left running is the baseline
+        QTimer.singleShot(1000, self.take_baseline)
+
+    def take_baseline(self):
+        self.count_browses()
+        self.threads = running_threads()
+        self.sockets = open_sockets()
+        self.drop()
+
+    def drop(self):
+        self.round = self.round + 1
+        api_request(self.base, "/drop?device=all&outage=%f" % self.outage)
+        self.wait(
+            "every device to reconnect",
+            lambda: self.reconnected(self.round),
+            self.on_back,
+        )
+
+    def on_back(self):
+        if not self.rediscover:
+            self.next_round()
+            return
+        self.lookups = []
+        for d in self.devices():
+            thread = threading.Thread(
+                target=self.look_up, args=(d.device.name,), daemon=True
+            )
+            thread.start()
+            self.lookups.append(thread)
+        self.wait("every device to be looked up", self.looked_up, self.next_round)
+
+    def look_up(self, name):
+        import pychromecast
+        from catt.api import CattDevice
+
+        try:
+            casts, browser = pychromecast.get_listed_chromecasts(
+                friendly_names=[name]
+            )
+            casts[0].wait()
+            browser.stop_discovery()
+            self.kept.append((casts[0], CattDevice(name=name)))
+        except Exception:
+            with self.lock:
+                self.failed = self.failed + 1
+
+    def looked_up(self):
+        return not any(thread.is_alive() for thread in self.lookups)
+
+    def next_round(self):
+        if self.round < self.rounds:
+            self.drop()
+        else:
+            # Connections that were replaced need a moment to wind down
+            QTimer.singleShot(2000, self.measure)
+
+    def measure(self):
+        threads = running_threads()
+        sockets = open_sockets()
+        self.report.update(
+            {
+                "rounds": self.round,
+                "online": sum(d.online for d in self.devices()),
+                "browses": self.browses,
+                "held": api_request(self.base, "/stats")["connections"],
+                "threads": threads - self.threads if threads != None else None,
+                "sockets": sockets - self.sockets if sockets != None else None,
+                "failed": self.failed,
+            }
+        )
+        self.finish()
+
+
+class GapProbe(EmulatorProbe):
+    # Plays a directory on the first emulated receiver until its last
+    # track starts and reads back the silences the receiver timed between
+    # tracks. Without the queue every track end loads the next file, as
+    # directory playback did before the receiver queue
+    tag = "gaps"
+
+    def __init__(self, s, control, tracks=8, queue=True, timeout=60):
+        super(GapProbe, self).__init__(s, control, timeout)
+        self.tracks = tracks
+        self.queue = queue
+
+    def on_online(self):
+        import tempfile
+
+        if not self.queue:
+            from cattqt import cattqt
+            from cattqt.core import DirectoryQueue
+
+            # Nothing queued leaves every track end to on_play_next
+            cattqt.DirectoryQueue = lambda s, d: DirectoryQueue(s, d, window=0)
+        self.directory = tempfile.TemporaryDirectory()
+        for i in range(self.tracks):
+            path = os.path.join(self.directory.name, "Track %02d.mp4" % (i + 1))
+            with open(path, "wb") as f:
+                f.write(bytes(64 * 1024))
+        self.d = self.devices()[0]
+        self.last = "Track %02d.mp4" % self.tracks
+        self.s.play(self.d, os.path.join(self.directory.name, "Track 01.mp4"))
+        self.wait("the last track to play", self.last_playing, self.on_last)
+
+    def last_playing(self):
+        d = self.d
+        status = d.cast.media_controller.status
+        return (
+            d.filename == self.last
+            and status.player_state == "PLAYING"
+            and status.title == d.title
+        )
+
+    def on_last(self):
+        receiver = api_request(self.base, "/devices")[0]
+        self.report["played"] = receiver["tracks"]
+        self.report["gaps"] = receiver["gaps"]
+        self.directory.cleanup()
+        self.finish()
+
+
+def emulator_env(home):
+    env = dict(os.environ)
+    env["QT_QPA_PLATFORM"] = "offscreen"
+    # Keep the runs away from the user's caches and known hosts
+    env["XDG_CACHE_HOME"] = os.path.join(home, "cache")
+    env["XDG_CONFIG_HOME"] = os.path.join(home, "config")
+    return env
+
+
+def start_emulator(env, options):
+    # The emulator process and the control port and hosts it printed, None
+    # for both when it did not come up
+    emulator = subprocess.Popen(
+        [sys.executable, "-u", "-c", "from cattqt.emulator import main; main()"]
+        + options,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    line = wait_for_line(read_lines(emulator.stdout), "emulator ", 30)
+    if line == None:
+        emulator.terminate()
+        emulator.wait()
+        return None, None
+    return emulator, json.loads(line[len("emulator ") :])
+
+
+def measure_e2e(env, devices, timeout):
+    emulator, emulated = start_emulator(
+        env, ["--devices=%d" % devices, "--durations=600"]
+    )
+    if emulator == None:
+        return {"error": "the emulator did not start"}
+    try:
+        options = [
+            "--known-hosts=" + ",".join(emulated["hosts"]),
+            "--device-cache=none",
+            probe_option(measure="e2e", control=emulated["control"]),
+        ]
+        try:
+            report = run_probe(options, "e2e", env, timeout)
+        except subprocess.TimeoutExpired:
+            return {"error": "the app did not finish within %ds" % timeout}
+        if report == None:
+            return {"error": "the app exited without a report"}
+        return report
+    finally:
+        emulator.terminate()
+        emulator.wait()
+
+
+def run_e2e_benchmark(counts=(1, 10, 50, 200)):
+    # The gui on the offscreen platform against the protocol emulator,
+    # nothing stands in for pychromecast, catt or the media server
+    import tempfile
+
+    failed = 0
+    for devices in counts:
+        with tempfile.TemporaryDirectory() as home:
+            report = measure_e2e(emulator_env(home), devices, 120 + devices)
+        if report["error"] != None:
+            print(
+                "Run with %d emulated devices failed: %s" % (devices, report["error"])
+            )
+            failed = failed + 1
+            continue
+        print_percentiles(
+            "%d emulated devices, startup to all connected %.3fs"
+            % (devices, report["startup"]),
+            {
+                "play to playing": report["cast"],
+                "seek": report["seek"],
+                "lost to usable": report["reconnect"],
+            },
+        )
+        print(
+            "  cpu idle %.1f%%, playing %.1f%%, reconnects %s"
+            % (
+                report["idle_cpu"] * 100,
+                report["playing_cpu"] * 100,
+                ", ".join("%s %d" % x for x in sorted(report["paths"].items())),
+            )
+        )
+    return 1 if failed else 0
+
+
+def measure_connections(devices, rounds, rediscover):
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as home:
+        env = emulator_env(home)
+        # Found over mDNS like real devices, so every browse is real traffic
+        emulator, emulated = start_emulator(
+            env, ["--devices=%d" % devices, "--mdns"]
+        )
+        if emulator == None:
+            return {"error": "the emulator did not start"}
+        try:
+            probe = probe_option(
+                measure="connections",
+                control=emulated["control"],
+                rounds=rounds,
+                rediscover=rediscover,
+            )
+            report = run_probe([probe, "--device-cache=none"], "connections", env)
+        finally:
+            emulator.terminate()
+            emulator.wait()
+    if report == None:
+        return {"error": "the app exited without a report"}
+    return report
+
+
+def run_connection_benchmark(devices=10, rounds=5):
+    # The connection pool against looking every device that came back up
+    # by name and giving it a new catt device, as on_add_device used to
+    pooled = measure_connections(devices, rounds, False)
+    if pooled["error"] != None:
+        print("Pooled run failed:", pooled["error"])
+        return 1
+    rediscovered = measure_connections(devices, rounds, True)
+    if rediscovered["error"] != None:
+        print("Rediscover run failed:", rediscovered["error"])
+        return 1
+    runs = (pooled, rediscovered)
+    print(
+        "%d emulated devices found over mDNS, each dropped and reconnected %d times"
+        % (devices, rounds)
+    )
+    print("  %-34s %10s %10s" % ("", "pooled", "rediscover"))
+    rows = (
+        ("discovery browses", "browses", 1),
+        ("receiver connections per device", "held", devices),
+        ("new threads per device", "threads", devices),
+        ("new sockets per device", "sockets", devices),
+    )
+    for title, key, scale in rows:
+        values = [
+            "%.1f" % (run[key] / scale) if run[key] != None else "-" for run in runs
+        ]
+        print("  %-34s %10s %10s" % (title, values[0], values[1]))
+    print(
+        "  %-34s %10d %10d"
+        % ("devices online", pooled["online"], rediscovered["online"])
+    )
+    if rediscovered["failed"]:
+        print("  %d lookups by name failed" % rediscovered["failed"])
+    if pooled["online"] < devices or pooled["browses"] or pooled["held"] > devices:
+        return 1
+    if (pooled["threads"] or 0) > 0 or (pooled["sockets"] or 0) > 0:
+        return 1
+    return 0
+
+
+def measure_gaps(tracks, queue):
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as home:
+        env = emulator_env(home)
+        emulator, emulated = start_emulator(env, ["--durations=1"])
+        if emulator == None:
+            return {"error": "the emulator did not start"}
+        try:
+            options = [
+                "--known-hosts=" + ",".join(emulated["hosts"]),
+                "--device-cache=none",
+                probe_option(
+                    measure="gaps",
+                    control=emulated["control"],
+                    tracks=tracks,
+                    queue=queue,
+                ),
+            ]
+            report = run_probe(options, "gaps", env)
+        finally:
+            emulator.terminate()
+            emulator.wait()
+    if report == None:
+        return {"error": "the app exited without a report"}
+    return report
+
+
+def run_gap_benchmark(tracks=8, gap_limit=0.25):
+    # The receiver queue against loading the next file once the receiver
+    # reports the track finished, both timed by the emulated receiver
+    queued = measure_gaps(tracks, True)
+    if queued["error"] != None:
+        print("Queued run failed:", queued["error"])
+        return 1
+    reloaded = measure_gaps(tracks, False)
+    if reloaded["error"] != None:
+        print("Reload run failed:", reloaded["error"])
+        return 1
+    print(
+        "%d one second tracks on an emulated receiver, %d queued and %d reloaded"
+        " played" % (tracks, queued["played"], reloaded["played"])
+    )
+    print_percentiles(
+        "Gap between tracks",
+        {"receiver queue": queued["gaps"], "reload on finish": reloaded["gaps"]},
+        "ms",
+        1000,
+    )
+    if queued["played"] < tracks or max(queued["gaps"] or [0]) > gap_limit:
+        print("Gaps over %dms or tracks missing" % (gap_limit * 1000))
+        return 1
+    return 0
+
+
+class ReplayProbe(QObject):
+    # Feeds a recording of --record-statuses into the listeners of stand-in
+    # devices, recorded device n being stand-in n + 1, and times each
+    # event. Counters around the ui methods and a look at the widgets
+    # before and after tell how much of the ui every event touched
+    methods = (
+        ("Device", "update_ui_playing"),
+        ("Device", "update_ui_paused"),
+        ("Device", "update_ui_idle"),
+        ("Device", "update_text"),
+        ("Device", "set_text"),
+        ("Device", "set_dial_value"),
+        ("App", "set_progress"),
+        ("App", "set_icon"),
+        ("App", "set_volume_label"),
+    )
+
+    def __init__(self, s, path, speed=1.0, timeout=60):
+        super(ReplayProbe, self).__init__(s)
+        self.s = s
+        self.path = path
+        self.speed = speed
+        self.timeout = timeout
+        self.report = {"error": None}
+
+    def start(self):
+        from cattqt.recording import read_recording
+
+        try:
+            recorded, self.events = read_recording(self.path)
+        except (OSError, ValueError) as e:
+            self.report["error"] = str(e)
+            self.finish()
+            return
+        self.uuids = [
+            uuid.uuid5(uuid.NAMESPACE_URL, "stand-in:%d" % (n + 1))
+            for n in range(len(recorded))
+        ]
+        self.deadline = time.perf_counter() + self.timeout
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.wait_online)
+        self.timer.start(20)
+
+    def wait_online(self):
+        devices = [self.s.registry.from_uuid(u) for u in self.uuids]
+        if all(d != None and d.online for d in devices):
+            self.timer.stop()
+            self.devices = devices
+            self.replay()
+        elif time.perf_counter() > self.deadline:
+            self.timer.stop()
+            self.report["error"] = "timed out waiting for the stand-in devices"
+            self.finish()
+
+    def count_calls(self):
+        import cattqt.cattqt
+
+        self.calls = {}
+        for owner, name in self.methods:
+            cls = getattr(cattqt.cattqt, owner)
+            key = owner + "." + name
+            self.calls[key] = 0
+
+            def counted(*args, method=getattr(cls, name), key=key, **kwargs):
+                self.calls[key] = self.calls[key] + 1
+                return method(*args, **kwargs)
+
+            setattr(cls, name, counted)
+
+    def widgets(self):
+        s = self.s
+        return (
+            ("status label", s.status_label.text()),
+            ("progress label", s.progress_label.text()),
+            ("volume label", s.volume_label.text()),
+            ("progress slider", s.progress_slider.value()),
+            ("progress range", s.progress_slider.maximum()),
+            ("dial", s.dial.value()),
+            ("play button", s.play_button.isEnabled()),
+            ("skip button", s.skip_forward_button.isEnabled()),
+        )
+
+    def replay(self):
+        self.count_calls()
+        self.changes = {name: 0 for name, value in self.widgets()}
+        self.times = {}
+        self.lag = []
+        self.next = 0
+        self.first = self.events[0][0] if self.events else 0.0
+        self.started = time.perf_counter()
+        self.step()
+
+    def step(self):
+        from cattqt.recording import build_status
+
+        # Due events at the recorded pace, or 10ms worth of them at a time
+        # as fast as possible so Qt still gets to paint and tick
+        now = time.perf_counter()
+        if self.speed > 0:
+            due = self.first + (now - self.started) * self.speed
+        else:
+            due = None
+        while self.next < len(self.events):
+            t, n, kind, fields = self.events[self.next]
+            if due != None and t > due:
+                break
+            if due != None:
+                self.lag.append(
+                    time.perf_counter() - self.started - (t - self.first) / self.speed
+                )
+            self.apply(self.devices[n], kind, build_status(kind, fields))
+            self.next = self.next + 1
+            if due == None and time.perf_counter() - now > 0.01:
+                break
+        if self.next >= len(self.events):
+            self.report["elapsed"] = time.perf_counter() - self.started
+            self.finish()
+            return
+        wait = 0
+        if due != None:
+            t = self.events[self.next][0]
+            wait = (t - self.first) / self.speed - (time.perf_counter() - self.started)
+        QTimer.singleShot(max(int(wait * 1000), 0), self.step)
+
+    def apply(self, d, kind, status):
+        s = self.s
+        selected = s.combo_box.currentIndex() == d.index
+        before = self.widgets()
+        if kind == "s":
+            key = "select"
+            start = time.perf_counter()
+            s.combo_box.setCurrentIndex(d.index)
+        elif kind == "m":
+            key = "media " + ("selected" if selected else "background")
+            d.cast.media_controller.status = status
+            start = time.perf_counter()
+            d.media_listener.apply(status)
+        else:
+            key = "cast " + ("selected" if selected else "background")
+            d.cast.status = status
+            start = time.perf_counter()
+            d.status_listener.apply(status)
+        self.times.setdefault(key, []).append(time.perf_counter() - start)
+        for (name, value), (_, after) in zip(before, self.widgets()):
+            if value != after:
+                self.changes[name] = self.changes[name] + 1
+
+    def finish(self):
+        if self.report["error"] == None:
+            self.report["events"] = len(self.events)
+            self.report["devices"] = len(self.devices)
+            self.report["times"] = self.times
+            self.report["calls"] = self.calls
+            self.report["changes"] = self.changes
+            self.report["lag"] = self.lag
+        print("replay " + json.dumps(self.report))
+        self.s.close()
+
+
+def run_replay(path, speed=1.0):
+    from cattqt.recording import read_recording
+
+    try:
+        recorded, events = read_recording(path)
+    except (OSError, ValueError) as e:
+        print("Failed to read", path + ":", e)
+        return 1
+    if not events:
+        print(path, "has no statuses to replay")
+        return 1
+    length = events[-1][0] - events[0][0]
+    timeout = 120 + (length / speed if speed > 0 else 0)
+    probe = probe_option(
+        devices=len(recorded), measure="replay", path=path, speed=speed
+    )
+    try:
+        report = run_probe([probe, "--device-cache=none"], "replay", timeout=timeout)
+    except subprocess.TimeoutExpired:
+        print("The replay did not finish within %ds" % timeout)
+        return 1
+    if report == None:
+        print("The replay exited without a report")
+        return 1
+    if report["error"] != None:
+        print("Replay failed:", report["error"])
+        return 1
+    print_percentiles(
+        "%d statuses from %d devices over %.1fs, replayed %s in %.1fs"
+        % (
+            report["events"],
+            report["devices"],
+            length,
+            "%gx" % speed if speed > 0 else "as fast as possible",
+            report["elapsed"],
+        ),
+        report["times"],
+        unit="us",
+        scale=1e6,
+    )
+    print("  ui calls per event")
+    for name, calls in report["calls"].items():
+        print("    %-26s %8d %8.2f" % (name, calls, calls / report["events"]))
+    print("  widget changes per event")
+    for name, changes in report["changes"].items():
+        print("    %-26s %8d %8.2f" % (name, changes, changes / report["events"]))
+    if report["lag"]:
+        print(
+            "  behind schedule p50 %.1fms, p99 %.1fms, max %.1fms"
+            % (
+                percentile(report["lag"], 50) * 1000,
+                percentile(report["lag"], 99) * 1000,
+                max(report["lag"]) * 1000,
+            )
+        )
+    return 0
@@ -1,14 +1,16 @@
 # Copyright 2020 - Scott Moreau
 
+import time
+
+import_start = time.perf_counter()
+
 import os
 import sys
 import math
-import signal
-import requests
-import catt.api
-import subprocess
-from catt.api import CattDevice
-import pychromecast
+import heapq
+from collections import deque
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore import (
@@ -16,29 +18,235 @@ from PyQt5.QtCore import (
     QDir,
     QPointF,
     QTimer,
-    QTime,
-    QThread,
+    QEvent,
+    QObject,
+    QModelIndex,
+    QAbstractListModel,
     pyqtSignal,
     QEventLoop,
 )
+from cattqt import __author__, __email__, __version__
+from cattqt.core import (
+    StartupTimer,
+    StatusBus,
+    open_probe,
+    open_discovery,
+    ConnectionPool,
+    CommandQueue,
+    VolumeChannel,
+    DirectoryQueue,
+    DeviceLifecycle,
+    ConnectionListener,
+    register_gauges,
+    parse_args,
+)
+from cattqt.metrics import Metrics
+from cattqt.devicecache import open_cache
+from cattqt.recording import open_recorder
+
+
+startup_timer = StartupTimer(import_start)
+startup_timer.mark("imports")
+
+
+class KnownDevice:
+    # A cached device listed before it answered, the device takes the
+    # row over once it connected
+    __slots__ = ("uuid", "name", "host", "volume", "index", "connecting")
+    online = False
+
+    def __init__(self, uuid, name, host, volume):
+        self.uuid = uuid
+        self.name = name
+        self.host = host
+        self.volume = volume
+        self.index = None
+        self.connecting = True
+
+
+class DeviceRegistry:
+    # Every known device by uuid, host and its row in the device list,
+    # so lookups never scan the list. Rows are stable, a device that goes
+    # offline keeps its row and a reconnect takes the same row over
+    __slots__ = ("by_uuid", "by_host", "positions", "reserved")
+
+    def __init__(self):
+        self.by_uuid = {}
+        self.by_host = {}
+        self.positions = []
+        self.reserved = {}
+
+    def __iter__(self):
+        return iter(list(self.by_uuid.values()))
+
+    def __len__(self):
+        return len(self.by_uuid)
+
+    def reserve(self, known):
+        known.index = len(self.positions)
+        self.positions.append(known)
+        self.reserved[known.uuid] = known
+
+    def add(self, d):
+        known = self.reserved.pop(d.cast.uuid, None)
+        if known != None:
+            d.index = known.index
+            self.positions[d.index] = d
+        else:
+            d.index = len(self.positions)
+            self.positions.append(d)
+        self.by_uuid[d.cast.uuid] = d
+        self.by_host[d.device.ip_addr] = d
+
+    def from_uuid(self, uuid):
+        return self.by_uuid.get(uuid)
+
+    def from_host(self, host):
+        return self.by_host.get(host)
+
+    def rehost(self, d, host):
+        # A device that came back on another address keeps its row
+        if self.by_host.get(d.device.ip_addr) is d:
+            del self.by_host[d.device.ip_addr]
+        d.device.ip_addr = host
+        self.by_host[host] = d
+
+    def row(self, i):
+        # The device or the known device that has not connected yet
+        if i < 0 or i >= len(self.positions):
+            return None
+        return self.positions[i]
+
+    def from_index(self, i):
+        d = self.row(i)
+        if isinstance(d, KnownDevice):
+            return None
+        return d
+
+    def active(self):
+        return [d for d in self.positions if d.online]
 
 
-def time_to_seconds(time):
-    return time.hour() * 3600 + time.minute() * 60 + time.second()
+class DeviceModel(QAbstractListModel):
+    def __init__(self, registry):
+        super(DeviceModel, self).__init__()
+        self.registry = registry
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.registry.positions)
+
+    def data(self, index, role=Qt.DisplayRole):
+        d = self.registry.row(index.row())
+        if d == None:
+            return None
+        if isinstance(d, KnownDevice):
+            if role == Qt.DisplayRole:
+                if d.connecting:
+                    return d.name + " (connecting)"
+                return d.name + " (offline)"
+            if role == Qt.ToolTipRole:
+                if d.volume == None:
+                    return d.host
+                return "%s, last volume %d" % (d.host, d.volume)
+            return None
+        if role == Qt.DisplayRole:
+            if d.online:
+                return d.device.name
+            return d.device.name + " (offline)"
+        if role == Qt.ToolTipRole:
+            return d.device.ip_addr
+        return None
+
+    def flags(self, index):
+        d = self.registry.row(index.row())
+        if d == None or not d.online:
+            # Offline devices stay listed but can not be picked
+            return Qt.NoItemFlags
+        return Qt.ItemIsEnabled | Qt.ItemIsSelectable
+
+    def reserve(self, known):
+        row = len(self.registry.positions)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.registry.reserve(known)
+        self.endInsertRows()
+
+    def add(self, d):
+        # True when the device took over the row listed for it
+        if d.cast.uuid in self.registry.reserved:
+            self.registry.add(d)
+            self.row_changed(d.index)
+            return True
+        row = len(self.registry.positions)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.registry.add(d)
+        self.endInsertRows()
+        return False
+
+    def set_online(self, d, online):
+        d.online = online
+        self.row_changed(d.index)
+
+    def row_changed(self, row):
+        index = self.index(row)
+        self.dataChanged.emit(index, index)
 
 
 class Device:
+    __slots__ = (
+        "media_listener",
+        "status_listener",
+        "online",
+        "connection_listener",
+        "cast",
+        "index",
+        "_self",
+        "device",
+        "live",
+        "muted",
+        "unmute_volume",
+        "disconnect_volume",
+        "paused",
+        "playing",
+        "stopping",
+        "rebooting",
+        "cast_thread",
+        "queue",
+        "volume_channel",
+        "commands",
+        "media_token",
+        "directory",
+        "filename",
+        "title",
+        "playback_starting",
+        "playback_just_started",
+        "stopping_timer",
+        "starting_timer",
+        "just_started_timer",
+        "progress_clicked",
+        "position",
+        "anchor",
+        "rate",
+        "duration",
+        "deadline",
+        "reconnect",
+        "play_requested",
+        "__weakref__",
+    )
+
     def __init__(self, s, d, c, i):
         self.media_listener = MediaListener()
         self.media_listener._self = s
-        self.media_listener.index = i
+        self.media_listener.device = self
         self.status_listener = StatusListener()
         self.status_listener._self = s
-        self.status_listener.index = i
+        self.status_listener.device = self
         self.connection_listener = ConnectionListener()
         self.connection_listener._self = s
         self.cast = c
         self.index = i
+        self.online = True
         self._self = s
         self.device = d
         self.live = False
@@ -49,51 +257,42 @@ class Device:
         self.playing = False
         self.stopping = False
         self.rebooting = False
-        self.catt_process = None
+        self.cast_thread = None
+        self.queue = None
+        self.volume_channel = VolumeChannel(self, s.command_pool)
+        self.commands = CommandQueue(self, s.command_pool)
+        self.media_token = None
         self.directory = None
         self.filename = None
+        self.title = None
         self.playback_starting = False
         self.playback_just_started = False
         self.stopping_timer = QTimer()
         self.starting_timer = QTimer()
         self.just_started_timer = QTimer()
         self.progress_clicked = False
-        self.catt_read_thread = None
-        self.progress_timer = QTimer()
-        self.time = QTime(0, 0, 0)
+        self.position = 0.0
+        self.anchor = 0.0
+        self.rate = 0.0
+        self.duration = None
+        self.deadline = None
+        self.reconnect = None
+        self.play_requested = None
         self.stopping_timer.timeout.connect(lambda: s.on_stopping_timeout(self))
         self.starting_timer.timeout.connect(lambda: s.on_starting_timeout(self))
         self.just_started_timer.timeout.connect(lambda: s.on_just_started_timeout(self))
         self.stopping_timer.setSingleShot(True)
         self.starting_timer.setSingleShot(True)
         self.just_started_timer.setSingleShot(True)
-        self.progress_timer.timeout.connect(self.on_progress_tick)
 
-    def on_progress_tick(self):
-        s = self._self
-        self.time = self.time.addSecs(1)
-        duration = self.get_duration(self.cast.media_controller.status)
-        if duration and duration != 0 and time_to_seconds(self.time) >= int(duration):
-            # If progress is at the end, stop the device progress timer
-            self.set_state_idle(self.index)
-            if s.combo_box.currentIndex() == self.index:
-                # If it is the currently selected device, update the ui
-                self.update_ui_idle()
-        if s.combo_box.currentIndex() == self.index:
-            # Update the ui elements using current progress time
-            s.progress_label.setText(self.time.toString("hh:mm:ss"))
-            s.set_progress(time_to_seconds(self.time))
-
-    def set_state_playing(self, i, time):
+    def set_state_playing(self, i, time, rate=1.0, updated=None):
         s = self._self
-        s.set_time(i, int(time))
         self.paused = False
         self.playing = True
         if self.live:
-            s.stop_timer.emit(i)
-            self.time.setHMS(0, 0, 0)
+            s.clock.set(self, 0, 0.0)
         else:
-            s.start_timer.emit(i)
+            s.clock.set(self, time, rate, updated)
 
     def update_ui_playing(self, time, duration):
         s = self._self
@@ -108,14 +307,13 @@ class Device:
             s.skip_forward_button.setEnabled(True)
             s.progress_slider.setEnabled(True)
             s.set_icon(s.play_button, "SP_MediaPause")
-        s.set_progress(time)
-        s.progress_label.setText(self.time.toString("hh:mm:ss"))
+        s.set_progress(s.clock.position(self))
+        s.progress_label.setText(s.clock.text(self))
         self.update_text()
 
     def set_state_paused(self, i, time):
         s = self._self
-        s.set_time(i, int(time))
-        s.stop_timer.emit(i)
+        s.clock.set(self, time, 0.0)
         self.paused = True
         self.playing = True
 
@@ -123,17 +321,16 @@ class Device:
         s = self._self
         if duration != None:
             s.progress_slider.setMaximum(int(duration))
-        s.set_progress(time)
+        s.set_progress(s.clock.position(self))
         s.skip_forward_button.setEnabled(True)
         s.progress_slider.setEnabled(True)
         s.set_icon(s.play_button, "SP_MediaPlay")
-        s.progress_label.setText(self.time.toString("hh:mm:ss"))
+        s.progress_label.setText(s.clock.text(self))
         self.update_text()
 
     def set_state_idle(self, i):
         s = self._self
-        s.stop_timer.emit(i)
-        self.time.setHMS(0, 0, 0)
+        s.clock.set(self, 0, 0.0)
         self.playing = False
         self.paused = True
         self.live = False
@@ -143,7 +340,7 @@ class Device:
         s.set_progress(0)
         s.skip_forward_button.setEnabled(False)
         s.progress_slider.setEnabled(False)
-        s.progress_label.setText(self.time.toString("hh:mm:ss"))
+        s.progress_label.setText(s.clock.text(self))
         s.set_icon(s.play_button, "SP_MediaPlay")
         self.update_text()
 
@@ -166,6 +363,17 @@ class Device:
             e = x.get("entity")
             b = e.get("bundle")
             duration = b.get("duration")
+        s = self._self
+        if (
+            not duration
+            and self.filename != None
+            and self.directory != None
+            and s.metadata != None
+        ):
+            # The receiver has not said yet, the probe may know
+            m = s.metadata.lookup(os.path.join(self.directory, self.filename))
+            if m != None:
+                duration = m.duration
         return duration
 
     def split_seconds(self, s):
@@ -216,17 +424,16 @@ class Device:
             return
         self.set_text(s, status_text, title)
 
-    def kill_catt_process(self):
-        if self.catt_process == None:
-            return
-        if self.catt_read_thread != None:
-            self.catt_read_thread.cancel()
-        try:
-            os.kill(self.catt_process.pid, signal.SIGINT)
-            self.catt_process.wait()
-        except:
-            pass
-        self.catt_process = None
+    def cancel_cast(self):
+        if self.cast_thread != None:
+            self.cast_thread.cancel()
+            self.cast_thread = None
+        if self.queue != None:
+            self.queue.cancel()
+            self.queue = None
+        if self.media_token != None:
+            self._self.media_server.remove_file(self.media_token)
+            self.media_token = None
 
 
 class ComboBox(QComboBox):
@@ -239,9 +446,19 @@ class ComboBox(QComboBox):
     def showMenu(self, event):
         menu = QMenu()
         reboot_action = menu.addAction("Reboot", QComboBox)
+        group_action = menu.addAction("Group devices..", QComboBox)
+        ungroup_action = menu.addAction("Ungroup", QComboBox)
+        ungroup_action.setEnabled(self._self.group != None)
+        fleet_action = menu.addAction("Fleet actions..", QComboBox)
         action = menu.exec_(self.mapToGlobal(event))
         if action == reboot_action:
             self.reboot_device()
+        elif action == group_action:
+            self._self.create_group()
+        elif action == ungroup_action:
+            self._self.ungroup()
+        elif action == fleet_action:
+            self._self.show_fleet_dialog()
 
     def reboot_device(self):
         s = self._self
@@ -249,19 +466,7 @@ class ComboBox(QComboBox):
         d = s.get_device_from_index(i)
         if d == None:
             return
-        s.stop(d, "Rebooting..")
-        try:
-            requests.post(
-                "http://" + d.device.ip_addr + ":8008/setup/reboot",
-                json={"params": "now"},
-            )
-            print(d.device.name, "rebooting")
-            s.play_button.setEnabled(False)
-            s.stop_button.setEnabled(False)
-            d.rebooting = True
-        except:
-            print(d.device.name, "reboot failed")
-            pass
+        s.reboot(d)
 
 
 class Dial(QDial):
@@ -401,66 +606,281 @@ class SplashScreen(QSplashScreen):
         )
         painter.setPen(QPen(Qt.white, 1.0, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin))
         painter.drawStaticText(version_pos, QStaticText("v" + self.version))
-        self.painted = True
+        if not self.painted:
+            startup_timer.mark("splash painted")
+            self.painted = True
+            self.animation_trigger_timer.start(1000)
 
     def showMessage(self, message, alignment=Qt.AlignLeft, color=Qt.black):
         pass
 
-    def ensure_first_paint(self):
-        while not self.painted:
-            QThread.usleep(250)
-            QApplication.processEvents()
-        self.animation_trigger_timer.start(1000)
-
     def finish(self):
         self.animation_trigger_timer.stop()
         self.animation_frame_timer.stop()
         self.close()
 
 
-class DiscoverThread(QThread):
+class DeviceGroup:
+    def __init__(self, s, members):
+        self._self = s
+        self.members = members
+        self.media_token = None
+        self.drift_threshold = 1.0
+        self.drift_timer = QTimer()
+        self.drift_timer.timeout.connect(self.check_drift)
+        self.drift_timer.start(5000)
+
+    def names(self):
+        names = ["'" + m.device.name + "'" for m in self.members]
+        return ", ".join(names[:-1]) + " and " + names[-1]
+
+    def remove(self, d):
+        if d in self.members:
+            self.members.remove(d)
+
+    def check_drift(self):
+        leader = self.members[0]
+        status = leader.cast.media_controller.status
+        if status == None or status.player_state != "PLAYING" or leader.live:
+            return
+        for m in self.members[1:]:
+            m_status = m.cast.media_controller.status
+            if m_status == None or m_status.player_state != "PLAYING":
+                continue
+            drift = m_status.adjusted_current_time - status.adjusted_current_time
+            if abs(drift) > self.drift_threshold:
+                print(m.device.name, "drifted %.2fs, realigning" % drift)
+                m.commands.submit("seek", lambda m=m: self.realign(m))
+
+    def realign(self, m):
+        # Read the leader position as late as possible, right before the seek
+        status = self.members[0].cast.media_controller.status
+        m.device.seek(status.adjusted_current_time)
+
+    def stop(self):
+        self.drift_timer.stop()
+        if self.media_token != None:
+            self._self.media_server.remove_file(self.media_token)
+            self.media_token = None
+
+
+class GroupDialog(QDialog):
     def __init__(self, s):
-        super(DiscoverThread, self).__init__(s)
+        super(GroupDialog, self).__init__(s)
+        self.setWindowTitle("Group devices")
+        self.list = QListWidget()
+        for d in s.registry.active():
+            item = QListWidgetItem(d.device.name)
+            item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
+            grouped = s.group != None and d in s.group.members
+            item.setCheckState(Qt.Checked if grouped else Qt.Unchecked)
+            item.setData(Qt.UserRole, d.index)
+            self.list.addItem(item)
+        buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        layout = QVBoxLayout()
+        layout.addWidget(QLabel("Play, pause, seek and volume apply to every member"))
+        layout.addWidget(self.list)
+        layout.addWidget(buttons)
+        self.setLayout(layout)
+
+    def checked_indices(self):
+        indices = []
+        for i in range(self.list.count()):
+            item = self.list.item(i)
+            if item.checkState() == Qt.Checked:
+                indices.append(item.data(Qt.UserRole))
+        return indices
+
+
+class FleetRun(QObject):
+    # One command across many devices with at most parallel of them in
+    # flight. Every device gets it through its own command queue, so it
+    # is ordered against whatever else was sent to that device, and gives
+    # up on it after timeout seconds
+    progress = pyqtSignal(Device, str)
+    completed = pyqtSignal(Device, str)
+    done = pyqtSignal()
+
+    def __init__(self, s, devices, kind, level=None, parallel=8, timeout=10):
+        super(FleetRun, self).__init__(s)
         self.s = s
-
-    def run(self):
-        self.s.chromecasts, browser = pychromecast.discovery.discover_chromecasts()
-        browser.stop_discovery()
+        self.kind = kind
+        self.level = level
+        self.parallel = parallel
+        self.timeout = timeout
+        self.pending = deque(devices)
+        self.running = 0
+        self.results = {}
+        # Futures that are already done call back right away, queue them
+        # so they never start the next device from inside this one
+        self.completed.connect(self.on_completed, Qt.QueuedConnection)
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self.next()
+
+    def next(self):
+        while self.pending and self.running < self.parallel:
+            d = self.pending.popleft()
+            if not d.online:
+                self.report(d, "offline")
+                continue
+            future = self.s.start_fleet_command(d, self.kind, self.timeout, self.level)
+            if future == None:
+                self.report(d, "skipped")
+                continue
+            self.running = self.running + 1
+            self.progress.emit(d, "running")
+            start = time.perf_counter()
+            future.add_done_callback(
+                lambda f, d=d, start=start: self.completed.emit(
+                    d, self.result(f, start)
+                )
+            )
+        if not self.pending and self.running == 0:
+            self.elapsed = time.perf_counter() - self.start_time
+            self.done.emit()
+
+    def result(self, future, start):
+        if future.cancelled():
+            return "superseded"
+        error = future.result()
+        if error != None:
+            return "failed: " + error
+        return "done in %.2fs" % (time.perf_counter() - start)
+
+    def report(self, d, text):
+        self.results[d] = text
+        self.progress.emit(d, text)
+
+    def on_completed(self, d, text):
+        self.running = self.running - 1
+        self.report(d, text)
+        self.next()
+
+    def summary(self):
+        counts = {}
+        for text in self.results.values():
+            key = text.split(" ", 1)[0].rstrip(":")
+            counts[key] = counts.get(key, 0) + 1
+        return ", ".join("%d %s" % (n, key) for key, n in counts.items())
+
+
+class FleetDialog(QDialog):
+    actions = (
+        ("Stop", "stop"),
+        ("Pause", "pause"),
+        ("Mute", "mute"),
+        ("Unmute", "unmute"),
+        ("Reboot", "reboot"),
+    )
+
+    def __init__(self, s, parallel=8):
+        super(FleetDialog, self).__init__(s)
+        self.s = s
+        self.parallel = parallel
+        self.run = None
+        self.setWindowTitle("Fleet actions")
+        self.tree = QTreeWidget()
+        self.tree.setHeaderLabels(["Device", "Result"])
+        self.tree.setRootIsDecorated(False)
+        self.items = {}
+        for d in s.registry:
+            item = QTreeWidgetItem([d.device.name, "" if d.online else "offline"])
+            item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
+            item.setCheckState(0, Qt.Checked if d.online else Qt.Unchecked)
+            self.items[d] = item
+            self.tree.addTopLevelItem(item)
+        self.tree.resizeColumnToContents(0)
+        self.buttons = []
+        row = QHBoxLayout()
+        for label, kind in self.actions:
+            button = QPushButton(label)
+            button.clicked.connect(lambda checked, kind=kind: self.on_action(kind))
+            self.buttons.append(button)
+            row.addWidget(button)
+        self.volume = QSpinBox()
+        self.volume.setRange(0, 100)
+        self.volume.setValue(25)
+        self.volume.setPrefix(s.volume_prefix)
+        button = QPushButton("Set")
+        button.clicked.connect(lambda: self.on_action("volume"))
+        self.buttons.append(button)
+        row.addWidget(self.volume)
+        row.addWidget(button)
+        self.status = QLabel("Runs on the checked devices, %d at a time" % parallel)
+        layout = QVBoxLayout()
+        layout.addWidget(self.tree)
+        layout.addLayout(row)
+        layout.addWidget(self.status)
+        self.setLayout(layout)
+
+    def checked_devices(self):
+        return [d for d, item in self.items.items() if item.checkState(0) == Qt.Checked]
+
+    def on_action(self, kind):
+        devices = self.checked_devices()
+        if not devices:
+            return
+        if kind == "reboot":
+            answer = QMessageBox.question(
+                self, "Reboot", "Reboot %d devices?" % len(devices)
+            )
+            if answer != QMessageBox.Yes:
+                return
+        for d in devices:
+            self.items[d].setText(1, "queued")
+        level = self.volume.value() / 100 if kind == "volume" else None
+        self.run = FleetRun(self.s, devices, kind, level, self.parallel)
+        self.run.progress.connect(self.on_progress)
+        self.run.done.connect(self.on_done)
+        for button in self.buttons:
+            button.setEnabled(False)
+        self.status.setText(kind.capitalize() + "..")
+        self.run.start()
+
+    def on_progress(self, d, text):
+        self.items[d].setText(1, text)
+
+    def on_done(self):
+        for button in self.buttons:
+            button.setEnabled(True)
+        self.status.setText(
+            "%s: %s in %.2fs"
+            % (self.run.kind.capitalize(), self.run.summary(), self.run.elapsed)
+        )
 
 
-class CattReadThread(QThread):
-    def __init__(self, s, d, stdout):
-        super(CattReadThread, self).__init__(s)
-        self.s = s
-        self.d = d
-        self.stdout = stdout
-        self.canceled = False
-
-    def run(self):
-        for line in iter(self.stdout.readline, ""):
-            if (
-                b"Playing" in line
-                or b"Serving local file" in line
-                or b"Casting local file" in line
-                or self.canceled == True
-            ):
-                break
-        if self.canceled == False:
-            self.s.start_singleshot_timer.emit(self.d)
-
-    def cancel(self):
-        self.canceled = True
-
-
-class App(QMainWindow):
+class App(QMainWindow, DeviceLifecycle):
     stop_call = pyqtSignal(Device)
     play_next = pyqtSignal(Device)
+    command_done = pyqtSignal(Device, str, float)
+    command_failed = pyqtSignal(Device, str, str)
+    metadata_ready = pyqtSignal(str)
     add_device = pyqtSignal(str)
-    stop_timer = pyqtSignal(int)
-    start_timer = pyqtSignal(int)
     remove_device = pyqtSignal(str)
     stopping_timer_cancel = pyqtSignal(int)
-    start_singleshot_timer = pyqtSignal(Device)
+    cast_started = pyqtSignal(Device)
+    cast_failed = pyqtSignal(Device, str)
+    device_connected = pyqtSignal(object)
+    device_failed = pyqtSignal(object)
+    device_redialed = pyqtSignal(Device, object, str)
+
+    def showEvent(self, event):
+        self.clock.schedule_tick()
+        super(App, self).showEvent(event)
+
+    def hideEvent(self, event):
+        self.clock.schedule_tick()
+        super(App, self).hideEvent(event)
+
+    def changeEvent(self, event):
+        if event.type() == QEvent.WindowStateChange:
+            # Nothing to refresh while minimized
+            self.clock.schedule_tick()
+        super(App, self).changeEvent(event)
 
     def closeEvent(self, event):
         self.clean_up()
@@ -468,7 +888,13 @@ class App(QMainWindow):
 
     def create_devices_layout(self):
         self.devices_layout = QHBoxLayout()
+        self.registry = DeviceRegistry()
+        self.device_model = DeviceModel(self.registry)
+        self.status_bus = StatusBus(self, metrics=self.metrics)
+        self.status_bus.recorder = open_recorder(self.args)
+        self.clock = PlaybackClock(self)
         self.combo_box = ComboBox(self)
+        self.combo_box.setModel(self.device_model)
         self.devices_layout.addWidget(self.combo_box)
 
     def create_control_layout(self):
@@ -484,10 +910,6 @@ class App(QMainWindow):
         self.volume_label = QLabel()
         self.volume_label.setText(self.volume_prefix + "0")
         self.volume_label.setAlignment(Qt.AlignCenter)
-        self.volume_status_event_pending = False
-        self.volume_event_timer = QTimer()
-        self.volume_event_timer.timeout.connect(self.event_pending_expired)
-        self.volume_event_timer.setSingleShot(True)
         self.textbox = QLineEdit()
         self.textbox.setToolTip("File, Link or Playlist")
         self.textbox.returnPressed.connect(self.on_textbox_return)
@@ -544,7 +966,7 @@ class App(QMainWindow):
 
         return os.path.join(base_path, relative_path)
 
-    def __init__(self, app, version):
+    def __init__(self, app, version, args):
         super().__init__()
         self.title = "Cast All The Things"
         self.init_message = "Scanning network for Chromecast devices.."
@@ -552,52 +974,38 @@ class App(QMainWindow):
         self.width = 640
         self.height = 180
         self.version = version
-        self.reconnect_volume = -1
-        if len(sys.argv) == 2 and sys.argv[1].startswith("--reconnect-volume="):
-            try:
-                arg = sys.argv[1]
-                arg = arg[len("--reconnect-volume=") :]
-                if int(arg) < 0 or int(arg) > 100:
-                    raise Exception(
-                        "Reconnect volume value out of range. Valid range is 0-100."
-                    )
-                else:
-                    self.reconnect_volume = int(arg)
-            except Exception as e:
-                print(e)
+        self.args = args
+        self.startup_timer = startup_timer
+        self.reconnect_volume = args.reconnect_volume
+        self.connect_timeout = 10
+        self.dial_timeout = 3
+        self.discover_timeout = 5
+        self.connect_threads = []
+        self.command_pool = ThreadPoolExecutor(32)
+        self.metrics = Metrics()
+        self.metrics_server = None
+        self.http = None
+        self.fleet_dialog = None
+        self.group = None
+        self.connecting_uuids = set()
+        self.startup_complete = False
+        self.connected_uuids = set()
+        self.instance = None
+        self.pending_request = None
+        if args.media or args.device:
+            from cattqt.instance import request_from_args
+
+            self.pending_request = request_from_args(args)
         self.initUI()
 
-    def discover_loop(self):
-        self.splash.show()
-        self.splash.ensure_first_paint()
-        print(self.init_message)
-        splash_thread = DiscoverThread(self)
-        splash_thread.start()
-        while splash_thread.isRunning():
-            QThread.usleep(250)
-            QApplication.processEvents()
-        self.num_devices = len(self.chromecasts)
-        if self.num_devices == 0:
-            self.splash.hide()
-            print("No devices found")
-            reply = QMessageBox.question(
-                self,
-                "catt-qt",
-                "No devices found. Retry?",
-                QMessageBox.Yes | QMessageBox.No,
-                QMessageBox.Yes,
-            )
-            if reply == QMessageBox.Yes:
-                self.discover_loop()
-                return
-            else:
-                sys.exit(1)
-
     def initUI(self):
         self.splash = SplashScreen(QPixmap(320, 240), self)
         self.icon = QIcon(self.resource_path("chromecast.png"))
         self.splash.setWindowIcon(self.icon)
-        self.discover_loop()
+        self.probe = open_probe(self)
+        self.discovery = open_discovery(self)
+        self.connections = ConnectionPool(self.discovery)
+        self.device_cache = open_cache(self.args)
         self.setWindowTitle(self.title)
         self.setWindowIcon(self.icon)
         self.setGeometry(0, 0, self.width, self.height)
@@ -609,46 +1017,24 @@ class App(QMainWindow):
         self.create_status_layout()
         self.skip_forward_button.setEnabled(False)
         self.skip_forward_button.clicked.connect(self.on_skip_click)
-        self.start_timer.connect(self.on_start_timer)
-        self.stop_timer.connect(self.on_stop_timer)
         self.add_device.connect(self.on_add_device)
         self.remove_device.connect(self.on_remove_device)
         self.stop_call.connect(self.on_stop_signal)
         self.play_next.connect(self.on_play_next)
+        self.command_done.connect(self.on_command_done)
+        self.command_failed.connect(self.on_command_failed)
+        self.metadata_ready.connect(self.on_metadata_ready)
         self.stopping_timer_cancel.connect(self.on_stopping_timer_cancel)
-        self.start_singleshot_timer.connect(self.on_start_singleshot_timer)
-        self.devices = []
-        self.device_list = []
-        if self.num_devices > 1:
-            text = "devices found"
-        else:
-            text = "device found"
-        print(self.num_devices, text)
-        i = 0
+        self.cast_started.connect(self.on_cast_started)
+        self.cast_failed.connect(self.on_cast_failed)
+        self.device_connected.connect(self.on_device_connected)
+        self.device_failed.connect(self.on_device_failed)
+        self.device_redialed.connect(self.on_device_redialed)
+        self.discovery.device_added.connect(self.on_device_discovered)
+        self.discovery.device_updated.connect(self.on_device_discovered)
+        self.discovery.device_removed.connect(self.on_device_vanished)
         loop = QEventLoop()
-        for d in self.chromecasts:
-            chromecasts, browser = pychromecast.get_listed_chromecasts(
-                friendly_names=[d.friendly_name]
-            )
-            cast = chromecasts[0]
-            cast.wait()
-            catt_device = CattDevice(name=d.friendly_name)
-            device = Device(self, catt_device, cast, i)
-            cast.media_controller.register_status_listener(device.media_listener)
-            cast.register_status_listener(device.status_listener)
-            cast.register_connection_listener(device.connection_listener)
-            device.disconnect_volume = round(cast.status.volume_level * 100)
-            mc_status = cast.media_controller.status
-            device.filename = mc_status.title if mc_status else None
-            self.device_list.append(device)
-            self.devices.append(catt_device)
-            self.combo_box.addItem(cast.name)
-            if i == 0:
-                device.set_dial_value(cast)
-            print(cast.name)
-            i = i + 1
-            if mc_status and mc_status.player_state == "PLAYING":
-                cast.media_controller.update_status()
+        self.status_label.setText(self.init_message)
         self.app.focusChanged.connect(self.focus_changed)
         self.combo_box.currentIndexChanged.connect(self.on_index_changed)
         self.main_layout.addLayout(self.devices_layout)
@@ -662,12 +1048,133 @@ class App(QMainWindow):
         fg = self.frameGeometry()
         fg.moveCenter(QDesktopWidget().availableGeometry().center())
         self.move(fg.topLeft())
+        if self.device_cache != None:
+            # Listed right away, they take their rows once they answer
+            for u, entry in self.device_cache.entries():
+                self.device_model.reserve(
+                    KnownDevice(u, entry["name"], entry["host"], entry.get("volume"))
+                )
         self.show()
-        self.splash.finish()
         self.raise_()
         self.activateWindow()
+        startup_timer.mark("window shown")
+        self.splash.show()
+        print(self.init_message)
+        register_gauges(self.metrics, self, lambda: list(self.registry))
+        if self.args.metrics_port:
+            from cattqt.metrics import serve_metrics
+
+            self.metrics_server = serve_metrics(self.metrics, self.args.metrics_port)
+        from cattqt.instance import InstanceServer, single_instance
+
+        if single_instance(self.args):
+            self.instance = InstanceServer(self.on_instance_request, self)
+            self.instance.listen()
+        self.discovery.start()
+        startup_timer.mark("discovery started")
+        self.dial_known_devices()
+        QTimer.singleShot(self.discover_timeout * 1000, self.on_discovery_timeout)
         loop.exec()
 
+    def dial_known_devices(self):
+        # Cached devices are dialed on their last address without waiting
+        # on mDNS, discovery only confirms them or finds where they went
+        for known in list(self.registry.reserved.values()):
+            cast_info = self.device_cache.cast_info(known.uuid)
+            self.connect_device(cast_info, direct=True)
+
+    def on_discovery_timeout(self):
+        if len(self.registry) != 0 or self.connecting_uuids:
+            return
+        print("No devices found")
+        self.splash.finish()
+        self.status_label.setText("No devices found, still listening..")
+
+    def create_device(self, catt_device, cast):
+        self.splash.finish()
+        d = Device(self, catt_device, cast, self.combo_box.count())
+        mc_status = cast.media_controller.status
+        d.filename = mc_status.title if mc_status else None
+        return d
+
+    def device_added(self, d):
+        took_over = self.device_model.add(d)
+        current = self.get_device_from_index(self.combo_box.currentIndex())
+        if current == None:
+            # The selection still sits on a cached device that has not answered
+            self.combo_box.setCurrentIndex(d.index)
+        elif current is d and took_over:
+            self.on_index_changed()
+        elif current is d:
+            d.set_dial_value(d.cast)
+            d.update_text()
+        mc_status = d.cast.media_controller.status
+        if mc_status and mc_status.player_state == "PLAYING":
+            d.cast.media_controller.update_status()
+
+    def connections_settled(self):
+        if self.startup_complete:
+            self.save_device_cache()
+        self.on_startup_complete()
+
+    def device_unreachable(self, cast_info):
+        known = self.registry.reserved.get(cast_info.uuid)
+        if known != None:
+            known.connecting = False
+            self.device_model.row_changed(known.index)
+        if not self.connecting_uuids and len(self.registry) != 0:
+            self.on_startup_complete()
+        if not self.connecting_uuids and len(self.registry) == 0:
+            self.status_label.setText(
+                "Failed to connect to " + cast_info.friendly_name + ", still listening.."
+            )
+
+    def on_startup_complete(self):
+        if self.startup_complete:
+            return
+        self.startup_complete = True
+        startup_timer.mark("all devices connected")
+        self.save_device_cache()
+        if self.args.startup_timing:
+            startup_timer.print_report()
+        if self.pending_request != None:
+            self.apply_request(self.pending_request)
+            self.pending_request = None
+        if self.probe != None:
+            self.probe.startup_complete()
+
+    def on_instance_request(self, request):
+        # A later launch handed over its command line
+        self.showNormal()
+        self.raise_()
+        self.activateWindow()
+        if not self.startup_complete:
+            # Applied once the devices are connected
+            self.pending_request = request
+            return None
+        return self.apply_request(request)
+
+    def apply_request(self, request):
+        media = request.get("media")
+        name = request.get("device")
+        d = self.get_device_from_index(self.combo_box.currentIndex())
+        if name:
+            d = None
+            for m in self.registry:
+                if m.device.name == name:
+                    d = m
+            if d == None:
+                self.status_label.setText("No device named " + name)
+                return "No device named " + name
+            self.combo_box.setCurrentIndex(d.index)
+        if not media:
+            return None
+        if d == None:
+            return "No device to cast to"
+        self.textbox.setText(media)
+        self.play(d, media)
+        return None
+
     def focus_changed(self, event):
         try:
             self.textbox.setFocus()
@@ -675,10 +1182,34 @@ class App(QMainWindow):
             pass
 
     def clean_up(self):
-        for d in self.device_list:
-            d.kill_catt_process()
+        for d in self.registry:
+            d.cancel_cast()
+            if d.reconnect != None:
+                d.reconnect.stop()
+        for thread in list(self.connect_threads):
+            thread.wait()
+        self.ungroup()
+        self.command_pool.shutdown(wait=False)
+        self.save_device_cache()
+        self.discovery.stop()
+        self.connections.close()
+        if self.instance != None:
+            self.instance.close()
+        if self.metrics_server != None:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+        if self.args.metrics_dump:
+            self.metrics.dump(self.args.metrics_dump)
+        if self.status_bus.recorder != None:
+            self.status_bus.recorder.close()
+        if self.http != None:
+            self.http.close()
+        self.close_library()
 
     def file_exists(self, d):
+        if d.directory == None or d.filename == None:
+            # Playing something this app did not cast, there is no file
+            return False
         if not os.path.exists(
             os.path.join(d.directory, d.filename)
         ) or not os.path.isfile(os.path.join(d.directory, d.filename)):
@@ -692,43 +1223,65 @@ class App(QMainWindow):
     def on_play_next(self, d):
         if d.filename == None or d.directory == None:
             return
+        if self.group != None and d in self.group.members[1:]:
+            # The leader moves the whole group on to the next file
+            return
         if not self.file_exists(d):
             return
 
-        paths = []
-        for root, directories, files in os.walk(d.directory):
-            for f in files:
-                paths.append(f)
-            break
-
-        paths.sort()
-
-        i = paths.index(d.filename)
-
-        if i >= len(paths) - 1:
+        name = self.next_playable(d.directory, d.filename)
+        if name == None:
             d.filename = d.directory = None
             return
 
-        i = i + 1
-
-        text = os.path.join(root, paths[i])
+        text = os.path.join(d.directory, name)
         self.play(d, text)
         self.textbox.setText(text)
 
-    def on_start_singleshot_timer(self, d):
+    def on_cast_started(self, d):
         d.playback_starting = False
         d.playback_just_started = True
         d.just_started_timer.start(2000)
+        if d.directory != None and len(self.group_members(d)) == 1:
+            # Groups still move on together through on_play_next
+            d.queue = DirectoryQueue(self, d)
+            d.queue.start()
 
     def on_just_started_timeout(self, d):
         d.playback_just_started = False
 
     def on_starting_timeout(self, d):
         if d.playback_starting == True:
-            d.kill_catt_process()
-            d.playback_starting = False
-            self.on_stop_signal(d)
-            self.on_play_next(d)
+            self.skip_unplayable(d)
+
+    def get_http(self):
+        # One keep-alive session for the setup api on port 8008 of every
+        # device, requests keeps a connection pool per host
+        if self.http == None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            self.http = requests.Session()
+            self.http.mount("http://", HTTPAdapter(pool_connections=64))
+        return self.http
+
+    def on_metadata_ready(self, path):
+        d = self.get_device_from_index(self.combo_box.currentIndex())
+        if d == None or d.filename == None or d.directory == None or d.live:
+            return
+        if os.path.join(d.directory, d.filename) != path or d.duration:
+            return
+        m = self.metadata.lookup(path)
+        if m != None and m.duration:
+            self.progress_slider.setMaximum(int(m.duration))
+
+    def skip_unplayable(self, d):
+        d.starting_timer.stop()
+        DeviceLifecycle.skip_unplayable(self, d)
+
+    def cast_not_started(self, d, error, skipping):
+        if not skipping:
+            self.stop(d, "Failed to play: " + error)
 
     def play(self, d, text):
         if text == "" or (
@@ -737,69 +1290,164 @@ class App(QMainWindow):
             self.status_label.setText("Failed to play, please include full path")
             print('Failed to play "%s" please include full path' % text)
             return
-        self.on_stop_signal(d)
-        d.stopping_timer.stop()
-        d.kill_catt_process()
+        if not d.online:
+            self.status_label.setText("Listening for '" + d.device.name + "'")
+            return
+        devices = self.group_members(d)
+        for member in devices:
+            self.on_stop_signal(member)
+            member.stopping_timer.stop()
+            member.cancel_cast()
+        grouped = len(devices) > 1
+        if grouped and self.group.media_token != None:
+            self.media_server.remove_file(self.group.media_token)
+            self.group.media_token = None
         self.status_label.setText("Playing..")
-        try:
-            catt = os.path.join(sys._MEIPASS, "catt")
-        except:
-            catt = "catt"
+        urls = {}
         if not "://" in text:
-            d.filename = os.path.basename(text)
-            d.directory = os.path.dirname(text)
+            title = self.local_title(text)
+            for member in devices:
+                member.filename = os.path.basename(text)
+                member.directory = os.path.dirname(text)
+                member.title = title
+                member.duration = None
             if not self.file_exists(d):
                 return
-            d.playback_just_started = d.playback_starting = True
-            d.just_started_timer.start(2000)
-            d.starting_timer.start(10000)
+            for member in devices:
+                member.playback_just_started = member.playback_starting = True
+                member.just_started_timer.start(2000)
+                member.starting_timer.start(10000)
             try:
-                si = subprocess.STARTUPINFO()
-                si.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-                d.catt_process = subprocess.Popen(
-                    [catt, "-d", d.device.name, "cast", text],
-                    close_fds=True,
-                    stdout=subprocess.PIPE,
-                    stdin=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    startupinfo=si,
-                )
-                d.catt_read_thread = CattReadThread(self, d, d.catt_process.stdout)
-                d.catt_read_thread.start()
-            except:
-                d.catt_process = subprocess.Popen(
-                    [catt, "-d", d.device.name, "cast", text],
-                    close_fds=True,
-                    stdout=subprocess.PIPE,
-                    stdin=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                )
-                d.catt_read_thread = CattReadThread(self, d, d.catt_process.stdout)
-                d.catt_read_thread.start()
+                # Group members share one token, so the file is read
+                # through a single path no matter how many devices play it
+                probe, token, urls = self.serve_local(devices, text)
+                probe.add_done_callback(lambda f: self.metadata_ready.emit(text))
+                if grouped:
+                    self.group.media_token = token
+                else:
+                    d.media_token = token
+            except Exception as e:
+                print("Failed to serve", text + ":", e)
+                self.stop(d, "Failed to serve " + text)
+                return
         else:
-            d.filename = None
-            d.directory = None
-            d.just_started_timer.stop()
-            d.starting_timer.stop()
-            try:
-                si = subprocess.STARTUPINFO()
-                si.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-                d.catt_process = subprocess.Popen(
-                    [catt, "-d", d.device.name, "cast", text],
-                    close_fds=True,
-                    stdout=subprocess.PIPE,
-                    stdin=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    startupinfo=si,
-                )
-            except:
-                d.catt_process = subprocess.Popen(
-                    [catt, "-d", d.device.name, "cast", text],
-                    close_fds=True,
-                    stdout=subprocess.PIPE,
-                    stdin=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                )
+            for member in devices:
+                member.filename = None
+                member.directory = None
+                member.title = None
+                member.just_started_timer.stop()
+                member.starting_timer.stop()
+        self.start_cast(devices, text, urls, d.title)
+
+    def group_members(self, d):
+        if self.group != None and d in self.group.members:
+            return self.group.members
+        return [d]
+
+    def fan_out(self, d, kind, action):
+        # Every group member gets the command on its own queue at once
+        # instead of waiting on the round trip to the previous one
+        for m in self.group_members(d):
+            m.commands.submit(kind, lambda m=m: action(m))
+
+    def on_command_failed(self, d, kind, error):
+        print(d.device.name, kind, "failed:", error)
+        self.metrics.command_failures.labels(device=d.device.name, command=kind).inc()
+        if kind == "reboot":
+            d.rebooting = False
+        if self.combo_box.currentIndex() == d.index:
+            self.status_label.setText("Failed to " + kind + ": " + error)
+            if kind == "reboot":
+                self.on_index_changed()
+
+    def create_group(self):
+        dialog = GroupDialog(self)
+        if not dialog.exec_():
+            return
+        members = []
+        for i in dialog.checked_indices():
+            d = self.get_device_from_index(i)
+            if d != None:
+                members.append(d)
+        self.ungroup()
+        if len(members) < 2:
+            return
+        # The selected device leads, the others are aligned to it
+        current = self.get_device_from_index(self.combo_box.currentIndex())
+        if current in members:
+            members.remove(current)
+            members.insert(0, current)
+        self.group = DeviceGroup(self, members)
+        print("Grouped", self.group.names())
+        self.status_label.setText("Grouped " + self.group.names())
+
+    def show_fleet_dialog(self):
+        if self.fleet_dialog != None and self.fleet_dialog.isVisible():
+            self.fleet_dialog.raise_()
+            return
+        self.fleet_dialog = FleetDialog(self)
+        self.fleet_dialog.show()
+
+    def start_fleet_command(self, d, kind, timeout, level=None):
+        # Runs the gui side of a fleet command and queues the device side,
+        # returns its future or None when there is nothing to do
+        current = self.combo_box.currentIndex() == d.index
+        if kind == "stop":
+            return self.on_stop(d, timeout)
+        if kind == "pause":
+            if not d.playing or d.paused:
+                return None
+            d.paused = True
+            self.clock.set(d, self.clock.position(d), 0.0)
+            if current:
+                self.set_icon(self.play_button, "SP_MediaPlay")
+            return d.commands.submit("pause", d.device.pause, timeout)
+        if kind == "reboot":
+            return self.reboot(d, timeout)
+        if kind == "mute":
+            if d.muted:
+                return None
+            d.unmute_volume = d.disconnect_volume
+            level = 0.0
+        elif kind == "unmute":
+            if not d.muted:
+                return None
+            level = d.unmute_volume / 100
+        d.muted = level == 0
+        # Through the same channel as the dial, so a level still queued
+        # from it can not land after this one
+        return d.volume_channel.set(level)
+
+    def reboot(self, d, timeout=None):
+        http = self.get_http()
+
+        def reboot():
+            http.post(
+                "http://" + d.device.ip_addr + ":8008/setup/reboot",
+                json={"params": "now"},
+                timeout=timeout or 10,
+            ).raise_for_status()
+
+        self.stop(d, "Rebooting..")
+        print(d.device.name, "rebooting")
+        if self.combo_box.currentIndex() == d.index:
+            self.play_button.setEnabled(False)
+            self.stop_button.setEnabled(False)
+        d.rebooting = True
+        return d.commands.submit("reboot", reboot, timeout)
+
+    def ungroup(self):
+        if self.group == None:
+            return
+        self.group.stop()
+        self.group = None
+
+    def remove_from_group(self, d):
+        if self.group == None:
+            return
+        self.group.remove(d)
+        if len(self.group.members) < 2:
+            self.ungroup()
 
     def on_play_click(self):
         i = self.combo_box.currentIndex()
@@ -808,22 +1456,18 @@ class App(QMainWindow):
             return
         if d.paused or d.live:
             if d.playing and not d.live:
-                try:
-                    d.device.play()
-                except:
-                    pass
+                self.fan_out(d, "play", lambda m: m.device.play())
                 self.set_icon(self.play_button, "SP_MediaPause")
-                d.paused = False
+                for m in self.group_members(d):
+                    m.paused = False
                 return
             self.play(d, self.textbox.text())
         elif d.playing:
             self.set_icon(self.play_button, "SP_MediaPlay")
-            try:
-                d.device.pause()
-            except:
-                pass
-            d.paused = True
-            d.progress_timer.stop()
+            self.fan_out(d, "pause", lambda m: m.device.pause())
+            for m in self.group_members(d):
+                m.paused = True
+                self.clock.set(m, self.clock.position(m), 0.0)
 
     def on_textbox_return(self):
         i = self.combo_box.currentIndex()
@@ -847,27 +1491,31 @@ class App(QMainWindow):
 
     def stop(self, d, text):
         d.set_state_idle(d.index)
-        self.status_label.setText(text)
-        d.update_ui_idle()
-        d.kill_catt_process()
+        if self.combo_box.currentIndex() == d.index:
+            # Fleet actions stop devices that are not the one shown
+            self.status_label.setText(text)
+            d.update_ui_idle()
+        d.cancel_cast()
         return d
 
-    def on_stop(self, d):
+    def on_stop(self, d, timeout=None):
         d.stopping = True
         self.stop(d, "Stopping..")
         d.playback_starting = False
         d.just_started_timer.stop()
         d.starting_timer.stop()
         d.stopping_timer.start(3000)
-        self.play_button.setEnabled(True)
-        d.device.stop()
+        if self.combo_box.currentIndex() == d.index:
+            self.play_button.setEnabled(True)
+        return d.commands.submit("stop", d.device.stop, timeout)
 
     def on_stop_click(self):
         i = self.combo_box.currentIndex()
         d = self.get_device_from_index(i)
         if d == None:
             return
-        self.on_stop(d)
+        for m in self.group_members(d):
+            self.on_stop(m)
 
     def on_stop_signal(self, d):
         self.on_stop(d)
@@ -875,6 +1523,8 @@ class App(QMainWindow):
     def on_file_click(self):
         i = self.combo_box.currentIndex()
         d = self.get_device_from_index(i)
+        if d == None:
+            return
         path, _ = QFileDialog.getOpenFileName()
         path = QDir.toNativeSeparators(path)
         if path:
@@ -886,6 +1536,17 @@ class App(QMainWindow):
         d = self.get_device_from_index(i)
         if d == None:
             return
+        if self.status_bus.recorder != None:
+            self.status_bus.recorder.select(d)
+        self.volume_label.setEnabled(d.online)
+        self.dial.setEnabled(d.online)
+        if not d.online:
+            self.status_label.setText("Listening for '" + d.device.name + "'")
+            self.skip_forward_button.setEnabled(False)
+            self.progress_slider.setEnabled(False)
+            self.play_button.setEnabled(False)
+            self.stop_button.setEnabled(False)
+            return
         if d.playing and not d.paused and not d.live:
             self.set_icon(self.play_button, "SP_MediaPause")
         else:
@@ -896,19 +1557,20 @@ class App(QMainWindow):
         duration = d.get_duration(d.cast.media_controller.status)
         if duration != None:
             self.progress_slider.setMaximum(int(duration))
-        self.set_progress(time_to_seconds(d.time))
+        if d.live:
+            self.clock.set(d, 0, 0.0)
+        self.set_progress(self.clock.position(d))
         if d.live:
             self.play_button.setEnabled(True)
             self.progress_label.setText("LIVE")
-            self.stop_timer.emit(d.index)
-            d.time.setHMS(0, 0, 0)
         else:
-            self.progress_label.setText(d.time.toString("hh:mm:ss"))
+            self.progress_label.setText(self.clock.text(d))
             enabled = not d.rebooting
             self.play_button.setEnabled(enabled)
             self.stop_button.setEnabled(enabled)
         d.set_dial_value(d.cast)
         d.update_text()
+        self.clock.schedule_tick()
 
     def on_skip_click(self):
         i = self.combo_box.currentIndex()
@@ -917,31 +1579,19 @@ class App(QMainWindow):
             return
         duration = d.get_duration(d.cast.media_controller.status)
         if d.filename != None:
-            d.kill_catt_process()
+            d.cancel_cast()
             self.on_stop_click()
             d.playback_starting = False
             self.on_play_next(d)
         if duration:
-            try:
-                d.device.seek(duration - 3)
-            except:
-                pass
+            self.fan_out(d, "seek", lambda m: m.device.seek(duration - 3))
 
     def on_dial_moved(self):
         i = self.combo_box.currentIndex()
         d = self.get_device_from_index(i)
         if d == None:
             return
-        if not self.volume_status_event_pending:
-            self.volume_status_event_pending = True
-            d.device.volume(self.dial.value() / 100)
-            self.volume_event_timer.start(250)
-        elif self.dial.value() == 0:
-            d.device.volume(0.0)
-            self.set_volume_label(0)
-        elif self.dial.value() == 100:
-            d.device.volume(1.0)
-            self.set_volume_label(100)
+        self.set_volume(d, self.dial.value() / 100)
 
     def toggle_mute(self):
         i = self.combo_box.currentIndex()
@@ -949,29 +1599,36 @@ class App(QMainWindow):
         if d == None:
             return
         if d.muted:
-            d.device.volume(d.unmute_volume / 100)
+            v = d.unmute_volume / 100
         else:
             d.unmute_volume = d.cast.status.volume_level * 100
-            d.device.volume(0.0)
+            v = 0.0
+        self.dial.blockSignals(True)
+        self.dial.setValue(round(v * 100))
+        self.dial.blockSignals(False)
+        self.set_volume(d, v)
+
+    def set_volume(self, d, v):
+        # The ui moves right away, the devices follow on the volume pool
+        for m in self.group_members(d):
+            m.muted = v == 0
+            m.volume_channel.set(v)
+        self.set_volume_label(v * 100)
 
     def seek(self, d, value):
         self.status_label.setText("Seeking..")
-        try:
-            d.device.seek(value)
-        except:
-            pass
+        self.fan_out(d, "seek", lambda m: m.device.seek(value))
 
     def on_progress_value_changed(self):
         i = self.combo_box.currentIndex()
         d = self.get_device_from_index(i)
-        if d.progress_clicked:
+        if d == None or d.progress_clicked:
             return
         mc_status = d.cast.media_controller.status
         if mc_status and mc_status.supports_seek:
             v = self.progress_slider.value()
-            self.stop_timer.emit(i)
-            self.set_time(i, v)
-            self.progress_label.setText(d.time.toString("hh:mm:ss"))
+            self.clock.set(d, v, 0.0)
+            self.progress_label.setText(self.clock.text(d))
             duration = d.get_duration(mc_status)
             if duration and v != int(duration):
                 self.seek(d, v)
@@ -983,7 +1640,6 @@ class App(QMainWindow):
         d = self.get_device_from_index(i)
         if d == None:
             return
-        d.progress_timer.stop()
         d.progress_clicked = True
         self.current_progress = self.progress_slider.value()
 
@@ -997,136 +1653,44 @@ class App(QMainWindow):
         mc_status = d.cast.media_controller.status
         if mc_status and mc_status.supports_seek:
             if value > self.current_progress or value < self.current_progress:
-                self.set_time(i, value)
-                self.progress_label.setText(d.time.toString("hh:mm:ss"))
+                self.clock.set(d, value, d.rate)
+                self.progress_label.setText(self.clock.text(d))
                 self.seek(d, value)
         else:
             print("Stream does not support seeking")
 
-    def on_start_timer(self, i):
-        d = self.get_device_from_index(i)
-        if d == None:
-            return
-        d.progress_timer.start(1000)
+    def set_icon(self, button, icon):
+        button.setIcon(self.app.style().standardIcon(getattr(QStyle, icon)))
 
-    def on_stop_timer(self, i):
-        d = self.get_device_from_index(i)
-        if d == None:
-            return
-        d.progress_timer.stop()
+    def device_from_host(self, ip):
+        return self.registry.from_host(ip)
 
-    def set_time(self, i, t):
-        d = self.get_device_from_index(i)
-        if d == None:
-            return
-        h, m, s = d.split_seconds(t)
-        d.time.setHMS(h, m, s)
+    def device_list(self):
+        return list(self.registry)
 
-    def set_icon(self, button, icon):
-        button.setIcon(self.app.style().standardIcon(getattr(QStyle, icon)))
+    def rehost_device(self, d, host):
+        self.registry.rehost(d, host)
 
-    def event_pending_expired(self):
-        self.volume_status_event_pending = False
-
-    def on_add_device(self, ip):
-        name = ""
-        for d in self.device_list:
-            if d.device.ip_addr == ip:
-                last_volume = d.disconnect_volume
-                self.devices.remove(d.device)
-                self.device_list.remove(d)
-                name = d.device.name
-                break
-        chromecasts, browser = pychromecast.get_listed_chromecasts(
-            friendly_names=[name]
-        )
-        d = chromecasts[0]
-        d.wait()
-        browser.stop_discovery()
-        catt_device = CattDevice(name=name)
-        device = Device(self, catt_device, d, self.combo_box.count())
-        d.media_controller.register_status_listener(device.media_listener)
-        d.register_status_listener(device.status_listener)
-        self.devices.append(catt_device)
-        self.device_list.append(device)
-        self.combo_box.addItem(d.name)
-        if self.combo_box.currentIndex() == device.index:
-            self.play_button.setEnabled(True)
-            self.stop_button.setEnabled(True)
-        self.volume_label.setEnabled(True)
-        self.dial.setEnabled(True)
-        device.disconnect_volume = last_volume
-        if self.reconnect_volume == -1:
-            if last_volume != round(device.cast.status.volume_level * 100):
-                device.device.volume(last_volume / 100)
-                if device.index == self.combo_box.currentIndex():
-                    self.set_volume_label(last_volume)
-        else:
-            d.volume(self.reconnect_volume / 100)
-            if device.index == self.combo_box.currentIndex():
-                self.set_volume_label(self.reconnect_volume)
+    def device_online(self, d, level):
+        self.device_model.set_online(d, True)
+        if self.combo_box.currentIndex() == d.index:
+            self.on_index_changed()
+            if level != None:
+                self.set_volume_label(level)
 
-    def on_remove_device(self, ip):
-        d = self.get_device_from_ip(ip)
-        if d == None:
-            return
-        try:
-            d.cast.media_controller._status_listeners.remove(d.media_listener)
-        except:
-            pass
-        try:
-            d.cast.socket_client.receiver_controller._status_listeners.remove(
-                d.status_listener
-            )
-        except:
-            pass
-        self.stop_timer.emit(d.index)
-        d.kill_catt_process()
-        d.time.setHMS(0, 0, 0)
+    def device_offline(self, d):
+        self.clock.set(d, 0, 0.0)
+        self.remove_from_group(d)
         d.playing = False
         d.paused = True
         d.live = False
-        self.combo_box.clear()
-        i = 0
-        j = 0
-        devices_active = False
-        lost_devices = ""
-        for _d in self.device_list:
-            if d == _d or _d.index == -1:
-                _d.media_listener.index = _d.status_listener.index = _d.index = -1
-                if j == len(self.device_list) - 1:
-                    lost_devices = lost_devices + " and "
-                elif j != 0:
-                    lost_devices = lost_devices + ", "
-                lost_devices = lost_devices + "'" + _d.device.name + "'"
-            else:
-                self.combo_box.addItem(_d.device.name)
-                _d.media_listener.index = _d.status_listener.index = _d.index = i
-                if i == 0:
-                    _d.update_text()
-                i = i + 1
-                devices_active = True
-            j = j + 1
-        self.on_index_changed()
-        if not devices_active:
-            self.status_label.setText("Listening for " + lost_devices)
-            self.skip_forward_button.setEnabled(False)
-            self.play_button.setEnabled(False)
-            self.stop_button.setEnabled(False)
-            self.volume_label.setEnabled(False)
-            self.dial.setEnabled(False)
-
-    def get_device_from_ip(self, ip):
-        for d in self.device_list:
-            if d.device.ip_addr == ip:
-                return d
-        return None
+        # Only the row of the lost device changes, the selection stays put
+        self.device_model.set_online(d, False)
+        if self.combo_box.currentIndex() == d.index:
+            self.on_index_changed()
 
     def get_device_from_index(self, i):
-        for d in self.device_list:
-            if d.index == i:
-                return d
-        return None
+        return self.registry.from_index(i)
 
     def set_progress(self, v):
         self.progress_slider.blockSignals(True)
@@ -1137,22 +1701,126 @@ class App(QMainWindow):
         self.volume_label.setText(self.volume_prefix + str(round(v)))
 
 
+class PlaybackClock(QObject):
+    # Positions are worked out from the last status the receiver sent, so
+    # they can not drift. Only the shown device is refreshed, once per
+    # second of playback, and track ends are one shot deadlines
+    def __init__(self, s):
+        super(PlaybackClock, self).__init__(s)
+        self.s = s
+        self.deadlines = []
+        self.sequence = 0
+        self.tick_count = 0
+        self.tick_timer = QTimer(self)
+        self.tick_timer.setSingleShot(True)
+        self.tick_timer.setTimerType(Qt.PreciseTimer)
+        self.tick_timer.timeout.connect(self.tick)
+        self.deadline_timer = QTimer(self)
+        self.deadline_timer.setSingleShot(True)
+        self.deadline_timer.timeout.connect(self.on_deadline)
+
+    def set(self, d, position, rate=1.0, updated=None):
+        position = float(position or 0)
+        rate = float(rate or 0)
+        if updated != None and rate > 0:
+            # The status may have waited in the bus, count from when it came in
+            age = (datetime.now(timezone.utc) - updated).total_seconds()
+            position = position + max(age, 0) * rate
+        d.position = position
+        d.anchor = time.monotonic()
+        d.rate = rate
+        self.set_deadline(d)
+        if d.index == self.s.combo_box.currentIndex():
+            self.schedule_tick()
+
+    def position(self, d):
+        p = d.position + (time.monotonic() - d.anchor) * d.rate
+        if d.duration:
+            p = min(p, d.duration)
+        return max(p, 0)
+
+    def text(self, d):
+        h, m, s = d.split_seconds(int(self.position(d)))
+        return "%02d:%02d:%02d" % (h, m, s)
+
+    def schedule_tick(self):
+        s = self.s
+        d = s.get_device_from_index(s.combo_box.currentIndex())
+        if (
+            d == None
+            or d.rate <= 0
+            or d.live
+            or not s.isVisible()
+            or s.isMinimized()
+        ):
+            self.tick_timer.stop()
+            return
+        # Wake up right after the position crosses the next whole second
+        p = self.position(d)
+        delay = (math.floor(p) + 1 - p) / d.rate
+        self.tick_timer.start(int(delay * 1000) + 1)
+
+    def tick(self):
+        s = self.s
+        d = s.get_device_from_index(s.combo_box.currentIndex())
+        self.tick_count = self.tick_count + 1
+        if d != None and not d.progress_clicked:
+            s.progress_label.setText(self.text(d))
+            s.set_progress(self.position(d))
+        self.schedule_tick()
+
+    def set_deadline(self, d):
+        if d.rate <= 0 or not d.duration or d.live:
+            d.deadline = None
+        else:
+            d.deadline = d.anchor + (d.duration - d.position) / d.rate
+            self.sequence = self.sequence + 1
+            heapq.heappush(self.deadlines, (d.deadline, self.sequence, d))
+        if len(self.deadlines) > 2 * len(self.s.registry) + 16:
+            # Every status moves a deadline, drop the stale entries
+            self.deadlines = [e for e in self.deadlines if e[2].deadline == e[0]]
+            heapq.heapify(self.deadlines)
+        self.schedule_deadline()
+
+    def schedule_deadline(self):
+        while self.deadlines and self.deadlines[0][2].deadline != self.deadlines[0][0]:
+            heapq.heappop(self.deadlines)
+        if not self.deadlines:
+            self.deadline_timer.stop()
+            return
+        delay = self.deadlines[0][0] - time.monotonic()
+        self.deadline_timer.start(max(int(delay * 1000) + 1, 0))
+
+    def on_deadline(self):
+        s = self.s
+        now = time.monotonic()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            end, _, d = heapq.heappop(self.deadlines)
+            if d.deadline != end:
+                continue
+            # The track reached its end without a status saying so
+            d.set_state_idle(d.index)
+            if s.combo_box.currentIndex() == d.index:
+                d.update_ui_idle()
+        self.schedule_deadline()
+
+
 class MediaListener:
+    __slots__ = ("_self", "device")
+
     def new_media_status(self, status):
+        self._self.status_bus.post(self, status)
+
+    def apply(self, status):
         s = self._self
         i = s.combo_box.currentIndex()
-        index = self.index
-        if index == -1:
+        d = self.device
+        index = d.index
+        if not d.online:
             return
         if i != index:
-            d = s.get_device_from_index(index)
-            if d == None:
-                return
             self.handle_media_status(s, d, index, status, False)
             return
-        d = s.get_device_from_index(i)
-        if d == None:
-            return
         s.stopping_timer_cancel.emit(i)
         self.handle_media_status(s, d, i, status, True)
 
@@ -1164,19 +1832,20 @@ class MediaListener:
             and d.playback_just_started == False
             and status.title == None
         ):
-            d.kill_catt_process()
+            d.cancel_cast()
             d.filename = None
             d.directory = None
             d.playback_starting = False
-        if d.catt_process != None and d.catt_process.poll() != None:
-            d.catt_process.wait()
-            d.catt_process = None
+        if d.queue != None and d.queue.advance(status):
+            if i == s.combo_box.currentIndex():
+                s.textbox.setText(os.path.join(d.directory, d.filename))
         if (
             d.filename != None
             and status.idle_reason == "FINISHED"
-            and status.title == os.path.splitext(d.filename)[0]
+            and status.title == d.title
+            and (d.queue == None or not d.queue.waiting())
         ):
-            d.kill_catt_process()
+            d.cancel_cast()
             s.stop_call.emit(d)
             s.play_next.emit(d)
         if d.playback_starting == True and status.title != None:
@@ -1187,9 +1856,18 @@ class MediaListener:
             d.set_state_idle(i)
             if update_ui:
                 d.update_ui_idle()
+        if status.player_state in ("PLAYING", "PAUSED"):
+            d.duration = d.get_duration(status)
         if status.player_state == "PLAYING":
+            if d.play_requested != None:
+                s.metrics.play_to_playing.labels(device=d.device.name).observe(
+                    time.perf_counter() - d.play_requested
+                )
+                d.play_requested = None
             d.live = status.stream_type == "LIVE"
-            d.set_state_playing(i, status.current_time)
+            d.set_state_playing(
+                i, status.current_time, status.playback_rate, status.last_updated
+            )
             if update_ui:
                 duration = d.get_duration(status)
                 d.update_ui_playing(status.current_time, duration)
@@ -1205,36 +1883,31 @@ class MediaListener:
 
 
 class StatusListener:
+    __slots__ = ("_self", "device")
+
     def new_cast_status(self, status):
+        self._self.status_bus.post(self, status)
+
+    def apply(self, status):
         s = self._self
         i = s.combo_box.currentIndex()
-        index = self.index
-        if index == -1:
+        d = self.device
+        index = d.index
+        if not d.online:
             return
         v = round(status.volume_level * 100)
-        if i != index:
-            d = s.get_device_from_index(index)
-            if d == None:
-                return
-            d.disconnect_volume = v
-            self.update_playback_starting_status(d, status)
-            return
-        d = s.get_device_from_index(i)
-        if d == None:
-            return
         d.disconnect_volume = v
         self.update_playback_starting_status(d, status)
+        if not d.volume_channel.reconcile(status.volume_level):
+            # An echo of a level on the way to the one the user picked,
+            # the optimistic ui already shows where it ends up
+            return
         if d.muted and v != 0:
             d.muted = False
         elif not d.muted and v == 0:
             d.muted = True
-        if not s.volume_status_event_pending:
+        if i == index:
             d.set_dial_value(d.cast)
-        else:
-            s.set_volume_label(v)
-            if v > 0:
-                d.muted = False
-            s.volume_status_event_pending = False
 
     def update_playback_starting_status(self, d, status):
         if (
@@ -1253,25 +1926,74 @@ class StatusListener:
             d.playback_starting = False
 
 
-class ConnectionListener:
-    def new_connection_status(self, status):
-        s = self._self
-        if status.status == "CONNECTED":
-            print(status.address.address, "connected")
-            s.add_device.emit(status.address.address)
-        elif status.status == "LOST":
-            print(status.address.address, "disconnected")
-            s.remove_device.emit(status.address.address)
+author = __author__
+email = __email__
+version = __version__
+
+
+def main(args=None) -> None:
+    if args == None:
+        args = parse_args(sys.argv[1:])
+    if args.headless:
+        from cattqt import daemon
+
+        daemon.main(args)
+    if args.benchmark_connections:
+        from cattqt.benchmark import run_connection_benchmark
+
+        sys.exit(run_connection_benchmark())
+    if args.benchmark_reconnect:
+        from cattqt.benchmark import run_reconnect_benchmark
+
+        sys.exit(run_reconnect_benchmark())
+    if args.benchmark_device_cache:
+        from cattqt.benchmark import run_device_cache_benchmark
+
+        sys.exit(run_device_cache_benchmark(devices=args.benchmark_devices))
+    if args.benchmark_headless:
+        from cattqt.benchmark import run_headless_benchmark
+
+        sys.exit(run_headless_benchmark())
+    if args.benchmark_gaps:
+        from cattqt.benchmark import run_gap_benchmark
+
+        sys.exit(run_gap_benchmark())
+    if args.benchmark_playlist:
+        from cattqt.benchmark import run_playlist_benchmark
+
+        sys.exit(run_playlist_benchmark())
+    if args.benchmark_server:
+        from cattqt.benchmark import run_server_benchmark
+
+        sys.exit(run_server_benchmark())
+    if args.benchmark_registry:
+        from cattqt.benchmark import run_registry_benchmark
+
+        sys.exit(run_registry_benchmark())
+    if args.benchmark_status_bus:
+        from cattqt.benchmark import run_status_bus_benchmark
+
+        sys.exit(run_status_bus_benchmark())
+    if args.benchmark_e2e:
+        from cattqt.benchmark import run_e2e_benchmark
 
+        counts = [int(n) for n in args.benchmark_e2e.split(",")]
+        sys.exit(run_e2e_benchmark(counts))
+    if args.replay_statuses:
+        from cattqt.benchmark import run_replay
 
-author = "Scott Moreau"
-email = "oreaus@gmail.com"
-version = "5.1"
+        sys.exit(run_replay(args.replay_statuses, args.replay_speed))
+    if args.check_import_budget:
+        from cattqt.benchmark import check_import_budget
 
+        sys.exit(check_import_budget())
+    if args.benchmark_startup:
+        from cattqt.benchmark import run_startup_benchmark
 
-def main() -> None:
+        sys.exit(run_startup_benchmark(args.benchmark_startup, args.benchmark_devices))
     app = QApplication(sys.argv)
-    ex = App(app, version)
+    startup_timer.mark("qt initialized")
+    ex = App(app, version, args)
     sys.exit(app.exec_())
 
 
@@ -0,0 +1,1367 @@
+# Copyright 2020 - Scott Moreau
+
+# Everything that talks to devices without needing a widget, shared by
+# the gui and the headless daemon
+
+import os
+import time
+import copy
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from PyQt5.QtCore import QObject, QTimer, QThread, pyqtSignal
+
+
+class StartupTimer:
+    def __init__(self, start):
+        self.start = start
+        self.phases = []
+        self.devices = {}
+
+    def mark(self, name):
+        for phase, t in self.phases:
+            if phase == name:
+                return
+        self.phases.append((name, time.perf_counter() - self.start))
+
+    def device(self, name, seconds):
+        # Called from connect threads, a plain dict store is atomic
+        self.devices[name] = seconds
+
+    def report(self):
+        return {"phases": self.phases, "devices": self.devices}
+
+    def print_report(self):
+        for phase, t in self.phases:
+            print("%-24s %8.3fs" % (phase, t))
+        for name, t in sorted(self.devices.items(), key=lambda x: x[1]):
+            print("  %-22s %8.3fs connect" % (name, t))
+
+
+class DiscoveryService(QObject):
+    device_added = pyqtSignal(object)
+    device_updated = pyqtSignal(object)
+    device_removed = pyqtSignal(object)
+
+    def __init__(self, parent=None, known_hosts=None):
+        super(DiscoveryService, self).__init__(parent)
+        self.browser = None
+        self.browses = 0
+        # Polled directly as well, for networks that filter multicast
+        self.known_hosts = known_hosts or None
+
+    def start(self):
+        import zeroconf
+        import pychromecast
+
+        self.browses = self.browses + 1
+        # The browser keeps running for the lifetime of the app, its callbacks
+        # arrive on zeroconf threads and are queued to the gui thread as signals
+        listener = pychromecast.discovery.SimpleCastListener(
+            lambda uuid, service: self.device_added.emit(uuid),
+            lambda uuid, service, cast_info: self.device_removed.emit(uuid),
+            lambda uuid, service: self.device_updated.emit(uuid),
+        )
+        self.browser = pychromecast.discovery.CastBrowser(
+            listener, zeroconf.Zeroconf(), self.known_hosts
+        )
+        self.browser.start_discovery()
+
+    def stop(self):
+        if self.browser != None:
+            self.browser.stop_discovery()
+            self.browser = None
+
+    def get_cast_info(self, uuid):
+        if self.browser == None:
+            return None
+        return self.browser.devices.get(uuid)
+
+    def get_chromecast(self, cast_info, tries=None, timeout=None):
+        import pychromecast
+
+        return pychromecast.get_chromecast_from_cast_info(
+            cast_info, self.browser.zc, tries=tries, timeout=timeout
+        )
+
+    def wind_down(self, cast, timeout):
+        # A connection that never came up ends its socket thread without
+        # closing the socket of its last attempt, its wakeup sockets and
+        # selector, they are closed here once the thread is gone. Blocks,
+        # so never on the gui thread
+        client = cast.socket_client
+        client.join(timeout)
+        if not client.is_alive():
+            if client.socket != None:
+                client.socket.close()
+            client.socketpair[0].close()
+            client.socketpair[1].close()
+            client.selector.close()
+
+
+def open_probe(s):
+    # Benchmarks start the app with --probe, a JSON object naming the
+    # stand-in devices to use and what to measure once startup completes.
+    # Their code is not even imported otherwise
+    if s.args.probe == None:
+        return None
+    import json
+    from cattqt.benchmark import Probe
+
+    return Probe(s, json.loads(s.args.probe))
+
+
+def open_discovery(s):
+    if s.probe != None and s.probe.discovery != None:
+        return s.probe.discovery
+    from cattqt.devicecache import known_hosts
+
+    return DiscoveryService(s, known_hosts(s.args))
+
+
+def hang_up(cast):
+    # pychromecast raises from disconnect(timeout=0) whenever its socket
+    # thread has not stopped yet, which it never has right away
+    try:
+        cast.disconnect(timeout=0)
+    except TimeoutError:
+        pass
+
+
+class ConnectionPool:
+    # One pychromecast connection per device uuid, shared by the status
+    # listeners and the catt control path. pychromecast reconnects it in
+    # place, so a device that drops never has to be discovered again
+    def __init__(self, discovery):
+        self.discovery = discovery
+        self.lock = threading.Lock()
+        self.casts = {}
+        self.opened = 0
+
+    def acquire(self, cast_info):
+        with self.lock:
+            cast = self.casts.get(cast_info.uuid)
+            if cast != None:
+                return cast
+        cast = self.discovery.get_chromecast(cast_info)
+        with self.lock:
+            self.casts[cast_info.uuid] = cast
+            self.opened = self.opened + 1
+        return cast
+
+    def get(self, uuid):
+        with self.lock:
+            return self.casts.get(uuid)
+
+    def adopt(self, cast_info, timeout):
+        # Dials a cached address once and pools the connection if it answered
+        cast = self.dial(cast_info, timeout)
+        if cast == None:
+            return None
+        with self.lock:
+            self.casts[cast_info.uuid] = cast
+            self.opened = self.opened + 1
+        return cast
+
+    def dial(self, cast_info, timeout):
+        # A single attempt, returns the connected cast or None
+        probe = DialProbe()
+        cast = self.discovery.get_chromecast(cast_info, tries=1, timeout=timeout)
+        cast.register_connection_listener(probe)
+        cast.register_status_listener(probe)
+        cast.start()
+        if not probe.done.wait(timeout) or cast.status == None:
+            hang_up(cast)
+            self.discovery.wind_down(cast, timeout)
+            return None
+        return cast
+
+    def swap(self, uuid, old, cast):
+        # Only replaces the connection the dial was started for, one that
+        # was released or replaced meanwhile is left alone
+        with self.lock:
+            if self.casts.get(uuid) is not old:
+                swapped = False
+            else:
+                self.casts[uuid] = cast
+                self.opened = self.opened + 1
+                swapped = True
+        hang_up(old if swapped else cast)
+        return swapped
+
+    def release(self, uuid):
+        with self.lock:
+            cast = self.casts.pop(uuid, None)
+        if cast != None:
+            hang_up(cast)
+        return cast
+
+    def close(self):
+        with self.lock:
+            casts = list(self.casts.values())
+            self.casts = {}
+        for cast in casts:
+            hang_up(cast)
+
+
+class ConnectThread(QThread):
+    def __init__(self, s, cast_info, direct=False):
+        super(ConnectThread, self).__init__(s)
+        self.s = s
+        self.cast_info = cast_info
+        self.direct = direct
+
+    def run(self):
+        start = time.perf_counter()
+        try:
+            if self.direct:
+                # One attempt on the cached address, discovery takes over
+                # when it does not answer
+                cast = self.s.connections.adopt(self.cast_info, self.s.dial_timeout)
+                if cast == None:
+                    raise ConnectionError("no answer from " + self.cast_info.host)
+            else:
+                cast = self.s.connections.acquire(self.cast_info)
+                cast.wait(timeout=self.s.connect_timeout)
+            # Load catt off the gui thread, the CattDevice for this cast
+            # is built on the gui thread once the connection is handed over
+            import catt.api
+        except Exception as e:
+            print(self.cast_info.friendly_name, "failed to connect:", e)
+            cast = self.s.connections.release(self.cast_info.uuid)
+            self.s.device_failed.emit(self.cast_info)
+            if cast != None:
+                self.s.discovery.wind_down(cast, self.s.connect_timeout)
+            return
+        self.s.startup_timer.device(
+            self.cast_info.friendly_name, time.perf_counter() - start
+        )
+        self.s.device_connected.emit(cast)
+
+
+class DialProbe:
+    # Wakes the dialer on the first status, or as soon as the one attempt
+    # failed rather than once the timeout ran out
+    __slots__ = ("done",)
+
+    def __init__(self):
+        self.done = threading.Event()
+
+    def new_cast_status(self, status):
+        self.done.set()
+
+    def new_connection_status(self, status):
+        if status.status in ("FAILED", "DISCONNECTED"):
+            self.done.set()
+
+
+class Reconnect:
+    # Dials the host and port a lost device last had, without waiting on
+    # mDNS, and backs off from delay up to limit seconds between attempts.
+    # Discovery is only asked after a direct dial failed, in case the
+    # device came back on another address. pychromecast keeps reconnecting
+    # the old connection in place meanwhile, whichever is first wins
+    def __init__(self, s, d, delay=0.5, limit=30.0):
+        self.s = s
+        self.d = d
+        self.cast = d.cast
+        self.delay = delay
+        self.limit = limit
+        self.lost_at = time.perf_counter()
+        self.attempts = 0
+        self.failures = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        from dataclasses import replace
+        from pychromecast.models import HostServiceInfo
+
+        s = self.s
+        info = self.cast.cast_info
+        direct = replace(info, services={HostServiceInfo(info.host, info.port)})
+        delay = self.delay
+        while not self.stopped.wait(delay):
+            path = "direct"
+            cast = self.dial(direct)
+            if cast == None:
+                found = s.discovery.get_cast_info(info.uuid)
+                if found != None and (found.host, found.port) != (
+                    info.host,
+                    info.port,
+                ):
+                    path = "discovery"
+                    cast = self.dial(found)
+            if cast != None:
+                if self.stopped.is_set():
+                    hang_up(cast)
+                elif s.connections.swap(info.uuid, self.cast, cast):
+                    s.device_redialed.emit(self.d, cast, path)
+                return
+            delay = min(delay * 2, self.limit)
+
+    def dial(self, cast_info):
+        self.attempts = self.attempts + 1
+        try:
+            cast = self.s.connections.dial(cast_info, self.s.dial_timeout)
+        except Exception as e:
+            print(cast_info.friendly_name, "failed to dial:", e)
+            cast = None
+        if cast == None:
+            self.failures = self.failures + 1
+        return cast
+
+
+def catt_device_from_cast(cast):
+    # Hand the already connected cast to catt instead of letting it
+    # discover the device by name again
+    from catt.api import CattDevice
+
+    catt_device = CattDevice(name=cast.cast_info.friendly_name, lazy=True)
+    catt_device._cast = cast
+    catt_device.ip_addr = cast.cast_info.host
+    catt_device.uuid = cast.cast_info.uuid
+    return catt_device
+
+
+class CastThread(QThread):
+    def __init__(self, s, devices, text, urls=None, title=None):
+        super(CastThread, self).__init__(s)
+        self.s = s
+        self.devices = devices
+        self.text = text
+        self.urls = urls or {}
+        self.title = title
+        self.canceled = False
+        self.playlist_lock = threading.Lock()
+        self.started = None
+        self.subtitles = None
+        self.converted = None
+
+    def run(self):
+        from catt.stream_info import StreamInfo
+
+        self.started = time.perf_counter()
+        try:
+            # Resolve the media once, every device loads the same stream
+            stream = StreamInfo(self.text, cast_info=self.devices[0].cast.cast_info)
+        except Exception as e:
+            for d in self.devices:
+                self.fail(d, e)
+            return
+        if stream.is_local_file:
+            self.serve_subtitles()
+            if self.canceled:
+                # Canceled before there was anything to clean up
+                self.cancel()
+                return
+        if len(self.devices) == 1:
+            self.load(self.devices[0], stream)
+            return
+        with ThreadPoolExecutor(len(self.devices)) as pool:
+            for d in self.devices:
+                pool.submit(self.load, d, stream)
+
+    def serve_subtitles(self):
+        # Like catt cast, subtitles next to a local file go along with it,
+        # served by the same server as the file itself
+        from catt.util import hunt_subtitles
+        from catt.subs_info import SubsInfo
+
+        path = hunt_subtitles(self.text)
+        if path == None or self.s.media_server == None:
+            return
+        try:
+            subs = SubsInfo(path, None, 0)
+        except Exception as e:
+            print("Failed to read subtitles", path + ":", e)
+            return
+        if subs.file != path:
+            # SubRip converted to WebVTT in a temporary file
+            self.converted = subs.file
+        content_type = subs.mimetype
+        if subs.file.endswith(".vtt"):
+            content_type = "text/vtt"
+        self.subtitles = self.s.media_server.add_file(subs.file, content_type)
+
+    def subtitles_url(self, d):
+        from catt.util import get_local_ip
+
+        if self.subtitles == None:
+            return None
+        host = get_local_ip(d.cast.cast_info.host)
+        return self.s.media_server.url(self.subtitles, host)
+
+    def load(self, d, stream):
+        from catt.controllers import get_app, get_controller
+
+        cast = d.cast
+        # A stop queued for the previous media must not land on this one
+        d.commands.wait_idle(d.commands.timeout)
+        try:
+            if stream.is_local_file:
+                app = get_app("default")
+            else:
+                app = get_app(stream.extractor, cast.cast_type)
+            controller = get_controller(cast, app, prep="app")
+            if self.canceled:
+                return
+            if stream.is_playlist:
+                if stream.playlist_length == 0:
+                    raise Exception("Playlist is empty")
+                if controller.playlist_capability and stream.playlist_all_ids:
+                    video_id = stream.video_id or stream.playlist_all_ids[0]
+                    controller.play_playlist(stream.playlist_id, video_id=video_id)
+                    self.wait_for_playing(d, controller)
+                    return
+                with self.playlist_lock:
+                    if not stream.is_playlist_with_active_entry:
+                        stream.set_playlist_entry(0)
+            if controller.info_type == "id":
+                controller.play_media_id(stream.video_id)
+            else:
+                controller.play_media_url(
+                    self.urls.get(d) or stream.video_url,
+                    title=self.title or stream.video_title,
+                    content_type=stream.guessed_content_type,
+                    thumb=stream.video_thumbnail,
+                    subtitles=self.subtitles_url(d),
+                    stream_type=getattr(stream, "stream_type", None),
+                    media_info=getattr(stream, "media_info", None),
+                )
+            self.wait_for_playing(d, controller)
+        except Exception as e:
+            self.fail(d, e)
+
+    def fail(self, d, e):
+        if not self.canceled:
+            print(d.device.name, "failed to play", self.text + ":", e)
+            self.s.cast_failed.emit(d, str(e))
+
+    def wait_for_playing(self, d, controller):
+        if self.canceled:
+            return
+        if not controller.wait_for(["PLAYING"], timeout=10):
+            raise Exception("Playback failed")
+        if not self.canceled:
+            self.s.metrics.cast_load.labels(device=d.device.name).observe(
+                time.perf_counter() - self.started
+            )
+            self.s.cast_started.emit(d)
+
+    def cancel(self):
+        self.canceled = True
+        if self.subtitles != None:
+            self.s.media_server.remove_file(self.subtitles)
+            self.subtitles = None
+        if self.converted != None:
+            try:
+                os.unlink(self.converted)
+            except OSError:
+                pass
+            self.converted = None
+
+
+class CommandWatchdog:
+    # One thread gives up on the commands of every device that run past
+    # their timeout, instead of a thread per command
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.queues = set()
+        self.thread = None
+
+    def watch(self, queue):
+        with self.lock:
+            self.queues.add(queue)
+            if self.thread == None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            now = time.monotonic()
+            with self.lock:
+                for queue in list(self.queues):
+                    if not queue.check(now):
+                        self.queues.discard(queue)
+                if not self.queues:
+                    self.thread = None
+                    return
+
+
+command_watchdog = CommandWatchdog()
+
+
+class CommandQueue:
+    # Device commands run in order on the command pool, never on the gui
+    # thread. A command still waiting is dropped when one that supersedes
+    # it comes in, so 30 slider seeks end up as a single seek. A command
+    # that runs past its timeout fails, the device is stuck until it
+    # returns and everything sent to it meanwhile is dropped, so nothing
+    # ever runs alongside the hung call or overtakes it
+    supersedes = {
+        "play": {"play", "pause"},
+        "pause": {"play", "pause"},
+        "stop": {"play", "pause", "seek", "stop"},
+        "reboot": {"play", "pause", "seek", "stop", "reboot"},
+    }
+
+    def __init__(self, d, pool, timeout=15):
+        self.d = d
+        self.pool = pool
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.pending = deque()
+        self.busy = False
+        self.dropped = 0
+        # (kind, future, deadline) of the command running now
+        self.running = None
+        self.stuck = False
+
+    def submit(self, kind, action, timeout=None):
+        # The future resolves to None or the error once the command ran,
+        # it is cancelled when the command is dropped
+        future = Future()
+        with self.lock:
+            stuck = self.stuck
+            if not stuck:
+                drop = self.supersedes.get(kind, {kind})
+                kept = deque(c for c in self.pending if c[0] not in drop)
+                dropped = [c for c in self.pending if c[0] in drop]
+                self.dropped = self.dropped + len(dropped)
+                kept.append((kind, action, timeout or self.timeout, future))
+                self.pending = kept
+                busy = self.busy
+                self.busy = True
+        if stuck:
+            self.fail(kind, future, "not responding")
+            return future
+        for c in dropped:
+            c[3].cancel()
+        if not busy:
+            self.pool.submit(self.run)
+        return future
+
+    def fail(self, kind, future, error):
+        self.d._self.command_failed.emit(self.d, kind, error)
+        future.set_result(error)
+
+    def run(self):
+        s = self.d._self
+        while True:
+            with self.lock:
+                if not self.pending:
+                    self.busy = False
+                    self.idle.notify_all()
+                    return
+                kind, action, timeout, future = self.pending.popleft()
+                self.running = (kind, future, time.monotonic() + timeout)
+            command_watchdog.watch(self)
+            start = time.perf_counter()
+            try:
+                action()
+                error = None
+            except Exception as e:
+                error = str(e) or type(e).__name__
+            with self.lock:
+                self.running = None
+                late = self.stuck
+                self.stuck = False
+            if late:
+                # Already failed by the watchdog, the device answers again
+                print(
+                    self.d.device.name,
+                    kind,
+                    "returned after %.1fs" % (time.perf_counter() - start),
+                )
+            elif error == None:
+                s.command_done.emit(self.d, kind, time.perf_counter() - start)
+                future.set_result(None)
+            else:
+                self.fail(kind, future, error)
+
+    def check(self, now):
+        # Called by the watchdog, False once nothing is running
+        with self.lock:
+            if self.running == None:
+                return False
+            kind, future, deadline = self.running
+            if self.stuck or now < deadline:
+                return True
+            self.stuck = True
+            dropped = list(self.pending)
+            self.pending.clear()
+            self.dropped = self.dropped + len(dropped)
+        self.fail(kind, future, "timed out")
+        for c in dropped:
+            c[3].cancel()
+        return True
+
+    def wait_idle(self, timeout=None):
+        with self.idle:
+            return self.idle.wait_for(lambda: not self.busy, timeout)
+
+    def cancel(self):
+        with self.lock:
+            dropped = list(self.pending)
+            self.pending.clear()
+        for c in dropped:
+            c[3].cancel()
+
+
+class VolumeChannel:
+    # The last level the user picked always reaches the device, with at
+    # most one request in flight. Levels picked meanwhile replace each
+    # other and only the latest is sent once the device answered
+    def __init__(self, d, pool):
+        self.d = d
+        self.pool = pool
+        self.lock = threading.Lock()
+        self.target = None
+        self.sent = None
+        self.busy = False
+        self.done_at = 0.0
+        # (level, future) of callers waiting for their level to be sent
+        self.waiters = []
+
+    def set(self, level):
+        # The future resolves to None once level is set, to an error or is
+        # cancelled when a later level replaced it before it was sent
+        future = Future()
+        with self.lock:
+            # A level already on its way resolves once the device answered
+            keep = (level, self.sent) if self.busy else (level,)
+            superseded = [f for l, f in self.waiters if l not in keep]
+            self.waiters = [(l, f) for l, f in self.waiters if l in keep]
+            self.waiters.append((level, future))
+            self.target = level
+            busy = self.busy
+            self.busy = True
+        for f in superseded:
+            f.cancel()
+        if not busy:
+            self.pool.submit(self.run)
+        return future
+
+    def resolve(self, level, error=None):
+        # Called with the lock held, returns what to resolve outside it
+        if error != None:
+            done, self.waiters = self.waiters, []
+        else:
+            done = [(l, f) for l, f in self.waiters if l == level]
+            self.waiters = [(l, f) for l, f in self.waiters if l != level]
+        return [(f, error) for l, f in done]
+
+    def run(self):
+        while True:
+            with self.lock:
+                level = self.target
+                if level == None or level == self.sent:
+                    self.busy = False
+                    self.done_at = time.monotonic()
+                    done = self.resolve(level)
+                    break
+                self.sent = level
+            start = time.perf_counter()
+            try:
+                self.d.device.volume(level)
+            except Exception as e:
+                print(self.d.device.name, "failed to set volume:", e)
+                self.d._self.metrics.command_failures.labels(
+                    device=self.d.device.name, command="volume"
+                ).inc()
+                with self.lock:
+                    self.sent = None
+                    self.busy = False
+                    self.done_at = time.monotonic()
+                    done = self.resolve(level, str(e) or type(e).__name__)
+                break
+            self.d._self.command_done.emit(
+                self.d, "volume", time.perf_counter() - start
+            )
+            with self.lock:
+                done = self.resolve(level)
+            self.notify(done)
+        self.notify(done)
+
+    def notify(self, done):
+        for future, error in done:
+            future.set_result(error)
+
+    def reconcile(self, level):
+        # True once a status echo can be trusted again for the dial
+        with self.lock:
+            if self.busy:
+                return False
+            if (
+                self.target != None
+                and abs(level - self.target) >= 0.01
+                and time.monotonic() - self.done_at < 1.0
+            ):
+                return False
+            self.target = None
+            self.sent = None
+            return True
+
+
+class DirectoryQueue:
+    # The next files of the directory wait in the receiver's own media
+    # queue, so it moves on to the next track without a round trip to us.
+    # The window is topped up each time the receiver starts a queued item
+    def __init__(self, s, d, window=2):
+        self.s = s
+        self.d = d
+        self.window = window
+        self.items = []
+        self.pool = ThreadPoolExecutor(1)
+        self.fallback_timer = QTimer()
+        self.fallback_timer.setSingleShot(True)
+        self.fallback_timer.timeout.connect(self.on_stalled)
+
+    def start(self):
+        d = self.d
+        # The playing file's token now lives and dies with the queue
+        self.items = [(d.filename, None, d.media_token, d.title)]
+        d.media_token = None
+        self.fill()
+
+    def fill(self):
+        from catt.util import get_local_ip
+
+        s = self.s
+        d = self.d
+        server = s.get_media_server()
+        host = get_local_ip(d.cast.cast_info.host)
+        while len(self.items) <= self.window:
+            name = s.next_playable(d.directory, self.items[-1][0])
+            if name == None:
+                break
+            path = os.path.join(d.directory, name)
+            token = server.add_file(path)
+            url = server.url(token, host)
+            title = s.local_title(path)
+            self.items.append((name, url, token, title))
+            self.pool.submit(self.insert, url, path, title)
+        s.prefetch_metadata(d.directory, self.items[-1][0])
+
+    def insert(self, url, path, title):
+        from catt.util import guess_mime
+
+        try:
+            self.d.cast.media_controller.play_media(
+                url,
+                guess_mime(path),
+                title=title,
+                stream_type="BUFFERED",
+                enqueue=True,
+            )
+        except Exception as e:
+            # The track end falls back to loading the next file
+            print(self.d.device.name, "failed to queue", path + ":", e)
+
+    def advance(self, status):
+        for i in range(1, len(self.items)):
+            if self.items[i][1] == status.content_id:
+                break
+        else:
+            return False
+        self.fallback_timer.stop()
+        for name, url, token, title in self.items[:i]:
+            if token != None:
+                self.s.media_server.remove_file(token)
+        self.items = self.items[i:]
+        self.d.filename = self.items[0][0]
+        self.d.title = self.items[0][3]
+        self.fill()
+        return True
+
+    def waiting(self):
+        # A finished track is fine while the next one is queued, unless
+        # the receiver never gets to it
+        if len(self.items) < 2:
+            return False
+        if not self.fallback_timer.isActive():
+            self.fallback_timer.start(5000)
+        return True
+
+    def on_stalled(self):
+        s = self.s
+        d = self.d
+        print(d.device.name, "did not start the queued track")
+        d.cancel_cast()
+        s.stop_call.emit(d)
+        s.play_next.emit(d)
+
+    def cancel(self):
+        self.fallback_timer.stop()
+        self.pool.shutdown(wait=False)
+        for name, url, token, title in self.items:
+            if token != None:
+                self.s.media_server.remove_file(token)
+        self.items = []
+
+
+class MediaLibrary:
+    # Local files, their directory playlists and probed metadata, each
+    # started the first time it is needed
+    media_server = None
+    playlists = None
+    metadata = None
+
+    def get_media_server(self):
+        # One server hands out every local file to every device
+        if self.media_server == None:
+            from cattqt.server import MediaServer
+
+            self.media_server = MediaServer()
+            self.media_server.start()
+        return self.media_server
+
+    def get_metadata(self):
+        if self.metadata == None:
+            from cattqt.metadata import MetadataCache
+
+            self.metadata = MetadataCache()
+        return self.metadata
+
+    def prefetch_metadata(self, directory, name, count=4):
+        # Runs on a worker thread once the playlist is listed
+        if self.metadata == None or self.playlists == None:
+            return
+        names = self.playlists.following(directory, name, count)
+        self.metadata.prefetch([os.path.join(directory, n) for n in names])
+
+    def local_title(self, path):
+        m = self.metadata.lookup(path) if self.metadata != None else None
+        if m != None and m.title:
+            return m.title
+        return os.path.splitext(os.path.basename(path))[0]
+
+    def next_playable(self, directory, name):
+        # Files the probe found the receiver can not decode are skipped
+        # instead of waiting out the starting timer
+        playlists = self.get_playlists()
+        metadata = self.get_metadata()
+        while True:
+            name = playlists.next(directory, name)
+            if name == None:
+                return None
+            m = metadata.lookup(os.path.join(directory, name))
+            if m == None or m.playable != False:
+                return name
+            print("Skipping", name + ", the receiver can not decode it")
+
+    def get_playlists(self):
+        if self.playlists == None:
+            from cattqt.playlist import PlaylistIndex
+
+            self.playlists = PlaylistIndex()
+        return self.playlists
+
+    def close_library(self):
+        if self.media_server != None:
+            self.media_server.stop()
+        if self.playlists != None:
+            self.playlists.close()
+        if self.metadata != None:
+            self.metadata.close()
+
+
+class DeviceLifecycle(MediaLibrary):
+    # Connecting, losing and redialing devices and starting casts, shared
+    # by the gui and the daemon. Each keeps its devices its own way and
+    # fills in create_device, device_from_host, device_list, rehost_device,
+    # device_added, device_unreachable, connections_settled, device_online,
+    # device_offline and cast_not_started
+
+    def connect_device(self, cast_info, direct=False):
+        self.connecting_uuids.add(cast_info.uuid)
+        thread = ConnectThread(self, cast_info, direct)
+        thread.finished.connect(lambda: self.connect_threads.remove(thread))
+        self.connect_threads.append(thread)
+        thread.start()
+
+    def save_device_cache(self):
+        if self.device_cache == None:
+            return
+        for d in self.device_list():
+            self.device_cache.remember(d.cast.cast_info, d.disconnect_volume)
+        self.device_cache.save()
+
+    def on_device_discovered(self, uuid):
+        cast_info = self.discovery.get_cast_info(uuid)
+        if cast_info == None:
+            return
+        if self.device_cache != None:
+            self.device_cache.correct(cast_info)
+        if uuid in self.connecting_uuids or uuid in self.connected_uuids:
+            return
+        self.startup_timer.mark("first device found")
+        print("Found", cast_info.friendly_name)
+        self.connect_device(cast_info)
+
+    def on_device_vanished(self, uuid):
+        # Connected devices are torn down by their ConnectionListener,
+        # forgetting the uuid lets a later announcement connect again
+        self.connecting_uuids.discard(uuid)
+
+    def on_device_connected(self, cast):
+        self.startup_timer.mark("first device connected")
+        self.connecting_uuids.discard(cast.uuid)
+        self.connected_uuids.add(cast.uuid)
+        d = self.create_device(catt_device_from_cast(cast), cast)
+        cast.media_controller.register_status_listener(d.media_listener)
+        cast.register_status_listener(d.status_listener)
+        cast.register_connection_listener(d.connection_listener)
+        if cast.status != None:
+            d.disconnect_volume = round(cast.status.volume_level * 100)
+        self.device_added(d)
+        print(cast.name)
+        if not self.connecting_uuids:
+            self.connections_settled()
+
+    def on_device_failed(self, cast_info):
+        self.connecting_uuids.discard(cast_info.uuid)
+        found = self.discovery.get_cast_info(cast_info.uuid)
+        if found != None and found is not cast_info:
+            # The cached address did not answer but discovery knows the device
+            self.connect_device(found)
+            return
+        self.device_unreachable(cast_info)
+
+    def on_add_device(self, ip):
+        d = self.device_from_host(ip)
+        if d == None:
+            return
+        # pychromecast brought the pooled connection back in place, the
+        # device only has to come back online
+        self.set_device_online(d, "in place")
+
+    def on_device_redialed(self, d, cast, path):
+        # The pool already swapped the connection, the listeners follow it
+        cast.media_controller.register_status_listener(d.media_listener)
+        cast.register_status_listener(d.status_listener)
+        cast.register_connection_listener(d.connection_listener)
+        d.cast = cast
+        d.device._cast = cast
+        self.rehost_device(d, cast.cast_info.host)
+        self.set_device_online(d, path)
+
+    def set_device_online(self, d, path):
+        reconnect = d.reconnect
+        if reconnect != None:
+            reconnect.stop()
+            d.reconnect = None
+            self.metrics.record_reconnect(reconnect, path)
+        if d.online:
+            return
+        # Back to the volume asked for, or the one it had when it was lost
+        level = None
+        if self.reconnect_volume != -1:
+            level = self.reconnect_volume
+        elif d.cast.status != None and d.disconnect_volume != round(
+            d.cast.status.volume_level * 100
+        ):
+            level = d.disconnect_volume
+        self.device_online(d, level)
+        if level != None:
+            d.volume_channel.set(level / 100)
+
+    def on_remove_device(self, ip):
+        d = self.device_from_host(ip)
+        if d == None:
+            return
+        # The listeners stay registered, statuses of an offline device
+        # are ignored until the connection is back
+        if d.reconnect == None:
+            d.reconnect = Reconnect(self, d)
+            d.reconnect.start()
+        d.commands.cancel()
+        d.cancel_cast()
+        self.device_offline(d)
+
+    def on_command_done(self, d, kind, seconds):
+        self.metrics.commands.labels(device=d.device.name, command=kind).observe(
+            seconds
+        )
+
+    def serve_local(self, devices, text):
+        # Probes the file and lists its directory while the cast starts,
+        # returns the probe, the file's token and a url per device
+        from catt.util import get_local_ip
+
+        directory, filename = os.path.dirname(text), os.path.basename(text)
+        probe = self.get_metadata().probe(text)
+        # The listing is ready by the end of the track, what comes next
+        # is probed while this file plays
+        self.get_playlists().prepare(directory).add_done_callback(
+            lambda f: self.prefetch_metadata(directory, filename)
+        )
+        server = self.get_media_server()
+        token = server.add_file(text)
+        urls = {}
+        for d in devices:
+            urls[d] = server.url(token, get_local_ip(d.cast.cast_info.host))
+        return probe, token, urls
+
+    def start_cast(self, devices, text, urls, title):
+        requested = time.perf_counter()
+        thread = CastThread(self, devices, text, urls, title)
+        for d in devices:
+            d.play_requested = requested
+            d.cast_thread = thread
+        thread.start()
+
+    def skip_unplayable(self, d):
+        # Directory playback moves past files the receiver could not load
+        d.cancel_cast()
+        d.playback_starting = False
+        self.stop_call.emit(d)
+        self.on_play_next(d)
+
+    def on_cast_failed(self, d, error):
+        d.cast_thread = None
+        d.play_requested = None
+        skipping = d.filename != None and d.playback_starting
+        self.cast_not_started(d, error, skipping)
+        if skipping:
+            self.skip_unplayable(d)
+
+
+class ConnectionListener:
+    __slots__ = ("_self",)
+
+    def new_connection_status(self, status):
+        s = self._self
+        if status.status == "CONNECTED":
+            print(status.address.address, "connected")
+            s.add_device.emit(status.address.address)
+        elif status.status == "LOST":
+            print(status.address.address, "disconnected")
+            s.remove_device.emit(status.address.address)
+
+
+class StatusBus(QObject):
+    # pychromecast calls the listeners on its socket threads. They only post
+    # a copy of the status here, bursts for the same device collapse to the
+    # latest status and everything is applied on the gui thread once a frame
+    posted = pyqtSignal()
+
+    def __init__(self, parent=None, interval=16, metrics=None):
+        super(StatusBus, self).__init__(parent)
+        self.metrics = metrics
+        # Set by --record-statuses, sees every status before bursts collapse
+        self.recorder = None
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(interval)
+        self.timer.timeout.connect(self.flush)
+        self.posted.connect(self.schedule)
+        self.posted_count = 0
+        self.applied_count = 0
+        self.flush_count = 0
+        self.flush_time = 0.0
+        self.flush_time_max = 0.0
+
+    def post(self, listener, status):
+        if self.metrics != None:
+            self.metrics.status_events.labels(device=listener.device.device.name).inc()
+        snapshot = copy.copy(status)
+        if self.recorder != None:
+            self.recorder.record(listener.device, snapshot)
+        with self.lock:
+            wake = not self.pending
+            queue = self.pending.setdefault(listener, [])
+            if queue and not self.significant(queue[-1]):
+                queue[-1] = snapshot
+            else:
+                queue.append(snapshot)
+            self.posted_count = self.posted_count + 1
+        if wake:
+            self.posted.emit()
+
+    def significant(self, status):
+        # A finished or failed track drives directory playback, never
+        # let a later status overwrite it before it was seen
+        return getattr(status, "idle_reason", None) != None
+
+    def schedule(self):
+        if not self.timer.isActive():
+            self.timer.start()
+
+    def flush(self):
+        start = time.perf_counter()
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+        for listener, queue in pending.items():
+            for status in queue:
+                listener.apply(status)
+                self.applied_count = self.applied_count + 1
+        elapsed = time.perf_counter() - start
+        self.flush_count = self.flush_count + 1
+        self.flush_time = self.flush_time + elapsed
+        self.flush_time_max = max(self.flush_time_max, elapsed)
+        if self.recorder != None:
+            self.recorder.write()
+
+
+def register_gauges(metrics, s, devices):
+    # Read when scraped, devices returns a copy of the device list
+    metrics.gauge(
+        "catt_qt_devices",
+        "Devices by whether they are online",
+        lambda: [
+            ({"state": state}, sum(1 for d in devices() if d.online == online))
+            for state, online in (("online", True), ("offline", False))
+        ],
+    )
+    metrics.gauge(
+        "catt_qt_pooled_connections",
+        "Open device connections",
+        lambda: [({}, len(s.connections.casts))],
+    )
+    metrics.gauge(
+        "catt_qt_status_bus_statuses",
+        "Statuses posted by socket threads and applied after collapsing bursts",
+        lambda: [
+            ({"stage": "posted"}, s.status_bus.posted_count),
+            ({"stage": "applied"}, s.status_bus.applied_count),
+        ],
+    )
+    metrics.gauge(
+        "catt_qt_commands_dropped",
+        "Queued commands superseded before they ran",
+        lambda: [({"device": d.device.name}, d.commands.dropped) for d in devices()],
+    )
+
+
+def reconnect_volume(value):
+    v = int(value)
+    if v < 0 or v > 100:
+        raise argparse.ArgumentTypeError(
+            "Reconnect volume value out of range. Valid range is 0-100."
+        )
+    return v
+
+
+# Options QApplication takes with a value, the value must not be taken
+# for the media to cast
+qt_value_options = {
+    "-platform",
+    "-platformpluginpath",
+    "-platformtheme",
+    "-plugin",
+    "-qwindowgeometry",
+    "-qwindowicon",
+    "-qwindowtitle",
+    "-session",
+    "-style",
+    "-stylesheet",
+    "-display",
+    "-geometry",
+    "-title",
+    "-name",
+    "-font",
+    "-fn",
+    "-background",
+    "-bg",
+    "-foreground",
+    "-fg",
+    "-button",
+    "-btn",
+    "-inputstyle",
+    "-im",
+    "-ncols",
+    "-visual",
+}
+
+
+def strip_qt_options(argv):
+    args = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+            continue
+        name = arg[1:] if arg.startswith("--") else arg
+        if name in qt_value_options:
+            skip = True
+            continue
+        if name.split("=", 1)[0] in qt_value_options:
+            continue
+        args.append(arg)
+    return args
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="catt-qt")
+    parser.add_argument(
+        "media",
+        nargs="?",
+        help="File, link or playlist to cast, a running catt-qt casts it instead",
+    )
+    parser.add_argument(
+        "--device",
+        metavar="NAME",
+        help="Device to cast to or select, by its name",
+    )
+    parser.add_argument(
+        "--new-instance",
+        action="store_true",
+        help="Start another window instead of handing over to a running one",
+    )
+    parser.add_argument(
+        "--known-hosts",
+        metavar="HOST[,HOST..]",
+        help="Devices to poll directly, for networks that filter multicast,"
+        " also read from ~/.config/catt-qt/known_hosts",
+    )
+    parser.add_argument(
+        "--device-cache",
+        metavar="PATH",
+        help="Where devices are remembered to dial them before discovery"
+        " answers, none to not remember them",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        metavar="PORT",
+        help="Serve metrics on 127.0.0.1:PORT as /metrics for Prometheus"
+        " and /metrics.json",
+    )
+    parser.add_argument(
+        "--metrics-dump",
+        metavar="PATH",
+        help="Write the metrics as json to PATH on exit",
+    )
+    parser.add_argument(
+        "--record-statuses",
+        metavar="PATH",
+        help="Record the statuses devices send to PATH, to replay them later",
+    )
+    parser.add_argument(
+        "--reconnect-volume",
+        type=reconnect_volume,
+        default=-1,
+        metavar="0-100",
+        help="Volume to set when a device reconnects",
+    )
+    parser.add_argument(
+        "--headless",
+        action="store_true",
+        help="Run without a window and serve a local JSON api instead",
+    )
+    parser.add_argument(
+        "--api",
+        default="127.0.0.1:8765",
+        metavar="HOST:PORT|unix:PATH",
+        help="Where the headless api listens, loopback http or a unix socket",
+    )
+    parser.add_argument(
+        "--startup-timing",
+        action="store_true",
+        help="Print how long each startup phase took",
+    )
+    parser.add_argument(
+        "--benchmark-startup",
+        type=int,
+        metavar="N",
+        help="Run startup N times against stand-in devices and print percentiles",
+    )
+    parser.add_argument(
+        "--benchmark-devices",
+        type=int,
+        default=10,
+        metavar="N",
+        help="Number of stand-in devices to use for benchmarks",
+    )
+    parser.add_argument(
+        "--benchmark-connections",
+        action="store_true",
+        help="Drop and reconnect stand-in devices and count the connections it costs",
+    )
+    parser.add_argument(
+        "--benchmark-reconnect",
+        action="store_true",
+        help="Drop stand-in devices repeatedly and measure how long reconnects take",
+    )
+    parser.add_argument(
+        "--benchmark-device-cache",
+        action="store_true",
+        help="Compare startup against slow-to-answer stand-in devices with and"
+        " without the device cache",
+    )
+    parser.add_argument(
+        "--benchmark-headless",
+        action="store_true",
+        help="Drive the headless api without a display and compare it to the gui",
+    )
+    parser.add_argument(
+        "--benchmark-gaps",
+        action="store_true",
+        help="Measure the gap between directory tracks on a stand-in receiver",
+    )
+    parser.add_argument(
+        "--benchmark-playlist",
+        action="store_true",
+        help="Compare directory playlist lookups against listing the directory",
+    )
+    parser.add_argument(
+        "--benchmark-server",
+        action="store_true",
+        help="Measure media server throughput and seek latency on loopback",
+    )
+    parser.add_argument(
+        "--benchmark-registry",
+        action="store_true",
+        help="Measure status dispatch cost and memory from 1 to 500 stand-in devices",
+    )
+    parser.add_argument(
+        "--benchmark-status-bus",
+        action="store_true",
+        help="Flood stand-in devices with status updates and check gui thread time",
+    )
+    parser.add_argument(
+        "--benchmark-e2e",
+        nargs="?",
+        const="1,10,50,200",
+        metavar="COUNTS",
+        help="Run the gui offscreen against emulated receivers, 1 to 200 of them by"
+        " default, and measure startup, cast, seek and reconnect time and cpu use",
+    )
+    parser.add_argument(
+        "--replay-statuses",
+        metavar="PATH",
+        help="Replay recorded statuses into the gui offscreen and report handler"
+        " time and ui updates per event",
+    )
+    parser.add_argument(
+        "--replay-speed",
+        type=float,
+        default=1.0,
+        metavar="X",
+        help="How many times faster than recorded to replay, 0 for as fast as"
+        " possible",
+    )
+    parser.add_argument(
+        "--check-import-budget",
+        action="store_true",
+        help="Fail when importing catt-qt takes longer than its budget",
+    )
+    # What a benchmark wants from the app it started, see open_probe
+    parser.add_argument("--probe", help=argparse.SUPPRESS)
+    # Leave anything else, such as Qt's own options, to QApplication
+    return parser.parse_known_args(strip_qt_options(argv))[0]
@@ -0,0 +1,656 @@
+# Copyright 2020 - Scott Moreau
+
+import os
+import sys
+import json
+import time
+import queue
+import signal
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from urllib.parse import unquote, urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from PyQt5.QtCore import QCoreApplication, QObject, QSocketNotifier, pyqtSignal
+from cattqt.core import (
+    StartupTimer,
+    StatusBus,
+    open_probe,
+    open_discovery,
+    ConnectionPool,
+    CommandQueue,
+    VolumeChannel,
+    DirectoryQueue,
+    DeviceLifecycle,
+    ConnectionListener,
+    register_gauges,
+)
+from cattqt.metrics import Metrics, serve_metrics
+from cattqt.devicecache import open_cache
+from cattqt.recording import open_recorder
+
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super(ApiError, self).__init__(message)
+        self.status = status
+
+
+class HeadlessDevice:
+    # The gui's Device without the widgets and timers, positions are
+    # handed out with the time they were reported at instead of ticking
+    __slots__ = (
+        "_self",
+        "cast",
+        "device",
+        "online",
+        "media_listener",
+        "status_listener",
+        "connection_listener",
+        "commands",
+        "volume_channel",
+        "reconnect",
+        "cast_thread",
+        "queue",
+        "media_token",
+        "directory",
+        "filename",
+        "title",
+        "playback_starting",
+        "media",
+        "status",
+        "disconnect_volume",
+        "play_requested",
+        "__weakref__",
+    )
+
+    def __init__(self, s, catt_device, cast):
+        self._self = s
+        self.cast = cast
+        self.device = catt_device
+        self.online = True
+        self.media_listener = HeadlessMediaListener()
+        self.media_listener._self = s
+        self.media_listener.device = self
+        self.status_listener = HeadlessStatusListener()
+        self.status_listener._self = s
+        self.status_listener.device = self
+        self.connection_listener = ConnectionListener()
+        self.connection_listener._self = s
+        self.commands = CommandQueue(self, s.command_pool)
+        self.volume_channel = VolumeChannel(self, s.command_pool)
+        self.reconnect = None
+        self.cast_thread = None
+        self.queue = None
+        self.media_token = None
+        self.directory = None
+        self.filename = None
+        self.title = None
+        self.playback_starting = False
+        self.media = cast.media_controller.status
+        self.status = cast.status
+        self.disconnect_volume = 0
+        self.play_requested = None
+
+    def cancel_cast(self):
+        if self.cast_thread != None:
+            self.cast_thread.cancel()
+            self.cast_thread = None
+        if self.queue != None:
+            self.queue.cancel()
+            self.queue = None
+        if self.media_token != None:
+            self._self.media_server.remove_file(self.media_token)
+            self.media_token = None
+
+    def snapshot(self):
+        m = self.media
+        status = self.status
+        updated = getattr(m, "last_updated", None)
+        local = self.filename != None and self.directory != None
+        return {
+            "uuid": str(self.cast.uuid),
+            "name": self.device.name,
+            "host": self.device.ip_addr,
+            "online": self.online,
+            "state": getattr(m, "player_state", None),
+            "title": getattr(m, "title", None),
+            "content_id": getattr(m, "content_id", None),
+            "file": os.path.join(self.directory, self.filename) if local else None,
+            "position": getattr(m, "current_time", None),
+            "rate": getattr(m, "playback_rate", None),
+            "updated": updated.timestamp() if updated != None else None,
+            "duration": getattr(m, "duration", None),
+            "volume": status.volume_level if status != None else None,
+            "muted": status.volume_muted if status != None else None,
+        }
+
+
+class HeadlessMediaListener:
+    __slots__ = ("_self", "device")
+
+    def new_media_status(self, status):
+        self._self.status_bus.post(self, status)
+
+    def apply(self, status):
+        s = self._self
+        d = self.device
+        if not d.online:
+            return
+        d.media = status
+        if d.play_requested != None and status.player_state == "PLAYING":
+            s.metrics.play_to_playing.labels(device=d.device.name).observe(
+                time.perf_counter() - d.play_requested
+            )
+            d.play_requested = None
+        if d.queue != None and d.queue.advance(status):
+            s.publish("track", d)
+        if (
+            d.filename != None
+            and status.idle_reason == "FINISHED"
+            and status.title == d.title
+            and (d.queue == None or not d.queue.waiting())
+        ):
+            d.cancel_cast()
+            s.play_next.emit(d)
+        elif d.playback_starting and status.idle_reason == "ERROR":
+            s.stop_call.emit(d)
+            s.play_next.emit(d)
+        s.publish("media", d)
+
+
+class HeadlessStatusListener:
+    __slots__ = ("_self", "device")
+
+    def new_cast_status(self, status):
+        self._self.status_bus.post(self, status)
+
+    def apply(self, status):
+        d = self.device
+        if not d.online:
+            return
+        d.status = status
+        d.disconnect_volume = round(status.volume_level * 100)
+        d.volume_channel.reconcile(status.volume_level)
+        self._self.publish("volume", d)
+
+
+class Subscriber:
+    # A slow client loses its oldest events rather than holding up the
+    # daemon or growing without bound
+    def __init__(self, size=256):
+        self.events = queue.Queue(size)
+        self.dropped = 0
+
+    def put(self, line):
+        while True:
+            try:
+                self.events.put_nowait(line)
+                return
+            except queue.Full:
+                try:
+                    self.events.get_nowait()
+                    self.dropped = self.dropped + 1
+                except queue.Empty:
+                    pass
+
+
+class Daemon(QObject, DeviceLifecycle):
+    # Discovery, connections, device commands and directory playback as in
+    # the gui, driven over a local JSON api. Device state is only touched
+    # on the daemon's own thread, api requests are handed over to it
+    command_done = pyqtSignal(object, str, float)
+    command_failed = pyqtSignal(object, str, str)
+    add_device = pyqtSignal(str)
+    remove_device = pyqtSignal(str)
+    device_connected = pyqtSignal(object)
+    device_failed = pyqtSignal(object)
+    device_redialed = pyqtSignal(object, object, str)
+    cast_started = pyqtSignal(object)
+    cast_failed = pyqtSignal(object, str)
+    stop_call = pyqtSignal(object)
+    play_next = pyqtSignal(object)
+    invoke = pyqtSignal(object)
+
+    def __init__(self, args, parent=None):
+        super(Daemon, self).__init__(parent)
+        self.args = args
+        self.startup_timer = StartupTimer(time.perf_counter())
+        self.reconnect_volume = args.reconnect_volume
+        self.connect_timeout = 10
+        self.dial_timeout = 3
+        self.connect_threads = []
+        self.command_pool = ThreadPoolExecutor(32)
+        self.metrics = Metrics()
+        self.metrics_server = None
+        self.devices = {}
+        self.by_host = {}
+        self.connecting_uuids = set()
+        self.connected_uuids = set()
+        self.subscribers = set()
+        self.subscribers_lock = threading.Lock()
+        self.status_bus = StatusBus(self, metrics=self.metrics)
+        self.status_bus.recorder = open_recorder(args)
+        self.probe = open_probe(self)
+        self.discovery = open_discovery(self)
+        self.connections = ConnectionPool(self.discovery)
+        self.device_cache = open_cache(args)
+        self.command_done.connect(self.on_command_done)
+        self.command_failed.connect(self.on_command_failed)
+        self.add_device.connect(self.on_add_device)
+        self.remove_device.connect(self.on_remove_device)
+        self.device_connected.connect(self.on_device_connected)
+        self.device_failed.connect(self.on_device_failed)
+        self.device_redialed.connect(self.on_device_redialed)
+        self.cast_started.connect(self.on_cast_started)
+        self.cast_failed.connect(self.on_cast_failed)
+        self.stop_call.connect(self.stop)
+        self.play_next.connect(self.on_play_next)
+        self.invoke.connect(self.on_invoke)
+        self.discovery.device_added.connect(self.on_device_discovered)
+        self.discovery.device_updated.connect(self.on_device_discovered)
+        self.discovery.device_removed.connect(self.on_device_vanished)
+
+    def start(self):
+        self.server = serve_api(self, self.args.api)
+        print("api " + self.server.location, flush=True)
+        register_gauges(self.metrics, self, lambda: list(self.devices.values()))
+        if self.args.metrics_port:
+            self.metrics_server = serve_metrics(self.metrics, self.args.metrics_port)
+        self.discovery.start()
+        if self.device_cache != None:
+            # Dialed on their last address without waiting on mDNS
+            for u, entry in self.device_cache.entries():
+                self.connect_device(self.device_cache.cast_info(u), direct=True)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.server.location.startswith("unix:"):
+            try:
+                os.unlink(self.server.location[len("unix:") :])
+            except OSError:
+                pass
+        for d in self.devices.values():
+            d.cancel_cast()
+            if d.reconnect != None:
+                d.reconnect.stop()
+        for thread in list(self.connect_threads):
+            thread.wait()
+        self.command_pool.shutdown(wait=False)
+        if self.metrics_server != None:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+        if self.args.metrics_dump:
+            self.metrics.dump(self.args.metrics_dump)
+        if self.status_bus.recorder != None:
+            self.status_bus.recorder.close()
+        self.save_device_cache()
+        self.discovery.stop()
+        self.connections.close()
+        self.close_library()
+
+    def create_device(self, catt_device, cast):
+        return HeadlessDevice(self, catt_device, cast)
+
+    def device_from_host(self, ip):
+        return self.by_host.get(ip)
+
+    def device_list(self):
+        return list(self.devices.values())
+
+    def rehost_device(self, d, host):
+        if self.by_host.get(d.device.ip_addr) is d:
+            del self.by_host[d.device.ip_addr]
+        d.device.ip_addr = host
+        self.by_host[host] = d
+
+    def device_added(self, d):
+        self.devices[d.cast.uuid] = d
+        self.by_host[d.device.ip_addr] = d
+        self.publish("added", d)
+
+    def connections_settled(self):
+        self.save_device_cache()
+
+    def device_unreachable(self, cast_info):
+        print("Failed to connect to", cast_info.friendly_name)
+
+    def device_online(self, d, level):
+        d.online = True
+        self.publish("online", d)
+
+    def device_offline(self, d):
+        d.online = False
+        self.publish("offline", d)
+
+    def on_command_failed(self, d, kind, error):
+        print(d.device.name, kind, "failed:", error)
+        self.metrics.command_failures.labels(device=d.device.name, command=kind).inc()
+        self.publish("error", d, kind + " failed: " + error)
+
+    def on_invoke(self, fn):
+        fn()
+
+    def call(self, fn, *args):
+        # Runs fn on the daemon's thread and waits for what it returns
+        future = Future()
+
+        def run():
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+        self.invoke.emit(run)
+        return future.result(timeout=30)
+
+    def subscribe(self):
+        subscriber = Subscriber()
+        with self.subscribers_lock:
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.subscribers_lock:
+            self.subscribers.discard(subscriber)
+
+    def publish(self, event, d, error=None):
+        with self.subscribers_lock:
+            if not self.subscribers:
+                return
+            subscribers = list(self.subscribers)
+        message = {"event": event, "device": d.snapshot()}
+        if error != None:
+            message["error"] = error
+        line = json.dumps(message) + "\n"
+        for subscriber in subscribers:
+            subscriber.put(line)
+
+    def find(self, key):
+        for d in self.devices.values():
+            if str(d.cast.uuid) == key or d.device.name == key:
+                return d
+        raise ApiError(404, "No device " + key)
+
+    def usable(self, key):
+        d = self.find(key)
+        if not d.online:
+            raise ApiError(409, d.device.name + " is offline")
+        return d
+
+    def list_devices(self):
+        return {"devices": [d.snapshot() for d in self.devices.values()]}
+
+    def get_device(self, key):
+        return self.find(key).snapshot()
+
+    def cast(self, key, media):
+        d = self.usable(key)
+        if not media or (
+            not "://" in media and not ":\\" in media and not media.startswith("/")
+        ):
+            raise ApiError(400, "media needs a url or a full path")
+        self.play(d, media)
+        return d.snapshot()
+
+    def control(self, key, kind, value=None):
+        d = self.usable(key)
+        if kind == "volume":
+            d.volume_channel.set(min(max(float(value), 0.0), 1.0))
+        elif kind == "seek":
+            value = float(value)
+            d.commands.submit("seek", lambda: d.device.seek(value))
+        elif kind == "play":
+            d.commands.submit("play", d.device.play)
+        elif kind == "pause":
+            d.commands.submit("pause", d.device.pause)
+        elif kind == "stop":
+            d.cancel_cast()
+            d.filename = d.directory = None
+            self.stop(d)
+        return d.snapshot()
+
+    def stop(self, d):
+        d.commands.submit("stop", d.device.stop)
+
+    def play(self, d, text):
+        d.cancel_cast()
+        if getattr(d.media, "player_state", None) in ("PLAYING", "PAUSED", "BUFFERING"):
+            self.stop(d)
+        urls = {}
+        if not "://" in text:
+            if not os.path.isfile(text):
+                raise ApiError(404, text + " does not exist")
+            d.filename = os.path.basename(text)
+            d.directory = os.path.dirname(text)
+            d.title = self.local_title(text)
+            d.playback_starting = True
+            _, d.media_token, urls = self.serve_local([d], text)
+        else:
+            d.filename = d.directory = d.title = None
+        self.start_cast([d], text, urls, d.title)
+
+    def on_cast_started(self, d):
+        d.playback_starting = False
+        if d.directory != None:
+            d.queue = DirectoryQueue(self, d)
+            d.queue.start()
+        self.publish("started", d)
+
+    def cast_not_started(self, d, error, skipping):
+        self.publish("error", d, error)
+
+    def on_play_next(self, d):
+        if d.filename == None or d.directory == None or not d.online:
+            return
+        name = self.next_playable(d.directory, d.filename)
+        if name == None:
+            d.filename = d.directory = None
+            return
+        try:
+            self.play(d, os.path.join(d.directory, name))
+        except (ApiError, OSError) as e:
+            # Runs from signals, an exception here would take the daemon
+            # down, so subscribers hear of it instead
+            d.filename = d.directory = None
+            d.playback_starting = False
+            self.publish("error", d, str(e))
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def parts(self):
+        # Device names in the path may be percent encoded
+        path = self.path.split("?", 1)[0].strip("/")
+        return [unquote(part) for part in path.split("/")]
+
+    def trusted(self):
+        # Browsers let any page send a simple POST to a loopback port and
+        # DNS rebinding lets it read the answers, requests have to name
+        # this server and may only come from its own origin
+        if isinstance(self.server, UnixApiServer):
+            return True
+        allowed = self.server.names
+        port = self.server.server_address[1]
+        try:
+            host = urlsplit("//" + self.headers.get("Host", ""))
+            if host.hostname not in allowed or host.port not in (None, port):
+                return False
+            origin = self.headers.get("Origin")
+            if origin != None:
+                origin = urlsplit(origin)
+                if origin.hostname not in allowed or origin.port != port:
+                    return False
+        except ValueError:
+            return False
+        return True
+
+    def do_GET(self):
+        if not self.trusted():
+            self.send_json(403, {"error": "Forbidden"})
+            return
+        parts = self.parts()
+        app = self.server.app
+        if parts == ["events"]:
+            self.stream_events()
+        elif parts == ["metrics"]:
+            self.send_text(200, app.metrics.prometheus())
+        elif parts == ["metrics.json"]:
+            self.send_json(200, app.metrics.snapshot())
+        elif parts == ["devices"]:
+            self.respond(app.list_devices)
+        elif len(parts) == 2 and parts[0] == "devices":
+            self.respond(app.get_device, parts[1])
+        else:
+            self.send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        if not self.trusted():
+            self.send_json(403, {"error": "Forbidden"})
+            return
+        parts = self.parts()
+        app = self.server.app
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self.send_json(400, {"error": "Body is not JSON"})
+            return
+        if not isinstance(body, dict):
+            self.send_json(400, {"error": "Body is not a JSON object"})
+            return
+        if len(parts) != 3 or parts[0] != "devices":
+            self.send_json(404, {"error": "Not found"})
+            return
+        key, action = parts[1], parts[2]
+        if action == "cast":
+            self.respond(app.cast, key, body.get("media"))
+        elif action == "volume":
+            self.respond(app.control, key, "volume", body.get("level"))
+        elif action == "seek":
+            self.respond(app.control, key, "seek", body.get("position"))
+        elif action in ("play", "pause", "stop"):
+            self.respond(app.control, key, action)
+        else:
+            self.send_json(404, {"error": "Not found"})
+
+    def respond(self, fn, *args):
+        try:
+            self.send_json(200, self.server.app.call(fn, *args))
+        except ApiError as e:
+            self.send_json(e.status, {"error": str(e)})
+        except (TypeError, ValueError) as e:
+            self.send_json(400, {"error": str(e)})
+        except Exception as e:
+            self.send_json(500, {"error": str(e) or type(e).__name__})
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_text(self, status, body):
+        data = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def stream_events(self):
+        # One JSON object per line: every device as it is now, then each
+        # change as it happens until the client hangs up
+        app = self.server.app
+        subscriber = app.subscribe()
+        try:
+            devices = app.call(app.list_devices)["devices"]
+            self.close_connection = True
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            for device in devices:
+                line = json.dumps({"event": "device", "device": device}) + "\n"
+                self.wfile.write(line.encode())
+            self.wfile.flush()
+            while True:
+                try:
+                    line = subscriber.events.get(timeout=15)
+                except queue.Empty:
+                    # Finds clients that went away while nothing happened
+                    line = "\n"
+                self.wfile.write(line.encode())
+                self.wfile.flush()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            app.unsubscribe(subscriber)
+
+
+class ApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class ApiServer6(ApiServer):
+    address_family = socket.AF_INET6
+
+
+class UnixApiServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # http.server expects a (host, port) client address
+        request, _ = super(UnixApiServer, self).get_request()
+        return request, ("unix", 0)
+
+
+def serve_api(app, address):
+    if address.startswith("unix:"):
+        path = address[len("unix:") :]
+        if os.path.exists(path):
+            os.unlink(path)
+        server = UnixApiServer(path, ApiHandler)
+        os.chmod(path, 0o600)
+        server.location = "unix:" + path
+    else:
+        host, _, port = address.rpartition(":")
+        host = host.strip("[]") or "127.0.0.1"
+        if ":" in host:
+            server = ApiServer6((host, int(port)), ApiHandler)
+            server.location = "http://[%s]:%d" % server.server_address[:2]
+        else:
+            server = ApiServer((host, int(port)), ApiHandler)
+            server.location = "http://%s:%d" % server.server_address[:2]
+        server.names = {"127.0.0.1", "localhost", "::1", host.lower()}
+    server.app = app
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def main(args):
+    app = QCoreApplication(sys.argv[:1])
+    daemon = Daemon(args)
+    # Ctrl-C and SIGTERM reach Python through a wakeup socket, so the
+    # event loop never has to poll for them
+    wake_r, wake_w = socket.socketpair()
+    wake_r.setblocking(False)
+    wake_w.setblocking(False)
+    signal.set_wakeup_fd(wake_w.fileno())
+    signal.signal(signal.SIGINT, lambda *args: app.quit())
+    signal.signal(signal.SIGTERM, lambda *args: app.quit())
+    notifier = QSocketNotifier(wake_r.fileno(), QSocketNotifier.Read)
+    notifier.activated.connect(lambda: wake_r.recv(64))
+    daemon.start()
+    code = app.exec_()
+    daemon.close()
+    sys.exit(code)
@@ -0,0 +1,145 @@
+# Copyright 2020 - Scott Moreau
+
+import os
+import json
+import time
+import uuid
+
+
+def cache_path():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(base, "catt-qt", "devices.json")
+
+
+def known_hosts_path():
+    base = os.environ.get("XDG_CONFIG_HOME") or os.path.join(
+        os.path.expanduser("~"), ".config"
+    )
+    return os.path.join(base, "catt-qt", "known_hosts")
+
+
+def known_hosts(args):
+    # One host per line in the config file, anything after # is a comment
+    hosts = []
+    try:
+        with open(known_hosts_path()) as f:
+            for line in f:
+                host = line.split("#")[0].strip()
+                if host:
+                    hosts.append(host)
+    except OSError:
+        pass
+    if args.known_hosts:
+        hosts.extend(h.strip() for h in args.known_hosts.split(",") if h.strip())
+    return hosts
+
+
+def open_cache(args):
+    # Benchmark runs leave the real cache alone unless they are given one
+    if args.device_cache == "none":
+        return None
+    if args.device_cache == None and args.probe != None:
+        return None
+    return DeviceCache(args.device_cache)
+
+
+class DeviceCache:
+    # The devices seen in earlier runs with the address each was last
+    # reached on, so startup can list and dial them before mDNS answered.
+    # Devices not seen for max_age days are forgotten
+    def __init__(self, path=None, max_age=30):
+        self.path = path or cache_path()
+        self.max_age = max_age * 86400
+        self.devices = {}
+        self.dirty = False
+        try:
+            with open(self.path) as f:
+                devices = json.load(f)
+        except (OSError, ValueError):
+            devices = {}
+        if not isinstance(devices, dict):
+            devices = {}
+        now = time.time()
+        for key, entry in devices.items():
+            # The file may have been edited by hand, skip what would not load
+            try:
+                uuid.UUID(key)
+                if not entry["name"] or not entry["host"] or not entry["port"]:
+                    continue
+                if not isinstance(entry["name"], str) or not isinstance(
+                    entry["host"], str
+                ):
+                    continue
+                age = now - float(entry.get("seen", 0))
+            except (ValueError, TypeError, KeyError, AttributeError):
+                continue
+            if age < self.max_age:
+                self.devices[key] = entry
+
+    def entries(self):
+        # Sorted by name, the order they are listed in until they connect
+        return sorted(
+            ((uuid.UUID(key), entry) for key, entry in self.devices.items()),
+            key=lambda x: x[1]["name"].lower(),
+        )
+
+    def cast_info(self, u):
+        # Only the cached address as service, dialing it skips mDNS
+        from pychromecast.models import CastInfo, HostServiceInfo
+
+        entry = self.devices[str(u)]
+        return CastInfo(
+            services={HostServiceInfo(entry["host"], entry["port"])},
+            uuid=u,
+            model_name=entry.get("model"),
+            friendly_name=entry["name"],
+            host=entry["host"],
+            port=entry["port"],
+            cast_type=entry.get("cast_type"),
+            manufacturer=entry.get("manufacturer"),
+        )
+
+    def remember(self, cast_info, volume=None):
+        entry = self.devices.setdefault(str(cast_info.uuid), {})
+        entry["name"] = cast_info.friendly_name
+        entry["host"] = cast_info.host
+        entry["port"] = cast_info.port
+        entry["model"] = cast_info.model_name
+        entry["cast_type"] = cast_info.cast_type
+        entry["manufacturer"] = cast_info.manufacturer
+        entry["seen"] = time.time()
+        if volume != None:
+            entry["volume"] = volume
+        self.dirty = True
+
+    def correct(self, cast_info):
+        # Discovery has the last word on where a known device is now
+        entry = self.devices.get(str(cast_info.uuid))
+        if entry == None or not cast_info.host:
+            return
+        if (entry["host"], entry["port"], entry["name"]) != (
+            cast_info.host,
+            cast_info.port,
+            cast_info.friendly_name,
+        ):
+            self.remember(cast_info)
+
+    def volume(self, u):
+        entry = self.devices.get(str(u))
+        return entry.get("volume") if entry != None else None
+
+    def save(self):
+        if not self.dirty:
+            return
+        temp = self.path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(temp, "w") as f:
+                json.dump(self.devices, f, indent=1, sort_keys=True)
+            os.replace(temp, self.path)
+        except OSError as e:
+            print("Failed to save", self.path + ":", e)
+            return
+        self.dirty = False
@@ -0,0 +1,756 @@
+# Copyright 2020 - Scott Moreau
+
+# Emulated receivers for testing and benchmarks without real devices.
+# Each one gets its own loopback address with the cast channel over TLS
+# on 8009 and the setup endpoints on 8008, the ports pychromecast expects,
+# and plays media like the default media receiver without decoding any.
+# They are found over mDNS with --mdns, or polled with --known-hosts
+
+import os
+import sys
+import ssl
+import json
+import time
+import uuid
+import random
+import socket
+import struct
+import asyncio
+import logging
+import argparse
+import tempfile
+import subprocess
+from urllib.parse import urlsplit, parse_qs
+
+NS_CONNECTION = "urn:x-cast:com.google.cast.tp.connection"
+NS_HEARTBEAT = "urn:x-cast:com.google.cast.tp.heartbeat"
+NS_RECEIVER = "urn:x-cast:com.google.cast.receiver"
+NS_MEDIA = "urn:x-cast:com.google.cast.media"
+
+DEFAULT_MEDIA_RECEIVER = "CC1AD845"
+# Pause, seek, stream volume and mute, skip and the queue commands
+SUPPORTED_MEDIA_COMMANDS = 274447
+SESSION_COMMANDS = (
+    "PLAY",
+    "PAUSE",
+    "SEEK",
+    "STOP",
+    "QUEUE_INSERT",
+    "QUEUE_NEXT",
+    "QUEUE_PREV",
+)
+
+
+def receiver_host(i):
+    # Clear of 127.0.1.1, which distributions give the machine's hostname
+    return "127.0.%d.%d" % (2 + i // 250, i % 250 + 1)
+
+
+def make_context(directory):
+    # A throwaway self signed certificate, senders do not verify it
+    cert = os.path.join(directory, "cert.pem")
+    key = os.path.join(directory, "key.pem")
+    subprocess.run(
+        [
+            "openssl",
+            "req",
+            "-x509",
+            "-newkey",
+            "ec",
+            "-pkeyopt",
+            "ec_paramgen_curve:prime256v1",
+            "-nodes",
+            "-days",
+            "2",
+            "-subj",
+            "/CN=catt-qt emulator",
+            "-keyout",
+            key,
+            "-out",
+            cert,
+        ],
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    return context
+
+
+def fetch_head(url, size=65536):
+    # What a receiver reads of the stream before it starts playing
+    import urllib.request
+
+    headers = {"Range": "bytes=0-%d" % (size - 1)}
+    request = urllib.request.Request(url, headers=headers)
+    with urllib.request.urlopen(request, timeout=10) as response:
+        response.read(size)
+
+
+async def read_request(reader):
+    # Just enough HTTP for the setup endpoints and the control api
+    line = await reader.readline()
+    while True:
+        header = await reader.readline()
+        if header in (b"\r\n", b"\n", b""):
+            break
+    parts = line.decode(errors="replace").split()
+    if len(parts) < 2:
+        return None, None
+    return parts[0], parts[1]
+
+
+def write_json(writer, status, body):
+    body = json.dumps(body).encode()
+    writer.write(
+        (
+            "HTTP/1.1 %s\r\n"
+            "Content-Type: application/json\r\n"
+            "Content-Length: %d\r\n"
+            "Connection: close\r\n\r\n" % (status, len(body))
+        ).encode()
+        + body
+    )
+
+
+class Sender:
+    # One connection from a sender app, every message is length prefixed
+    __slots__ = ("writer",)
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def send(self, namespace, source, destination, data):
+        from pychromecast.generated.cast_channel_pb2 import CastMessage
+
+        if self.writer.is_closing():
+            return
+        message = CastMessage()
+        message.protocol_version = message.CASTV2_1_0
+        message.source_id = source
+        message.destination_id = destination
+        message.namespace = namespace
+        message.payload_type = message.STRING
+        message.payload_utf8 = json.dumps(data)
+        payload = message.SerializeToString()
+        self.writer.write(struct.pack(">I", len(payload)) + payload)
+
+
+class MediaSession:
+    # The queue of one load, with the position kept as where it was when
+    # the state last changed plus the time played since
+    def __init__(self, session_id, items, position):
+        self.session_id = session_id
+        self.items = items
+        self.current = 0
+        self.state = "BUFFERING"
+        self.idle_reason = None
+        self.base = position
+        self.since = time.monotonic()
+        self.timer = None
+
+    def position(self):
+        if self.state == "PLAYING":
+            return self.base + time.monotonic() - self.since
+        return self.base
+
+    def move(self, position, state):
+        self.base = position
+        self.since = time.monotonic()
+        self.state = state
+
+    def cancel(self):
+        if self.timer != None:
+            self.timer.cancel()
+            self.timer = None
+
+
+class Receiver:
+    def __init__(self, emulator, index):
+        self.emulator = emulator
+        self.index = index
+        self.host = receiver_host(index)
+        self.name = "Emulated %d" % (index + 1)
+        self.uuid = uuid.uuid5(uuid.NAMESPACE_URL, "catt-qt-emulator/%d" % index)
+        self.senders = set()
+        self.servers = []
+        self.down = False
+        self.volume = 1.0
+        self.muted = False
+        self.app = None
+        self.media = None
+        self.sessions = 0
+        self.drops = 0
+        self.tracks = 0
+        self.ended = None
+        self.gaps = []
+
+    async def start(self):
+        self.servers = [
+            await asyncio.start_server(
+                self.on_cast_connection, self.host, 8009, ssl=self.emulator.context
+            ),
+            await asyncio.start_server(self.on_setup_connection, self.host, 8008),
+        ]
+
+    def describe(self):
+        return {
+            "index": self.index,
+            "name": self.name,
+            "uuid": str(self.uuid),
+            "host": self.host,
+            "down": self.down,
+            "connections": len(self.senders),
+            "app": self.app["appId"] if self.app != None else None,
+            "state": self.media.state if self.media != None else None,
+            "drops": self.drops,
+            "tracks": self.tracks,
+            "gaps": self.gaps,
+        }
+
+    def drop(self, outage):
+        # Like a device losing the network, it stops answering and every
+        # connection breaks until the outage is over. Playback goes on
+        if self.down:
+            return False
+        self.down = True
+        self.drops = self.drops + 1
+        for server in self.servers:
+            server.close()
+        self.servers = []
+        for sender in list(self.senders):
+            sender.writer.transport.abort()
+        asyncio.get_running_loop().call_later(
+            outage, lambda: asyncio.ensure_future(self.restore())
+        )
+        return True
+
+    async def restore(self):
+        await self.start()
+        self.down = False
+
+    async def on_setup_connection(self, reader, writer):
+        try:
+            method, path = await read_request(reader)
+            if path != None and urlsplit(path).path == "/setup/eureka_info":
+                info = {
+                    "name": self.name,
+                    "model_name": "Chromecast",
+                    "manufacturer": "Google Inc.",
+                    "ssdp_udn": str(self.uuid),
+                    "capabilities": {
+                        "display_supported": True,
+                        "multizone_supported": False,
+                    },
+                }
+                body = {"name": self.name, "device_info": info}
+                write_json(writer, "200 OK", body)
+            else:
+                write_json(writer, "404 Not Found", {})
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def on_cast_connection(self, reader, writer):
+        from pychromecast.generated.cast_channel_pb2 import CastMessage
+
+        emulator = self.emulator
+        sender = Sender(writer)
+        self.senders.add(sender)
+        try:
+            while True:
+                size = struct.unpack(">I", await reader.readexactly(4))[0]
+                message = CastMessage()
+                message.ParseFromString(await reader.readexactly(size))
+                emulator.messages = emulator.messages + 1
+                try:
+                    data = json.loads(message.payload_utf8)
+                except ValueError:
+                    continue
+                emulator.later(self.handle, sender, message, data)
+        except (asyncio.IncompleteReadError, ConnectionError, ssl.SSLError):
+            pass
+        except Exception as e:
+            print(self.name, "dropped a sender:", e)
+        finally:
+            self.senders.discard(sender)
+            writer.close()
+
+    def handle(self, sender, message, data):
+        kind = data.get("type")
+        if message.namespace == NS_HEARTBEAT:
+            if kind == "PING":
+                source, destination = message.destination_id, message.source_id
+                sender.send(NS_HEARTBEAT, source, destination, {"type": "PONG"})
+        elif message.namespace == NS_RECEIVER:
+            self.on_receiver_message(sender, message, kind, data)
+        elif message.namespace == NS_MEDIA:
+            # Only the running app has a media channel
+            if self.app != None and message.destination_id == self.app["transportId"]:
+                self.on_media_message(sender, message, kind, data)
+        # CONNECT and CLOSE on the connection namespace need no answer
+
+    def answer(self, sender, message, data, payload):
+        payload["requestId"] = data.get("requestId", 0)
+        source, destination = message.destination_id, message.source_id
+        sender.send(message.namespace, source, destination, payload)
+
+    def invalid(self, sender, message, data, reason):
+        payload = {"type": "INVALID_REQUEST", "reason": reason}
+        self.answer(sender, message, data, payload)
+
+    def publish(
+        self, namespace, source, payload, sender=None, message=None, data=None
+    ):
+        # Every sender hears about a change, the one that asked for it gets
+        # the answer to its request
+        for s in list(self.senders):
+            if s is sender:
+                self.answer(sender, message, data, dict(payload))
+            else:
+                s.send(namespace, source, "*", dict(payload, requestId=0))
+
+    def receiver_status(self):
+        status = {
+            "volume": {
+                "controlType": "attenuation",
+                "level": self.volume,
+                "muted": self.muted,
+                "stepInterval": 0.05,
+            },
+            "isActiveInput": True,
+            "isStandBy": False,
+        }
+        if self.app != None:
+            status["applications"] = [self.app]
+        return {"type": "RECEIVER_STATUS", "status": status}
+
+    def on_receiver_message(self, sender, message, kind, data):
+        loop = asyncio.get_running_loop()
+        if kind == "GET_STATUS":
+            self.answer(sender, message, data, self.receiver_status())
+        elif kind == "LAUNCH":
+            app_id = data.get("appId")
+            if self.app != None and self.app["appId"] == app_id:
+                self.answer(sender, message, data, self.receiver_status())
+                return
+            loop.call_later(
+                self.emulator.launch_latency,
+                self.launch,
+                app_id,
+                sender,
+                message,
+                data,
+            )
+        elif kind == "STOP":
+            self.stop_app()
+            self.publish(
+                NS_RECEIVER, "receiver-0", self.receiver_status(), sender, message, data
+            )
+        elif kind == "SET_VOLUME":
+            volume = data.get("volume", {})
+            if "level" in volume:
+                self.volume = min(max(float(volume["level"]), 0.0), 1.0)
+            if "muted" in volume:
+                self.muted = bool(volume["muted"])
+            self.publish(
+                NS_RECEIVER, "receiver-0", self.receiver_status(), sender, message, data
+            )
+        else:
+            self.invalid(sender, message, data, "INVALID_COMMAND")
+
+    def launch(self, app_id, sender, message, data):
+        self.stop_app()
+        self.sessions = self.sessions + 1
+        session = str(uuid.uuid5(self.uuid, str(self.sessions)))
+        default = app_id == DEFAULT_MEDIA_RECEIVER
+        self.app = {
+            "appId": app_id,
+            "displayName": "Default Media Receiver" if default else app_id,
+            "iconUrl": "",
+            "isIdleScreen": False,
+            "launchedFromCloud": False,
+            "namespaces": [{"name": NS_MEDIA}],
+            "sessionId": session,
+            "statusText": "Ready To Cast",
+            "transportId": session,
+            "universalAppId": app_id,
+        }
+        self.publish(
+            NS_RECEIVER, "receiver-0", self.receiver_status(), sender, message, data
+        )
+
+    def stop_app(self):
+        if self.media != None:
+            self.media.cancel()
+            self.media = None
+        self.app = None
+
+    def media_status(self):
+        media = self.media
+        if media == None:
+            return {"type": "MEDIA_STATUS", "status": []}
+        status = {
+            "mediaSessionId": media.session_id,
+            "playbackRate": 1,
+            "playerState": media.state,
+            "currentTime": media.position(),
+            "supportedMediaCommands": SUPPORTED_MEDIA_COMMANDS,
+            "volume": {"level": self.volume, "muted": self.muted},
+            "currentItemId": media.current + 1,
+            "repeatMode": "REPEAT_OFF",
+            "media": media.items[media.current],
+            "items": [{"itemId": i + 1} for i in range(len(media.items))],
+        }
+        if media.idle_reason != None:
+            status["idleReason"] = media.idle_reason
+        return {"type": "MEDIA_STATUS", "status": [status]}
+
+    def publish_media(self, sender=None, message=None, data=None):
+        status = self.media_status()
+        self.publish(NS_MEDIA, self.app["transportId"], status, sender, message, data)
+
+    def media_item(self, media):
+        # Files play as buffered streams of the next configured duration
+        media = dict(media or {})
+        if not media.get("streamType"):
+            media["streamType"] = "BUFFERED"
+        if media.get("duration") == None:
+            media["duration"] = self.emulator.next_duration()
+        return media
+
+    def on_media_message(self, sender, message, kind, data):
+        media = self.media
+        if kind == "GET_STATUS":
+            self.answer(sender, message, data, self.media_status())
+            return
+        if kind == "LOAD":
+            self.load(sender, message, data)
+            return
+        if kind not in SESSION_COMMANDS:
+            self.invalid(sender, message, data, "INVALID_COMMAND")
+            return
+        if media == None or data.get("mediaSessionId") != media.session_id:
+            self.invalid(sender, message, data, "INVALID_MEDIA_SESSION_ID")
+            return
+        if kind == "PLAY":
+            if media.state == "PAUSED":
+                media.move(media.position(), "PLAYING")
+                self.schedule_end(media)
+        elif kind == "PAUSE":
+            if media.state == "PLAYING":
+                media.cancel()
+                media.move(media.position(), "PAUSED")
+        elif kind == "SEEK":
+            self.emulator.seeks = self.emulator.seeks + 1
+            duration = media.items[media.current]["duration"]
+            position = min(max(float(data.get("currentTime", 0)), 0.0), duration)
+            state = media.state
+            if data.get("resumeState") == "PLAYBACK_START":
+                state = "PLAYING"
+            elif data.get("resumeState") == "PLAYBACK_PAUSE":
+                state = "PAUSED"
+            media.cancel()
+            media.move(position, state)
+            if state == "PLAYING":
+                self.schedule_end(media)
+        elif kind == "STOP":
+            if media.state != "IDLE":
+                self.ended = None
+            media.cancel()
+            media.move(media.position(), "IDLE")
+            media.idle_reason = "CANCELLED"
+            self.publish_media(sender, message, data)
+            self.media = None
+            return
+        elif kind == "QUEUE_INSERT":
+            for item in data.get("items", []):
+                media.items.append(self.media_item(item.get("media")))
+        elif kind in ("QUEUE_NEXT", "QUEUE_PREV"):
+            step = 1 if kind == "QUEUE_NEXT" else -1
+            if 0 <= media.current + step < len(media.items):
+                media.cancel()
+                media.current = media.current + step
+                media.move(0.0, "PLAYING")
+                self.schedule_end(media)
+                self.started()
+        self.publish_media(sender, message, data)
+
+    def load(self, sender, message, data):
+        emulator = self.emulator
+        emulator.loads = emulator.loads + 1
+        if self.media != None:
+            self.media.cancel()
+        self.sessions = self.sessions + 1
+        item = self.media_item(data.get("media"))
+        media = MediaSession(self.sessions, [item], float(data.get("currentTime") or 0))
+        self.media = media
+        self.publish_media(sender, message, data)
+        asyncio.ensure_future(self.buffer(media, item.get("contentId", "")))
+
+    async def buffer(self, media, url):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        if self.emulator.fetch and url.startswith("http"):
+            try:
+                await loop.run_in_executor(None, fetch_head, url)
+            except Exception as e:
+                print(self.name, "failed to load", url + ":", e)
+                if self.media is media:
+                    self.media = None
+                    self.publish(
+                        NS_MEDIA,
+                        self.app["transportId"],
+                        {"type": "LOAD_FAILED", "itemId": 1, "detailedErrorCode": 104},
+                    )
+                return
+        await asyncio.sleep(max(self.emulator.load_latency - (loop.time() - start), 0))
+        if self.media is not media or media.state != "BUFFERING":
+            return
+        media.move(media.base, "PLAYING")
+        self.schedule_end(media)
+        self.started()
+        self.publish_media()
+
+    def schedule_end(self, media):
+        media.cancel()
+        remaining = media.items[media.current]["duration"] - media.position()
+        media.timer = asyncio.get_running_loop().call_later(
+            max(remaining, 0.0), self.track_ended, media
+        )
+
+    def track_ended(self, media):
+        media.timer = None
+        if self.media is not media:
+            return
+        self.ended = time.monotonic()
+        if media.current + 1 < len(media.items):
+            # Queued items are preloaded and start right away
+            media.current = media.current + 1
+            media.move(0.0, "PLAYING")
+            self.schedule_end(media)
+            self.started()
+        else:
+            media.move(media.items[media.current]["duration"], "IDLE")
+            media.idle_reason = "FINISHED"
+        self.publish_media()
+
+    def started(self):
+        # The silence since the last track ended, whether the next one was
+        # waiting in the queue or loaded after the sender saw the end
+        self.tracks = self.tracks + 1
+        if self.ended != None:
+            self.gaps.append(time.monotonic() - self.ended)
+            self.ended = None
+
+
+class Emulator:
+    def __init__(self, args):
+        self.args = args
+        self.latency = args.latency
+        self.launch_latency = args.launch_latency
+        self.load_latency = args.load_latency
+        self.fetch = not args.no_fetch
+        self.durations = [float(d) for d in args.durations.split(",")]
+        self.loaded = 0
+        self.receivers = [Receiver(self, i) for i in range(args.devices)]
+        self.context = None
+        self.zeroconf = None
+        self.messages = 0
+        self.loads = 0
+        self.seeks = 0
+
+    def later(self, callback, *args):
+        # Every message pays the configured round trip, in order
+        if self.latency > 0:
+            asyncio.get_running_loop().call_later(self.latency, callback, *args)
+        else:
+            callback(*args)
+
+    def next_duration(self):
+        duration = self.durations[self.loaded % len(self.durations)]
+        self.loaded = self.loaded + 1
+        return duration
+
+    def route(self, method, path):
+        url = urlsplit(path)
+        query = parse_qs(url.query)
+        if url.path == "/devices":
+            return "200 OK", [r.describe() for r in self.receivers]
+        if url.path == "/stats":
+            return "200 OK", {
+                "messages": self.messages,
+                "loads": self.loads,
+                "seeks": self.seeks,
+                "drops": sum(r.drops for r in self.receivers),
+                "connections": sum(len(r.senders) for r in self.receivers),
+            }
+        if url.path == "/drop":
+            outage = float(query.get("outage", [self.args.outage])[0])
+            device = query.get("device", ["all"])[0]
+            if device == "all":
+                receivers = self.receivers
+            else:
+                receivers = [self.receivers[int(i)] for i in device.split(",")]
+            dropped = [r.index for r in receivers if r.drop(outage)]
+            return "200 OK", {"dropped": dropped}
+        return "404 Not Found", {"error": "Unknown path " + url.path}
+
+    async def on_control_connection(self, reader, writer):
+        try:
+            method, path = await read_request(reader)
+            try:
+                status, body = self.route(method, path or "")
+            except (ValueError, IndexError) as e:
+                status, body = "400 Bad Request", {"error": str(e)}
+            write_json(writer, status, body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def disconnects(self, every, outage):
+        # Drops land on random receivers, every seconds apart on average
+        while True:
+            await asyncio.sleep(random.expovariate(1.0 / every))
+            random.choice(self.receivers).drop(outage)
+
+    def announce(self):
+        from zeroconf import Zeroconf, ServiceInfo
+
+        self.zeroconf = Zeroconf()
+        for r in self.receivers:
+            self.zeroconf.register_service(
+                ServiceInfo(
+                    "_googlecast._tcp.local.",
+                    "Chromecast-%s._googlecast._tcp.local." % r.uuid.hex,
+                    addresses=[socket.inet_aton(r.host)],
+                    port=8009,
+                    properties={
+                        "id": r.uuid.hex,
+                        "fn": r.name,
+                        "md": "Chromecast",
+                        "ca": "4101",
+                        "ve": "05",
+                        "st": "0",
+                        "rs": "",
+                    },
+                    server="%s.local." % r.uuid,
+                )
+            )
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        # Senders that go away mid handshake are expected, not worth a trace
+        logging.getLogger("asyncio").setLevel(logging.CRITICAL)
+        with tempfile.TemporaryDirectory() as directory:
+            self.context = make_context(directory)
+        await asyncio.gather(*(r.start() for r in self.receivers))
+        control = await asyncio.start_server(
+            self.on_control_connection, "127.0.0.1", self.args.control_port
+        )
+        port = control.sockets[0].getsockname()[1]
+        if self.args.mdns:
+            await loop.run_in_executor(None, self.announce)
+        if self.args.disconnect_every > 0:
+            asyncio.ensure_future(
+                self.disconnects(self.args.disconnect_every, self.args.outage)
+            )
+        hosts = [r.host for r in self.receivers]
+        print("emulator " + json.dumps({"control": port, "hosts": hosts}), flush=True)
+        print(
+            "%d receivers, connect with catt-qt --known-hosts=%s"
+            % (len(hosts), ",".join(hosts)),
+            flush=True,
+        )
+        try:
+            await asyncio.Event().wait()
+        finally:
+            if self.zeroconf != None:
+                self.zeroconf.close()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Emulate Chromecast receivers on loopback addresses"
+    )
+    parser.add_argument("--devices", type=int, default=1, help="Number of receivers")
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.01,
+        help="Seconds before a receiver answers any message",
+    )
+    parser.add_argument(
+        "--launch-latency",
+        type=float,
+        default=0.5,
+        help="Seconds an app takes to launch",
+    )
+    parser.add_argument(
+        "--load-latency",
+        type=float,
+        default=0.3,
+        help="Seconds from loading media to playing it, at least",
+    )
+    parser.add_argument(
+        "--durations",
+        default="300",
+        help="Comma separated media durations in seconds, used in turn",
+    )
+    parser.add_argument(
+        "--disconnect-every",
+        type=float,
+        default=0.0,
+        help="Drop a random receiver every so many seconds on average",
+    )
+    parser.add_argument(
+        "--outage",
+        type=float,
+        default=2.0,
+        help="Seconds a dropped receiver stays unreachable",
+    )
+    parser.add_argument(
+        "--control-port",
+        type=int,
+        default=0,
+        help="Port of the control api on 127.0.0.1, /devices, /stats and"
+        " /drop?device=N&outage=SECONDS",
+    )
+    parser.add_argument(
+        "--mdns", action="store_true", help="Announce the receivers over mDNS"
+    )
+    parser.add_argument(
+        "--no-fetch",
+        action="store_true",
+        help="Start playing without reading the head of the media",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> None:
+    args = parse_args(sys.argv[1:] if argv == None else argv)
+    if args.devices < 1 or args.devices > 1000:
+        print("Between 1 and 1000 receivers can be emulated")
+        sys.exit(1)
+    try:
+        asyncio.run(Emulator(args).run())
+    except FileNotFoundError:
+        print("The emulator needs openssl to make its certificate")
+        sys.exit(1)
+    except subprocess.CalledProcessError as e:
+        print("Failed to make a certificate:", e)
+        sys.exit(1)
+    except OSError as e:
+        print("Failed to listen:", e)
+        sys.exit(1)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
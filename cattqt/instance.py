@@ -0,0 +1,101 @@
+# Copyright 2020 - Scott Moreau
+
+import os
+import json
+import getpass
+from PyQt5.QtCore import QObject
+from PyQt5.QtNetwork import QLocalServer, QLocalSocket
+
+
+def instance_name():
+    try:
+        user = getpass.getuser()
+    except Exception:
+        user = "user"
+    return "catt-qt-" + user
+
+
+def single_instance(args):
+    # Benchmarks, timing and stand-in runs always start their own instance
+    if args.new_instance or args.headless or args.probe != None:
+        return False
+    if args.startup_timing or args.check_import_budget:
+        return False
+    for name, value in vars(args).items():
+        if name.startswith("benchmark_") and name != "benchmark_devices":
+            if value:
+                return False
+    return True
+
+
+def request_from_args(args):
+    media = args.media
+    if media and not "://" in media:
+        # The running instance has its own working directory
+        media = os.path.abspath(os.path.expanduser(media))
+    return {"media": media, "device": args.device}
+
+
+def forward(request, timeout=250):
+    # Hands the request to a running instance and returns its reply,
+    # None when there is no instance to hand it to
+    sock = QLocalSocket()
+    sock.connectToServer(instance_name())
+    if not sock.waitForConnected(timeout):
+        return None
+    sock.write((json.dumps(request) + "\n").encode())
+    sock.waitForBytesWritten(timeout)
+    reply = b""
+    while not reply.endswith(b"\n") and sock.waitForReadyRead(2000):
+        reply = reply + bytes(sock.readAll())
+    sock.disconnectFromServer()
+    try:
+        return json.loads(reply)
+    except ValueError:
+        return {"error": "The running instance did not answer"}
+
+
+class InstanceServer(QObject):
+    # The first instance listens, later launches hand their command line
+    # over to it instead of starting up and connecting to every device.
+    # The handler runs on the gui thread and returns an error or None
+    def __init__(self, handler, parent=None):
+        super(InstanceServer, self).__init__(parent)
+        self.handler = handler
+        self.server = QLocalServer(self)
+        self.server.setSocketOptions(QLocalServer.UserAccessOption)
+        self.server.newConnection.connect(self.on_new_connection)
+
+    def listen(self):
+        name = instance_name()
+        if self.server.listen(name):
+            return True
+        if forward({}, 100) != None:
+            # Another instance is alive after all, leave its socket alone
+            return False
+        # Left behind by an instance that did not exit cleanly
+        QLocalServer.removeServer(name)
+        return self.server.listen(name)
+
+    def on_new_connection(self):
+        while self.server.hasPendingConnections():
+            sock = self.server.nextPendingConnection()
+            sock.readyRead.connect(lambda sock=sock: self.on_ready_read(sock))
+            sock.disconnected.connect(sock.deleteLater)
+
+    def on_ready_read(self, sock):
+        if not sock.canReadLine():
+            return
+        try:
+            request = json.loads(bytes(sock.readLine()))
+            if not isinstance(request, dict):
+                raise ValueError(request)
+        except ValueError:
+            error = "Bad request"
+        else:
+            error = self.handler(request)
+        sock.write((json.dumps({"error": error}) + "\n").encode())
+        sock.flush()
+
+    def close(self):
+        self.server.close()
@@ -0,0 +1,287 @@
+# Copyright 2020 - Scott Moreau
+
+import os
+import json
+import shutil
+import sqlite3
+import threading
+import subprocess
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# What the default media receiver decodes, images show as video streams
+video_codecs = {"h264", "hevc", "vp8", "vp9", "av1", "mjpeg", "png", "gif", "webp"}
+audio_codecs = {
+    "aac",
+    "mp3",
+    "opus",
+    "vorbis",
+    "flac",
+    "pcm_u8",
+    "pcm_s16le",
+    "pcm_s24le",
+}
+
+
+def cache_path():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(base, "catt-qt", "metadata.sqlite3")
+
+
+class Metadata:
+    __slots__ = ("duration", "container", "video", "audio", "tags")
+
+    def __init__(
+        self, duration=None, container=None, video=None, audio=None, tags=None
+    ):
+        self.duration = duration
+        self.container = container
+        self.video = video
+        self.audio = audio
+        self.tags = tags or {}
+
+    @property
+    def title(self):
+        return self.tags.get("title")
+
+    @property
+    def playable(self):
+        # None when the probe could not tell, which is also what finding
+        # no streams at all means
+        if not self.video and not self.audio:
+            return None
+        if self.video and self.video[0] not in video_codecs:
+            return False
+        if self.audio and not any(c in audio_codecs for c in self.audio):
+            return False
+        return True
+
+
+def probe_ffprobe(path, ffprobe):
+    # A run that fails or finds no streams says nothing about the file, it
+    # may be unreadable for now or still being written
+    result = subprocess.run(
+        [
+            ffprobe,
+            "-v",
+            "quiet",
+            "-print_format",
+            "json",
+            "-show_format",
+            "-show_streams",
+            path,
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        timeout=30,
+        check=True,
+    )
+    info = json.loads(result.stdout or b"{}")
+    f = info.get("format", {})
+    video = []
+    audio = []
+    for stream in info.get("streams", []):
+        if stream.get("disposition", {}).get("attached_pic"):
+            # Cover art, not something the receiver has to decode
+            continue
+        if stream.get("codec_type") == "video":
+            video.append(stream.get("codec_name"))
+        elif stream.get("codec_type") == "audio":
+            audio.append(stream.get("codec_name"))
+    if not video and not audio:
+        raise ValueError("no streams found")
+    duration = f.get("duration")
+    tags = {k.lower(): v for k, v in f.get("tags", {}).items()}
+    return Metadata(
+        float(duration) if duration else None,
+        f.get("format_name"),
+        video,
+        audio,
+        tags,
+    )
+
+
+def probe_mutagen(path):
+    import mutagen
+
+    f = mutagen.File(path, easy=True)
+    if f == None:
+        return Metadata()
+    tags = {}
+    for k, v in (f.tags or {}).items():
+        tags[k.lower()] = v[0] if isinstance(v, list) and v else str(v)
+    length = getattr(f.info, "length", None)
+    return Metadata(length, type(f).__name__.lower(), None, None, tags)
+
+
+def probe_file(path):
+    ffprobe = shutil.which("ffprobe")
+    if ffprobe != None:
+        return probe_ffprobe(path, ffprobe)
+    try:
+        return probe_mutagen(path)
+    except ImportError:
+        return Metadata()
+
+
+def split_codecs(value):
+    # None means unknown, an empty string a file without such streams
+    if value == None:
+        return None
+    return value.split(",") if value else []
+
+
+class MetadataCache:
+    # Probe results are kept on disk keyed by path, mtime and size, so a
+    # file is only probed again after it changed. The least recently used
+    # rows go once the cache holds more than size files, and memory keeps
+    # the entries of the last files used. Stats, queries and probes all
+    # run on the workers, the gui thread only ever reads what they left
+    # in entries
+    def __init__(self, path=None, size=20000, memory=2000, workers=2):
+        self.path = path or cache_path()
+        self.size = size
+        self.memory = memory
+        self.lock = threading.Lock()
+        # Held around the database alone, lookups never wait on it
+        self.db_lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.pending = {}
+        self.inserts = 0
+        self.pool = ThreadPoolExecutor(workers)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.db = sqlite3.connect(
+            self.path, isolation_level=None, check_same_thread=False
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS metadata (path TEXT PRIMARY KEY,"
+            " mtime INTEGER, size INTEGER, duration REAL, container TEXT,"
+            " video TEXT, audio TEXT, tags TEXT, used REAL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS metadata_used ON metadata (used)")
+
+    def stat(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def lookup(self, path):
+        # Only answers from memory, a file changed since it was probed is
+        # seen the next time it is probed
+        entry = self.entries.get(path)
+        if entry == None:
+            return None
+        try:
+            self.entries.move_to_end(path)
+        except KeyError:
+            # Dropped by a worker in the meantime
+            pass
+        return entry[1]
+
+    def remember(self, path, key, m):
+        with self.lock:
+            self.entries[path] = (key, m)
+            self.entries.move_to_end(path)
+            while len(self.entries) > self.memory:
+                self.entries.popitem(last=False)
+
+    def probe(self, path):
+        with self.lock:
+            future = self.pending.get(path)
+            if future == None:
+                future = self.pool.submit(self.run, path)
+                self.pending[path] = future
+            return future
+
+    def prefetch(self, paths):
+        for path in paths:
+            self.probe(path)
+
+    def run(self, path):
+        try:
+            key = self.stat(path)
+            if key == None:
+                return Metadata()
+            entry = self.entries.get(path)
+            if entry != None and entry[0] == key:
+                return entry[1]
+            m = self.load(path, key)
+            if m != None:
+                return m
+            try:
+                m = probe_file(path)
+            except Exception as e:
+                # Not stored, the next probe tries again
+                print("Failed to probe", path + ":", e)
+                return Metadata()
+            self.store(path, key, m)
+            return m
+        finally:
+            with self.lock:
+                self.pending.pop(path, None)
+
+    def load(self, path, key):
+        with self.db_lock:
+            row = self.db.execute(
+                "SELECT duration, container, video, audio, tags FROM metadata"
+                " WHERE path = ? AND mtime = ? AND size = ?",
+                (path, key[0], key[1]),
+            ).fetchone()
+            if row == None:
+                return None
+            # Marking it used once per session is enough to order evictions
+            self.db.execute(
+                "UPDATE metadata SET used = julianday('now') WHERE path = ?", (path,)
+            )
+        duration, container, video, audio, tags = row
+        m = Metadata(
+            duration,
+            container,
+            split_codecs(video),
+            split_codecs(audio),
+            json.loads(tags),
+        )
+        self.remember(path, key, m)
+        return m
+
+    def store(self, path, key, m):
+        self.remember(path, key, m)
+        with self.db_lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO metadata VALUES"
+                " (?, ?, ?, ?, ?, ?, ?, ?, julianday('now'))",
+                (
+                    path,
+                    key[0],
+                    key[1],
+                    m.duration,
+                    m.container,
+                    ",".join(m.video) if m.video != None else None,
+                    ",".join(m.audio) if m.audio != None else None,
+                    json.dumps(m.tags),
+                ),
+            )
+            self.inserts = self.inserts + 1
+            if self.inserts % 100 == 0:
+                self.evict()
+
+    def evict(self):
+        count = self.db.execute("SELECT COUNT(*) FROM metadata").fetchone()[0]
+        if count > self.size:
+            self.db.execute(
+                "DELETE FROM metadata WHERE path IN"
+                " (SELECT path FROM metadata ORDER BY used LIMIT ?)",
+                (count - self.size,),
+            )
+
+    def close(self):
+        # A probe still running stores its result before the database goes
+        self.pool.shutdown(wait=True, cancel_futures=True)
+        with self.db_lock:
+            self.evict()
+            self.db.close()
@@ -0,0 +1,285 @@
+# Copyright 2020 - Scott Moreau
+
+import json
+import time
+import bisect
+import threading
+from collections import deque
+
+# Upper bounds in seconds, commands mostly answer within a few hundred
+# milliseconds while casts and reconnects take seconds
+buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    k = (len(values) - 1) * p / 100.0
+    f = int(k)
+    c = min(f + 1, len(values) - 1)
+    return values[f] + (values[c] - values[f]) * (k - f)
+
+
+class Counter:
+    __slots__ = ("lock", "value")
+
+    def __init__(self, lock):
+        self.lock = lock
+        self.value = 0
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value = self.value + n
+
+    def snapshot(self):
+        return {"value": self.value}
+
+
+class Rate(Counter):
+    # A counter that also knows how many events fell in the last window
+    # seconds, for the per second figures of the json dump
+    __slots__ = ("window", "started", "recent")
+
+    def __init__(self, lock, window=60):
+        super(Rate, self).__init__(lock)
+        self.window = window
+        self.started = time.monotonic()
+        self.recent = deque(maxlen=window)
+
+    def inc(self, n=1):
+        second = int(time.monotonic())
+        with self.lock:
+            self.value = self.value + n
+            if self.recent and self.recent[-1][0] == second:
+                self.recent[-1][1] = self.recent[-1][1] + n
+            else:
+                self.recent.append([second, n])
+
+    def per_second(self):
+        now = time.monotonic()
+        with self.lock:
+            count = sum(n for second, n in self.recent if now - second < self.window)
+        return count / min(max(now - self.started, 1.0), self.window)
+
+    def snapshot(self):
+        return {"value": self.value, "per_second": self.per_second()}
+
+
+class Histogram:
+    __slots__ = ("lock", "counts", "count", "sum", "samples")
+
+    def __init__(self, lock):
+        self.lock = lock
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        # The latest samples, percentiles in the json dump are exact
+        self.samples = deque(maxlen=500)
+
+    def observe(self, value):
+        i = bisect.bisect_left(buckets, value)
+        with self.lock:
+            self.counts[i] = self.counts[i] + 1
+            self.count = self.count + 1
+            self.sum = self.sum + value
+            self.samples.append(value)
+
+    def snapshot(self):
+        with self.lock:
+            samples = list(self.samples)
+            count, total = self.count, self.sum
+        return {
+            "count": count,
+            "sum": total,
+            "p50": percentile(samples, 50),
+            "p90": percentile(samples, 90),
+            "p99": percentile(samples, 99),
+            "max": max(samples) if samples else 0.0,
+        }
+
+
+class Family:
+    # One metric by name, a child per set of label values
+    kinds = {"counter": Counter, "rate": Rate, "histogram": Histogram}
+
+    def __init__(self, name, kind, help, lock):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.lock = lock
+        self.children = {}
+
+    def labels(self, **labels):
+        key = tuple(sorted(labels.items()))
+        child = self.children.get(key)
+        if child == None:
+            with self.lock:
+                child = self.children.get(key)
+                if child == None:
+                    child = self.kinds[self.kind](threading.Lock())
+                    self.children[key] = child
+        return child
+
+    def value(self, **labels):
+        child = self.children.get(tuple(sorted(labels.items())))
+        return child.value if child != None else 0
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('%s="%s"' % (k, escape(v)) for k, v in pairs) + "}"
+
+
+class Metrics:
+    # What the running app measures about its devices. Recording is cheap
+    # and safe from any thread, nothing is exposed unless asked for
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.families = {}
+        self.gauges = {}
+        self.status_events = self.family(
+            "catt_qt_status_events", "rate", "Media and receiver statuses received"
+        )
+        self.commands = self.family(
+            "catt_qt_command_seconds", "histogram", "Time a device command took"
+        )
+        self.command_failures = self.family(
+            "catt_qt_command_failures", "counter", "Device commands that failed"
+        )
+        self.cast_load = self.family(
+            "catt_qt_cast_load_seconds",
+            "histogram",
+            "From a cast thread starting to the receiver reporting PLAYING",
+        )
+        self.play_to_playing = self.family(
+            "catt_qt_play_to_playing_seconds",
+            "histogram",
+            "From play being asked for to the first PLAYING status",
+        )
+        self.reconnects = self.family(
+            "catt_qt_reconnects", "counter", "Lost devices back online, by path"
+        )
+        self.reconnect_time = self.family(
+            "catt_qt_reconnect_seconds",
+            "histogram",
+            "From losing a device to it being usable again",
+        )
+        self.failed_dials = self.family(
+            "catt_qt_failed_dials", "counter", "Redials of lost devices that failed"
+        )
+
+    def record_reconnect(self, reconnect, path):
+        self.reconnects.labels(path=path).inc()
+        self.reconnect_time.labels(path=path).observe(
+            time.perf_counter() - reconnect.lost_at
+        )
+        if reconnect.failures:
+            self.failed_dials.labels().inc(reconnect.failures)
+
+    def family(self, name, kind, help):
+        family = Family(name, kind, help, self.lock)
+        self.families[name] = family
+        return family
+
+    def gauge(self, name, help, read):
+        # read runs at scrape time and returns (labels, value) pairs
+        self.gauges[name] = (help, read)
+
+    def series(self, family):
+        with self.lock:
+            return list(family.children.items())
+
+    def prometheus(self):
+        lines = []
+        for name, family in self.families.items():
+            kind = "histogram" if family.kind == "histogram" else "counter"
+            if kind == "counter":
+                name = name + "_total"
+            lines.append("# HELP %s %s" % (name, family.help))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for labels, child in self.series(family):
+                if kind == "counter":
+                    lines.append(
+                        "%s%s %d" % (name, format_labels(labels), child.value)
+                    )
+                    continue
+                with child.lock:
+                    counts = list(child.counts)
+                    count, total = child.count, child.sum
+                cumulative = 0
+                for bound, n in zip(buckets + ("+Inf",), counts):
+                    cumulative = cumulative + n
+                    lines.append(
+                        "%s_bucket%s %d"
+                        % (name, format_labels(labels, [("le", bound)]), cumulative)
+                    )
+                lines.append("%s_sum%s %f" % (name, format_labels(labels), total))
+                lines.append("%s_count%s %d" % (name, format_labels(labels), count))
+        for name, (help, read) in self.gauges.items():
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s gauge" % name)
+            for labels, value in read():
+                lines.append(
+                    "%s%s %s"
+                    % (name, format_labels(sorted(labels.items())), repr(value))
+                )
+        lines.append("# HELP catt_qt_uptime_seconds Seconds since the app started")
+        lines.append("# TYPE catt_qt_uptime_seconds gauge")
+        lines.append("catt_qt_uptime_seconds %f" % (time.monotonic() - self.started))
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        metrics = {}
+        for name, family in self.families.items():
+            metrics[name] = [
+                dict(labels=dict(labels), **child.snapshot())
+                for labels, child in self.series(family)
+            ]
+        for name, (help, read) in self.gauges.items():
+            metrics[name] = [
+                {"labels": labels, "value": value} for labels, value in read()
+            ]
+        return {"uptime": time.monotonic() - self.started, "metrics": metrics}
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            json.dump(self.snapshot(), f, indent=1)
+
+
+def serve_metrics(metrics, port):
+    # Loopback only, for a local Prometheus or a collector to scrape
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            path = self.path.split("?", 1)[0]
+            if path == "/metrics":
+                body = metrics.prometheus().encode()
+                content_type = "text/plain; version=0.0.4; charset=utf-8"
+            elif path == "/metrics.json":
+                body = json.dumps(metrics.snapshot()).encode()
+                content_type = "application/json"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,328 @@
+# Copyright 2020 - Scott Moreau
+
+import os
+import re
+import bisect
+import struct
+import mimetypes
+import selectors
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+media_types = ("audio/", "video/", "image/")
+# Not every platform's mime database knows these
+media_extensions = {".mkv", ".flac", ".m4a", ".opus", ".webm"}
+# Playlists and stream redirects that the mime database files as media
+playlist_extensions = {".m3u", ".m3u8", ".pls", ".asx", ".ram", ".wax", ".wvx"}
+media_cache = {}
+digits = re.compile(r"(\d+)")
+
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+watch_mask = (
+    IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+)
+event_header = struct.Struct("iIII")
+
+
+def natural_key(name):
+    # "track 2" sorts before "track 10"
+    parts = digits.split(name.casefold())
+    parts[1::2] = map(int, parts[1::2])
+    return tuple(parts)
+
+
+def is_media(name):
+    dot = name.rfind(".")
+    extension = name[dot:].lower() if dot > 0 else ""
+    media = media_cache.get(extension)
+    if media == None:
+        content_type = mimetypes.guess_type("file" + extension)[0]
+        media = extension in media_extensions or (
+            content_type != None
+            and content_type.startswith(media_types)
+            and extension not in playlist_extensions
+        )
+        media_cache[extension] = media
+    return media
+
+
+class DirectoryIndex:
+    def __init__(self, path):
+        self.path = path
+        self.names = []
+        self.keys = []
+        self.positions = {}
+        self.mtime = None
+        self.dirty = False
+        self.rescanning = False
+
+    def scan(self):
+        # The mtime is taken first, so a change during the listing is
+        # caught by the next lookup
+        mtime = os.stat(self.path).st_mtime_ns
+        with os.scandir(self.path) as it:
+            names = [e.name for e in it if is_media(e.name) and e.is_file()]
+        keys = list(map(natural_key, names))
+        order = sorted(range(len(names)), key=keys.__getitem__)
+        self.keys = [keys[i] for i in order]
+        self.names = [names[i] for i in order]
+        self.positions = {name: i for i, name in enumerate(self.names)}
+        self.mtime = mtime
+        self.dirty = False
+
+    def replace(self, other):
+        self.names = other.names
+        self.keys = other.keys
+        self.positions = other.positions
+        self.mtime = other.mtime
+        self.dirty = other.dirty
+
+    def add(self, name):
+        if not is_media(name) or self.position(name) != None:
+            return
+        key = natural_key(name)
+        i = bisect.bisect_right(self.keys, key)
+        self.keys.insert(i, key)
+        self.names.insert(i, name)
+        self.dirty = True
+
+    def remove(self, name):
+        i = self.position(name)
+        if i == None:
+            return
+        del self.keys[i]
+        del self.names[i]
+        self.dirty = True
+
+    def position(self, name):
+        if self.dirty:
+            # Renumbering is cheap next to listing and sorting again
+            self.positions = {name: i for i, name in enumerate(self.names)}
+            self.dirty = False
+        return self.positions.get(name)
+
+    def next(self, name):
+        i = self.position(name)
+        if i == None:
+            i = bisect.bisect_right(self.keys, natural_key(name))
+        else:
+            i = i + 1
+        return self.names[i] if i < len(self.names) else None
+
+    def following(self, name, count):
+        i = self.position(name)
+        if i == None:
+            i = bisect.bisect_right(self.keys, natural_key(name))
+        else:
+            i = i + 1
+        return self.names[i : i + count]
+
+    def previous(self, name):
+        i = self.position(name)
+        if i == None:
+            i = bisect.bisect_left(self.keys, natural_key(name))
+        return self.names[i - 1] if i > 0 else None
+
+
+class Inotify:
+    def __init__(self, callback):
+        import ctypes
+
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.callback = callback
+        self.watches = {}
+        self.paths = {}
+        self.lock = threading.Lock()
+        self.wake_r, self.wake_w = os.pipe()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def add(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), watch_mask)
+        if wd < 0:
+            return False
+        with self.lock:
+            self.watches[wd] = path
+            self.paths[path] = wd
+        return True
+
+    def remove(self, path):
+        with self.lock:
+            wd = self.paths.pop(path, None)
+        if wd != None:
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def close(self):
+        self.running = False
+        os.write(self.wake_w, b"\0")
+        self.thread.join()
+        os.close(self.fd)
+        os.close(self.wake_r)
+        os.close(self.wake_w)
+
+    def run(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self.fd, selectors.EVENT_READ)
+        selector.register(self.wake_r, selectors.EVENT_READ)
+        while self.running:
+            for key, events in selector.select():
+                if key.fd == self.fd:
+                    self.read()
+        selector.close()
+
+    def read(self):
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = event_header.unpack_from(data, offset)
+            offset = offset + event_header.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset = offset + length
+            with self.lock:
+                path = self.watches.get(wd)
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+            if path != None or mask & IN_Q_OVERFLOW:
+                self.callback(path, os.fsdecode(name), mask)
+
+
+class PlaylistIndex:
+    # Directory playlists are listed and sorted once, in the background,
+    # then kept up to date from inotify. Every lookup still compares the
+    # directory mtime, which catches changes inotify can not see such as
+    # those made on another machine sharing a network mount
+    def __init__(self, size=8):
+        self.size = size
+        self.lock = threading.Lock()
+        self.indexes = OrderedDict()
+        self.executor = ThreadPoolExecutor(max_workers=2)
+        try:
+            self.watcher = Inotify(self.on_change)
+        except (OSError, AttributeError):
+            self.watcher = None
+
+    def prepare(self, path):
+        with self.lock:
+            future = self.indexes.get(path)
+            if future != None:
+                self.indexes.move_to_end(path)
+                return future
+            future = self.executor.submit(self.build, path)
+            self.indexes[path] = future
+            if len(self.indexes) > self.size:
+                old, _ = self.indexes.popitem(last=False)
+                if self.watcher != None:
+                    self.watcher.remove(old)
+            return future
+
+    def build(self, path):
+        if self.watcher != None:
+            self.watcher.add(path)
+        index = DirectoryIndex(path)
+        index.scan()
+        return index
+
+    def get(self, path):
+        # Only the first listing is waited on, and that one started when
+        # the file was cast. A directory that changed since is listed again
+        # on the executor while lookups keep the index as it was
+        try:
+            index = self.prepare(path).result()
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            self.discard(path)
+            return None
+        with self.lock:
+            if index.mtime != mtime and not index.rescanning:
+                index.rescanning = True
+                self.executor.submit(self.rescan, index)
+        return index
+
+    def rescan(self, index):
+        fresh = DirectoryIndex(index.path)
+        try:
+            fresh.scan()
+        except OSError:
+            # Gone, the next lookup finds out and drops it
+            fresh = None
+        with self.lock:
+            index.rescanning = False
+            if fresh != None:
+                index.replace(fresh)
+
+    def discard(self, path):
+        with self.lock:
+            self.indexes.pop(path, None)
+        if self.watcher != None:
+            self.watcher.remove(path)
+
+    def next(self, path, name):
+        index = self.get(path)
+        if index == None:
+            return None
+        with self.lock:
+            return index.next(name)
+
+    def following(self, path, name, count):
+        index = self.get(path)
+        if index == None:
+            return []
+        with self.lock:
+            return index.following(name, count)
+
+    def previous(self, path, name):
+        index = self.get(path)
+        if index == None:
+            return None
+        with self.lock:
+            return index.previous(name)
+
+    def on_change(self, path, name, mask):
+        with self.lock:
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, rescan everything on its next lookup
+                futures = list(self.indexes.values())
+            else:
+                futures = [self.indexes.get(path)]
+            for future in futures:
+                if future == None or not future.done() or future.exception():
+                    continue
+                index = future.result()
+                if mask & (IN_Q_OVERFLOW | IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                    index.mtime = None
+                    continue
+                if mask & IN_ISDIR:
+                    continue
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    index.add(name)
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    index.remove(name)
+                if index.mtime != None:
+                    try:
+                        index.mtime = os.stat(path).st_mtime_ns
+                    except OSError:
+                        index.mtime = None
+
+    def close(self):
+        if self.watcher != None:
+            self.watcher.close()
+            self.watcher = None
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,152 @@
+# Copyright 2020 - Scott Moreau
+
+# Status streams recorded while using the app, to replay them later and
+# profile what the listeners do with them. A recording is gzipped json
+# lines, a header, each device once before its first event and then an
+# event per line:
+#   [seconds, device, kind, fields]
+# where kind is m for a media status, c for a cast status and s for the
+# device being selected. Only fields that changed since the previous
+# status of that kind from that device are written, most statuses only
+# move current_time
+
+import gzip
+import json
+import time
+import threading
+import dataclasses
+from datetime import datetime, timezone
+
+FORMAT = 1
+
+
+def open_recorder(args):
+    if not args.record_statuses:
+        return None
+    try:
+        return Recorder(args.record_statuses)
+    except OSError as e:
+        print("Failed to record statuses to", args.record_statuses + ":", e)
+        return None
+
+
+def status_fields(status):
+    if dataclasses.is_dataclass(status):
+        return "c", dataclasses.asdict(status)
+    fields = dict(vars(status))
+    # Replayed statuses are stamped when they are fed back in
+    fields.pop("last_updated", None)
+    return "m", fields
+
+
+class Recorder:
+    # Socket threads only queue what they saw, the gui thread encodes and
+    # writes it every interval seconds while statuses keep coming
+    def __init__(self, path, interval=2.0):
+        self.path = path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.written = self.start
+        self.devices = {}
+        self.last = {}
+        self.pending = []
+        self.events = 0
+        self.file = gzip.open(path, "wt", encoding="utf-8")
+        header = {"catt-qt-statuses": FORMAT, "started": time.time()}
+        self.file.write(json.dumps(header) + "\n")
+
+    def device(self, d):
+        # Called with the lock held
+        key = d.cast.uuid
+        n = self.devices.get(key)
+        if n == None:
+            n = len(self.devices)
+            self.devices[key] = n
+            self.pending.append({"device": n, "uuid": str(key), "name": d.device.name})
+        return n
+
+    def record(self, d, status):
+        t = time.perf_counter() - self.start
+        kind, fields = status_fields(status)
+        with self.lock:
+            n = self.device(d)
+            last = self.last.get((n, kind), {})
+            changed = {
+                k: v for k, v in fields.items() if k not in last or last[k] != v
+            }
+            self.last[(n, kind)] = fields
+            self.pending.append([round(t, 4), n, kind, changed])
+            self.events = self.events + 1
+
+    def select(self, d):
+        t = time.perf_counter() - self.start
+        with self.lock:
+            self.pending.append([round(t, 4), self.device(d), "s", {}])
+
+    def write(self, force=False):
+        now = time.perf_counter()
+        if not force and now - self.written < self.interval:
+            return
+        self.written = now
+        with self.lock:
+            pending = self.pending
+            self.pending = []
+        if not pending or self.file == None:
+            return
+        try:
+            for entry in pending:
+                self.file.write(json.dumps(entry, default=str) + "\n")
+            # Readable up to here should the app not get to close it
+            self.file.flush()
+        except OSError as e:
+            print("Failed to record statuses to", self.path + ":", e)
+            self.file = None
+
+    def close(self):
+        self.write(True)
+        if self.file != None:
+            self.file.close()
+            self.file = None
+
+
+def read_recording(path):
+    # The devices and the events, each with its status whole again
+    devices = []
+    events = []
+    state = {}
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        try:
+            header = json.loads(f.readline())
+        except ValueError:
+            header = None
+        if not isinstance(header, dict) or header.get("catt-qt-statuses") != FORMAT:
+            raise ValueError(path + " is not a catt-qt status recording")
+        try:
+            for line in f:
+                entry = json.loads(line)
+                if isinstance(entry, dict):
+                    devices.append(entry)
+                    continue
+                t, n, kind, changed = entry
+                fields = state.setdefault((n, kind), {})
+                fields.update(changed)
+                events.append((t, n, kind, dict(fields)))
+        except (EOFError, ValueError):
+            # The end of a recording the app did not close
+            pass
+    return devices, events
+
+
+def build_status(kind, fields):
+    from pychromecast.controllers.media import MediaStatus
+    from pychromecast.controllers.receiver import CastStatus
+
+    if kind == "c":
+        names = {f.name for f in dataclasses.fields(CastStatus)}
+        return CastStatus(**{k: v for k, v in fields.items() if k in names})
+    status = MediaStatus()
+    for name, value in fields.items():
+        setattr(status, name, value)
+    status.last_updated = datetime.now(timezone.utc)
+    return status
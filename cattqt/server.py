@@ -0,0 +1,302 @@
+# Copyright 2020 - Scott Moreau
+
+import os
+import socket
+import secrets
+import selectors
+import threading
+from urllib.parse import quote, unquote
+
+reasons = {
+    200: "OK",
+    206: "Partial Content",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    416: "Range Not Satisfiable",
+}
+
+
+def parse_range(value, size):
+    # Returns the inclusive (first, last) byte range, None for the whole file
+    # or raises ValueError when the range can not be satisfied
+    if not value:
+        return None
+    unit, _, spec = value.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        raise ValueError(value)
+    first, _, last = spec.strip().partition("-")
+    if first == "":
+        # Suffix range, the last n bytes of the file
+        n = int(last)
+        if n <= 0:
+            raise ValueError(value)
+        return max(size - n, 0), size - 1
+    first = int(first)
+    last = int(last) if last else size - 1
+    if first >= size or last < first:
+        raise ValueError(value)
+    return first, min(last, size - 1)
+
+
+class MediaFile:
+    def __init__(self, path, content_type):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.content_type = content_type
+
+
+class Connection:
+    def __init__(self, sock):
+        self.sock = sock
+        self.inbuf = b""
+        self.outbuf = b""
+        self.token = None
+        self.file = None
+        self.offset = 0
+        self.remaining = 0
+        self.keep_alive = True
+
+    def close_file(self):
+        if self.file != None:
+            self.file.close()
+            self.file = None
+        self.remaining = 0
+
+
+class MediaServer:
+    def __init__(self, host="", port=0):
+        self.host = host
+        self.port = port
+        self.files = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.running = False
+        self.sendfile = hasattr(os, "sendfile")
+
+    def start(self):
+        if self.running:
+            return
+        self.listener = socket.create_server(
+            (self.host, self.port), reuse_port=False, backlog=64
+        )
+        self.listener.setblocking(False)
+        self.port = self.listener.getsockname()[1]
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listener, selectors.EVENT_READ, None)
+        self.selector.register(self.wake_r, selectors.EVENT_READ, None)
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        self.wake()
+        self.thread.join()
+
+    def wake(self):
+        try:
+            self.wake_w.send(b"\0")
+        except OSError:
+            pass
+
+    def add_file(self, path, content_type=None):
+        if content_type == None:
+            from catt.util import guess_mime
+
+            content_type = guess_mime(path)
+        token = secrets.token_urlsafe(16)
+        with self.lock:
+            self.files[token] = MediaFile(path, content_type)
+        return token
+
+    def remove_file(self, token):
+        with self.lock:
+            self.files.pop(token, None)
+        # Transfers of a removed file are dropped on the server thread
+        self.wake()
+
+    def url(self, token, address):
+        with self.lock:
+            f = self.files.get(token)
+        name = quote(f.name) if f != None else ""
+        return "http://%s:%d/%s/%s" % (address, self.port, token, name)
+
+    def serve(self):
+        while self.running:
+            for key, events in self.selector.select():
+                if key.fileobj is self.listener:
+                    self.accept()
+                elif key.fileobj is self.wake_r:
+                    self.drain_wake()
+                else:
+                    self.handle(key.data, events)
+        for key in list(self.selector.get_map().values()):
+            if key.data != None:
+                self.close(key.data)
+        self.selector.close()
+        self.listener.close()
+        self.wake_r.close()
+        self.wake_w.close()
+
+    def accept(self):
+        while True:
+            try:
+                sock, address = self.listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            c = Connection(sock)
+            self.selector.register(sock, selectors.EVENT_READ, c)
+
+    def drain_wake(self):
+        try:
+            while self.wake_r.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        with self.lock:
+            tokens = set(self.files)
+        for key in list(self.selector.get_map().values()):
+            c = key.data
+            if c != None and c.token != None and c.token not in tokens:
+                self.close(c)
+
+    def close(self, c):
+        c.close_file()
+        try:
+            self.selector.unregister(c.sock)
+        except (KeyError, ValueError):
+            pass
+        c.sock.close()
+
+    def handle(self, c, events):
+        try:
+            if events & selectors.EVENT_READ and not c.outbuf and not c.remaining:
+                data = c.sock.recv(65536)
+                if not data:
+                    self.close(c)
+                    return
+                c.inbuf = c.inbuf + data
+                if b"\r\n\r\n" in c.inbuf:
+                    head, _, c.inbuf = c.inbuf.partition(b"\r\n\r\n")
+                    self.respond(c, head.decode("latin-1"))
+                elif len(c.inbuf) > 65536:
+                    self.close(c)
+                    return
+            if c.outbuf or c.remaining:
+                self.write(c)
+        except (ConnectionError, OSError):
+            # The receiver drops the connection when it seeks or stops
+            self.close(c)
+
+    def respond(self, c, head):
+        lines = head.split("\r\n")
+        try:
+            method, target, protocol = lines[0].split(" ", 2)
+        except ValueError:
+            self.error(c, 400)
+            return
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        connection = headers.get("connection", "").lower()
+        if protocol == "HTTP/1.0":
+            c.keep_alive = connection == "keep-alive"
+        else:
+            c.keep_alive = connection != "close"
+        if method not in ("GET", "HEAD"):
+            self.error(c, 405)
+            return
+        token = unquote(target.lstrip("/").split("/", 1)[0].split("?", 1)[0])
+        with self.lock:
+            f = self.files.get(token)
+        if f == None:
+            self.error(c, 404)
+            return
+        try:
+            fd = open(f.path, "rb")
+            size = os.fstat(fd.fileno()).st_size
+        except OSError:
+            self.error(c, 404)
+            return
+        try:
+            byte_range = parse_range(headers.get("range"), size)
+        except ValueError:
+            fd.close()
+            self.error(c, 416, [("Content-Range", "bytes */%d" % size)])
+            return
+        if byte_range == None:
+            status = 200
+            first, last = 0, size - 1
+            extra = []
+        else:
+            status = 206
+            first, last = byte_range
+            extra = [("Content-Range", "bytes %d-%d/%d" % (first, last, size))]
+        length = max(last - first + 1, 0)
+        extra.append(("Content-Type", f.content_type))
+        extra.append(("Accept-Ranges", "bytes"))
+        self.queue_head(c, status, length, extra)
+        if method == "HEAD" or length == 0:
+            fd.close()
+            return
+        c.token = token
+        c.file = fd
+        c.offset = first
+        c.remaining = length
+
+    def error(self, c, status, extra=None):
+        c.keep_alive = False
+        self.queue_head(c, status, 0, extra or [])
+
+    def queue_head(self, c, status, length, extra):
+        head = ["HTTP/1.1 %d %s" % (status, reasons[status])]
+        head.append("Content-Length: %d" % length)
+        head.append("Access-Control-Allow-Origin: *")
+        head.append("Connection: " + ("keep-alive" if c.keep_alive else "close"))
+        for name, value in extra:
+            head.append(name + ": " + value)
+        c.outbuf = c.outbuf + ("\r\n".join(head) + "\r\n\r\n").encode("latin-1")
+        self.selector.modify(c.sock, selectors.EVENT_WRITE, c)
+
+    def write(self, c):
+        try:
+            while c.outbuf:
+                sent = c.sock.send(c.outbuf)
+                c.outbuf = c.outbuf[sent:]
+            while c.remaining:
+                if self.sendfile:
+                    # Zero copy from the page cache to the socket
+                    sent = os.sendfile(
+                        c.sock.fileno(),
+                        c.file.fileno(),
+                        c.offset,
+                        min(c.remaining, 1 << 20),
+                    )
+                else:
+                    c.file.seek(c.offset)
+                    sent = c.sock.send(c.file.read(min(c.remaining, 1 << 16)))
+                if sent == 0:
+                    self.close(c)
+                    return
+                c.offset = c.offset + sent
+                c.remaining = c.remaining - sent
+        except (BlockingIOError, InterruptedError):
+            return
+        c.close_file()
+        c.token = None
+        if not c.keep_alive:
+            self.close(c)
+            return
+        self.selector.modify(c.sock, selectors.EVENT_READ, c)
+        if b"\r\n\r\n" in c.inbuf:
+            # A pipelined request is already buffered
+            head, _, c.inbuf = c.inbuf.partition(b"\r\n\r\n")
+            self.respond(c, head.decode("latin-1"))